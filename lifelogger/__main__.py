@@ -2,28 +2,110 @@
 # coding=utf-8
 from __future__ import absolute_import, print_function
 
+import logging
 import sys
+import time
 
-from oauth2client import client as oa2c_client
+from . import daemon, profiling
 
-from .commands import parser
+# Imports count as the startup phase of --profile
+START_TIME, START_CPU = time.time(), profiling.cpu_time()
 
 
-def main():
-    if len(sys.argv) <= 1:
-        parser.print_help()
-        return True
+def run(argv):
+    """Parse the command line arguments and run the chosen command
+
+    :param argv: Command line arguments, without the program name
+    :return: Exit status
+    """
+    from .commands import parser
 
-    kwargs = dict(parser.parse_args(sys.argv[1:])._get_kwargs())
+    kwargs = dict(parser.parse_args(argv)._get_kwargs())
     func = kwargs.pop('func')
+    verbose = kwargs.pop('verbose')
+    profile_output = kwargs.pop('profile_output')
+    cprofile_path = kwargs.pop('cprofile')
+    if kwargs.pop('profile') or cprofile_path:
+        return run_profiled(func, kwargs, argv, profile_output, cprofile_path, verbose)
+    return run_command(func, kwargs, verbose)
+
+
+def run_command(func, kwargs, verbose):
+    from oauth2client import client as oa2c_client
+    from . import scheduler
+    from .utils import QueryTimeout, SchemaOutdated
+
+    # Log to the current stderr, which the daemon swaps per request
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger = logging.getLogger('lifelogger')
+    logger.addHandler(handler)
+    logger.setLevel({0: logging.WARNING, 1: logging.INFO}.get(verbose, logging.DEBUG))
+    scheduler.get().reset_usage()
+    # Only loaded by the commands that use the database
+    database = sys.modules.get(__package__ + '.database')
+    if database is not None:
+        database.query_stats.reset_usage()
 
     try:
         successful = func(**kwargs)
-        sys.exit(0 if successful else 1)
+        return 0 if successful else 1
     except oa2c_client.AccessTokenRefreshError:
         print("The credentials have been revoked or expired, please re-run"
               "the application to re-authorize")
-        sys.exit(1)
+        return 1
+    except (QueryTimeout, SchemaOutdated) as exc:
+        sys.stderr.write("Error: %s\n" % exc)
+        return 1
+    finally:
+        scheduler.get().log_usage()
+        database = sys.modules.get(__package__ + '.database')
+        if database is not None:
+            database.query_stats.log_usage()
+        logger.removeHandler(handler)
+
+
+def run_profiled(func, kwargs, argv, profile_output, cprofile_path, verbose):
+    """Run the command under --profile, reporting its phases on stderr
+    """
+    import cProfile
+
+    profile = profiling.start()
+    profile.record('startup', time.time() - START_TIME, profiling.cpu_time() - START_CPU)
+    profiler = cProfile.Profile() if cprofile_path else None
+    try:
+        with profiling.phase(func.parser.prog.split()[-1]):
+            if profiler is not None:
+                profiler.enable()
+            try:
+                return run_command(func, kwargs, verbose)
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+    finally:
+        profiling.stop()
+        sys.stderr.write("\n")
+        profile.write_table(sys.stderr)
+        profiling.save(profile, profile_output, argv=argv, cprofile=cprofile_path)
+        sys.stderr.write("Profile saved to %s\n" % profile_output)
+        if profiler is not None:
+            profiler.dump_stats(cprofile_path)
+            sys.stderr.write("cProfile stats saved to %s\n" % cprofile_path)
+
+
+def main():
+    if len(sys.argv) <= 1:
+        from .commands import parser
+        parser.print_help()
+        return True
+
+    # Hand quick commands over to the daemon, if one is running
+    if daemon.forwardable(sys.argv[1:]):
+        status = daemon.forward(sys.argv[1:])
+        if status is not None:
+            sys.exit(status)
+
+    sys.exit(run(sys.argv[1:]))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,108 @@
+# coding=utf-8
+"""
+Concurrent client layer for bulk Calendar API work (sync-nomie, import,
+journal flushes): runs many calls at once on a few threads, as the service
+from connection.connect() can be shared between them (see transport.py), and
+reports their results in order.
+
+Pacing, retries and the bound on requests in flight stay with the request
+scheduler (see scheduler.py), so raising the concurrency past its
+"max_in_flight" setting gains nothing.
+"""
+from __future__ import absolute_import
+
+import itertools
+import sys
+import threading
+
+import six
+from six.moves import queue
+
+from .config import config
+from .scheduler import DEFAULT_MAX_IN_FLIGHT
+
+# Long enough to never expire, but makes waits interruptible by Ctrl-C on
+# Python 2
+WAIT_TIMEOUT = 24 * 60 * 60
+
+
+def default_concurrency():
+    return config.get('api', {}).get('max_in_flight', DEFAULT_MAX_IN_FLIGHT)
+
+
+def imap(func, items, concurrency=None):
+    """Like map(), but calling func on up to concurrency items at once
+
+    Results come in the order of items, as soon as each and everything
+    before it are done. An exception from func is re-raised in its turn.
+    Either that, Ctrl-C or closing the generator early cancels the calls not
+    started yet, waiting for those in flight.
+
+    :param func: Callable taking an item - called from worker threads
+    :param items: Iterable of items, consumed lazily
+    :param concurrency: Number of worker threads - default the scheduler's
+                        max_in_flight
+    """
+    items = iter(items)
+    counter = itertools.count()
+    lock = threading.Lock()
+    cancelled = threading.Event()
+    results = queue.Queue()
+
+    def worker():
+        while not cancelled.is_set():
+            with lock:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                index = next(counter)
+            try:
+                results.put((index, True, func(item)))
+            except BaseException:
+                results.put((index, False, sys.exc_info()))
+        results.put(None)  # This worker is done
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency or default_concurrency())]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    finished = {}
+    next_index = 0
+    running = len(threads)
+    try:
+        while running:
+            message = results.get(True, WAIT_TIMEOUT)
+            if message is None:
+                running -= 1
+                continue
+
+            index, successful, value = message
+            finished[index] = (successful, value)
+            while next_index in finished:
+                successful, value = finished.pop(next_index)
+                next_index += 1
+                if not successful:
+                    six.reraise(*value)
+                yield value
+    finally:
+        cancelled.set()
+        for thread in threads:
+            thread.join()
+
+
+def execute_all(requests, concurrency=None):
+    """Execute API requests concurrently
+
+    :param requests: Iterable of requests, e.g. service.events().insert(...)
+    :param concurrency: See imap()
+    :return: Generator of (response, exception) per request, in order
+    """
+    def execute(request):
+        try:
+            return request.execute(), None
+        except Exception as exc:
+            return None, exc
+
+    return imap(execute, requests, concurrency)
@@ -0,0 +1,183 @@
+# coding=utf-8
+"""
+Persistent cache of the output of local query commands (list, csv, sql...).
+
+Entries are keyed on the command's normalized arguments plus the database
+generation, a counter bumped by every import, so they never outlive the data
+they were computed from. A hit streams the stored output straight to stdout,
+without opening the SQLite database or importing peewee.
+
+Settings live under the "cache" key of the config file:
+- "enabled": default true
+- "max_entries": entries kept before evicting the least recently used
+- "max_bytes": total size kept before evicting the least recently used
+"""
+from __future__ import absolute_import
+
+import functools
+import hashlib
+import json
+import os
+import sys
+
+from .config import CACHE_PATH, GENERATION_PATH, config, write_atomically
+
+DEFAULT_MAX_ENTRIES = 200
+DEFAULT_MAX_BYTES = 50 * 1024 * 1024
+
+ENTRY_SUFFIX = '.out'
+STATS_PATH = os.path.join(CACHE_PATH, 'stats.json')
+
+
+def generation():
+    try:
+        with open(GENERATION_PATH) as f:
+            return int(f.read().strip() or 0)
+    except (IOError, ValueError):
+        return 0
+
+
+def bump_generation():
+    """
+    Marks the database as changed, invalidating all cached results. Must be
+    called by anything that writes to the database.
+    """
+    write_atomically(GENERATION_PATH, str(generation() + 1).encode('ascii'))
+
+
+def settings():
+    values = config.get('cache', {})
+    return (
+        values.get('enabled', True),
+        values.get('max_entries', DEFAULT_MAX_ENTRIES),
+        values.get('max_bytes', DEFAULT_MAX_BYTES),
+    )
+
+
+def entry_key(command, kwargs):
+    normalized = json.dumps(
+        [command, sorted(kwargs.items()), sys.stdout.isatty(), generation()],
+        sort_keys=True,
+    )
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+
+def entries():
+    """
+    Returns the (mtime, size, path) of every entry, least recently used first.
+    """
+    found = []
+    for name in os.listdir(CACHE_PATH):
+        if not name.endswith(ENTRY_SUFFIX):
+            continue
+        path = os.path.join(CACHE_PATH, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        found.append((st.st_mtime, st.st_size, path))
+    return sorted(found)
+
+
+def evict(max_entries, max_bytes):
+    found = entries()
+    total_bytes = sum(size for _, size, _ in found)
+    while found and (len(found) > max_entries or total_bytes > max_bytes):
+        _, size, path = found.pop(0)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total_bytes -= size
+
+
+def clear():
+    for _, _, path in entries():
+        os.remove(path)
+    write_stats({'hits': 0, 'misses': 0})
+
+
+def read_stats():
+    try:
+        with open(STATS_PATH) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {'hits': 0, 'misses': 0}
+
+
+def write_stats(stats):
+    write_atomically(STATS_PATH, json.dumps(stats).encode('utf-8'))
+
+
+def count(counter):
+    stats = read_stats()
+    stats[counter] = stats.get(counter, 0) + 1
+    write_stats(stats)
+
+
+def binary_stdout():
+    return getattr(sys.stdout, 'buffer', sys.stdout)
+
+
+class Tee(object):
+    """
+    Stands in for stdout, passing writes through while recording them.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.chunks = []
+
+    def write(self, data):
+        self.stream.write(data)
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        self.chunks.append(data)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def cached_output(cacheable=None):
+    """
+    Decorator for commands whose output only depends on their arguments and
+    the database. Adds a 'no_cache' keyword argument to bypass the cache;
+    'cacheable' is an optional predicate on the arguments.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(**kwargs):
+            no_cache = kwargs.pop('no_cache', False)
+            enabled, max_entries, max_bytes = settings()
+            if no_cache or not enabled or (cacheable is not None and not cacheable(**kwargs)):
+                return func(**kwargs)
+
+            path = os.path.join(CACHE_PATH, entry_key(func.__name__, kwargs) + ENTRY_SUFFIX)
+            try:
+                f = open(path, 'rb')
+            except IOError:
+                pass
+            else:
+                with f:
+                    successful = f.readline() == b'1\n'
+                    out = binary_stdout()
+                    for chunk in iter(lambda: f.read(64 * 1024), b''):
+                        out.write(chunk)
+                os.utime(path, None)  # Most recently used
+                count('hits')
+                return successful
+
+            count('misses')
+            tee = Tee(sys.stdout)
+            sys.stdout = tee
+            try:
+                successful = func(**kwargs)
+            finally:
+                sys.stdout = tee.stream
+
+            write_atomically(path, (b'1\n' if successful else b'0\n') + b''.join(tee.chunks))
+            evict(max_entries, max_bytes)
+            return successful
+
+        return wrapper
+    return decorator
@@ -6,13 +6,16 @@ from __future__ import absolute_import
 from __future__ import print_function
 import re
 import sys
+from contextlib import closing
 from datetime import datetime, timedelta
 
 import dateutil.parser
 from googleapiclient.errors import HttpError
 
-from ..connection import connect
+from .. import bulk, importer, journal, recent
+from ..connection import MAX_PAGE_SIZE, PagedList, connect, connected, credentials_stored
 from ..config import config
+from ..utils import BackgroundCall
 
 from .parser import subparsers
 import six
@@ -21,27 +24,18 @@ import six
 def quickadd(summary):
     summary = ' '.join(summary)
 
-    service = connect()
-
     # Double up single-time events to be 0-length
     match = re.match(r'^\d\d:\d\d ', summary)
     if match:
         summary = match.group(0)[:-1] + '-' + summary
 
-    # Make request
+    prepare_queue()
+
+    # Journal request
     print("Quick add >>", summary)
 
-    result = service.events().quickAdd(
-        calendarId=config['calendar_id'],
-        text=summary
-    ).execute()
-
-    if result['status'] == 'confirmed':
-        print("Added! Link: ", result['htmlLink'])
-        return True
-    else:
-        sys.stdout.write("Failed :( - status %s\n" % result['status'])
-        return False
+    journal.queue_quickadd(config['calendar_id'], summary)
+    return queued()
 
 
 quickadd.parser = subparsers.add_parser(
@@ -60,6 +54,34 @@ quickadd.parser.add_argument(
 quickadd.parser.set_defaults(func=quickadd)
 
 
+def prepare_queue():
+    """Connect in the foreground on first use, so the OAuth flow can run and
+    the timezone gets stored before anything is journaled
+    """
+    if not credentials_stored() or 'timezone' not in config:
+        connect()
+
+
+def queued():
+    """Report an event as journaled, and start pushing it unless disabled
+
+    :return: True if nothing failed
+    """
+    if connected() and journal.spawn_flush:
+        # Already connected (first use) - may as well push it right now. If
+        # another process is flushing, it pushes this one too.
+        return journal.flush(connect) in (0, None)
+
+    if journal.spawn_flush and config.get('journal_autoflush', True):
+        journal.flush_in_background()
+        print("Queued! Pushing to Google Calendar in the background.")
+    elif journal.spawn_flush:
+        print("Queued! Run 'lifelogger flush' to push it to Google Calendar.")
+    else:
+        print("Queued!")
+    return True
+
+
 def now(summary, duration):
     try:
         offset = int(summary[0])
@@ -69,15 +91,14 @@ def now(summary, duration):
 
     summary = ' '.join(summary)
 
-    service = connect()
-
     start = datetime.now() + timedelta(minutes=offset)
     end = start + timedelta(minutes=duration)
 
     print("Adding %i-minute event >> %s" % (duration, summary))
 
-    result = service.events().insert(
-        calendarId=config['calendar_id'],
+    prepare_queue()
+    journal.queue_insert(
+        config['calendar_id'],
         body={
             'summary': summary,
             'start': {
@@ -89,14 +110,8 @@ def now(summary, duration):
                 'timeZone': config['timezone']
             }
         }
-    ).execute()
-
-    if result['status'] == 'confirmed':
-        print("Added! Link: ", result['htmlLink'])
-        return True
-    else:
-        sys.stdout.write("Failed :( - status %s\n" % result['status'])
-        return False
+    )
+    return queued()
 
 
 now.parser = subparsers.add_parser(
@@ -136,6 +151,7 @@ def new_command(summary, do_cancel_on_empty_body=False, do_escape_html=True):
     import os
     import notify2
     from ..config import DATA_PATH, MSG_PATH
+    from ..database import store_api_events
 
     notify2.init("lifelogger")
     # Use global try block to notify user/developer about uncaught exceptions
@@ -149,8 +165,8 @@ def new_command(summary, do_cancel_on_empty_body=False, do_escape_html=True):
 
         summary = ' '.join(summary)
 
-        # Get Calendar service (entrypoint to API)
-        service = connect()
+        # Get Calendar service (entrypoint to API) while the user types
+        service_call = BackgroundCall(prepare_service)
 
         start = datetime.now() + timedelta(minutes=offset)
         start_str = start.isoformat()
@@ -179,6 +195,9 @@ def new_command(summary, do_cancel_on_empty_body=False, do_escape_html=True):
         call_return = subprocess.call(gedit_args)
         assert call_return is 0
 
+        # Editor closed: from here on the service is needed
+        service = service_call.result()
+
         # Parse summary and description from message file
         with open(message_filename, 'r') as f:
             # Get summary from first line
@@ -207,26 +226,18 @@ def new_command(summary, do_cancel_on_empty_body=False, do_escape_html=True):
             return False
 
         # Translate start time into datetime
-        now = datetime.utcnow()
         if times['start'] == start.strftime("%H:%M"):
             # Same start time as originally stored
             pass
         elif times['start'] == 'last':
             # Special keyword
 
-            # Query events from last 2 days in *lifelogger*
-            last_events = service.events().list(
-                calendarId=config['calendars']['lifelogger']['id'],
-                timeMin=(now - timedelta(days=2)).isoformat() + "Z",
-                timeMax=now.isoformat() + "Z"
-            ).execute()['items']
-
-            # Get endtimes of all retrieved events
-            GetDateTime = lambda str: datetime.strptime(str, "%Y-%m-%dT%H:%M:%S")
-            endtimes = [GetDateTime(event['end']['dateTime'][0:-6]) for event in last_events]
-
-            # Keep last finished event as starting point for current event
-            start = max(endtimes)
+            # Keep last finished event in *lifelogger* as starting point for
+            # current event
+            start = recent.latest_end(lambda: service)
+            if start is None:
+                print("ERROR: No events in the last 2 days to start from")
+                return False
         else:
             # Parse datetime from hh:mm
             try:
@@ -313,6 +324,13 @@ def new_command(summary, do_cancel_on_empty_body=False, do_escape_html=True):
 
         if result['status'] == 'confirmed':
             print("Added new entry! Link: ", result['htmlLink'])
+            # The entry is in the calendar already, and the next import would
+            # pick it up anyway
+            try:
+                store_api_events('lifelogger', [result])
+                recent.record('lifelogger', [result])
+            except Exception as exc:
+                print("Warning: could not write the new entry to the local database:", exc, file=sys.stderr)
             return True
         else:
             sys.stdout.write("Failed :( - status %s\n" % result['status'])
@@ -336,6 +354,21 @@ def new_command(summary, do_cancel_on_empty_body=False, do_escape_html=True):
         return False
 
 
+def prepare_service():
+    """Connect to the API and make sure the recent events cache is fresh, so
+    'from last' resolves instantly - run while the editor is open
+
+    :return: service
+    """
+    service = connect()
+    try:
+        if recent.is_stale(recent.load()):
+            recent.refresh(service)
+    except Exception:
+        pass  # Retried if 'last' is actually used
+    return service
+
+
 new_command.parser = subparsers.add_parser(
     'new',
     description="Creates a new event starting now and opens an editor for entry details.")
@@ -355,29 +388,17 @@ def cont_command(num_prev_events):
     :return:
     """
 
-    # Get Calendar service (entrypoint to API)
-    service = connect()
-
-    # Query events from last 2 days in *lifelogger*
-    # HARDCODED: Nr of days to query
-    now = datetime.utcnow()
-    last_events = service.events().list(
-        calendarId=config['calendars']['lifelogger']['id'],
-        timeMin=(now - timedelta(days=2)).isoformat() + "Z",
-        timeMax=now.isoformat() + "Z",
-        orderBy="updated"  # get ordered list of events
-    ).execute()['items']
+    # Latest events from last 2 days in *lifelogger*, newest first
+    # Only hits the API when the local cache is stale
+    summaries = recent.last_summaries(num_prev_events, connect)
 
     # Print list of last N events
-    for idx, event in enumerate(last_events[:-(num_prev_events + 1):-1]):
-        # Traverse num_prev_events last items in reverse order
-        # SOURCE: https://stackoverflow.com/a/509295
-        # That is: From newest back
-        print("%d: %s" % (idx + 1, event['summary']))
+    for idx, summary in enumerate(summaries):
+        print("%d: %s" % (idx + 1, summary))
 
     try:
         chosen_idx = input("Type event idx to continue: ")
-        if chosen_idx < 1 or chosen_idx > num_prev_events:
+        if chosen_idx < 1 or chosen_idx > len(summaries):
             raise IndexError
     except Exception as exc:
         import traceback
@@ -386,7 +407,7 @@ def cont_command(num_prev_events):
         return False
 
     # Parse event
-    tags_str, title = last_events[-chosen_idx]['summary'].split(':')
+    tags_str, title = summaries[chosen_idx - 1].split(':')
 
     # Parse tags
     tags_list = re.findall(r"(#\w+)", tags_str)
@@ -416,9 +437,11 @@ cont_command.parser.add_argument(
 cont_command.parser.set_defaults(func=cont_command)
 
 
-def sync_nomie():
+def sync_nomie(download=True):
     """Synchronize Nomie backup file with corresponding Calendar
 
+    :param download: Download all calendars first, to tell which events are
+                     new - skip if the local database is up to date already
     :return:
     """
 
@@ -428,152 +451,11 @@ def sync_nomie():
     to its own file in the future
     """
     import os
+    from .. import nomie
     from ..config import NOMIE_BACKUP_PATH
+    from ..database import store_api_events
     import json
 
-    # Define function locally
-    # TODO: move this to tools/nomie.py module
-    def parse_events(backup_data):
-        """Parse all events from Nomie backup into a list
-
-        :param backup_data: json-like backup data
-        :return: list of events data
-        """
-
-        # Store tracker metadata, keyed by Nomie id
-        trackers = backup_data['trackers']
-        trackers_dict = {}
-        # Save human-readable label
-        for tracker in trackers:
-            trackers_dict[tracker['_id']] = dict()
-            trackers_dict[tracker['_id']]['label'] = tracker['label']
-
-        # Save groups trackers belong to
-        groups = backup_data['meta'][1]['groups']
-        # NOTE: Below is not really necessary
-        # for group, ids in groups.iteritems():
-        #     for tracker_id in ids:
-        #         if 'groups' not in trackers_dict[tracker_id]:
-        #             # ensure groups list is initialized
-        #             trackers_dict[tracker_id]['groups'] = list()
-        #         # add current group to list for this tracker
-        #         trackers_dict[tracker_id]['groups'].append(group)
-
-        # Set special group colors
-        colors_dict = {
-            'green': '2',
-            'cocoa': '7'  # check log
-        }
-
-        # Support for changing the name of a tracker for a substitute
-        substitutes = {}
-
-        # Event fields: title, startdate, enddate, description
-        events = backup_data['events']
-        calendarEvents = []
-        corruptedCount = 0
-        addedCount = 0
-        for event in events:
-            # Extract needed data
-            try:
-                tracker_id = event['parent']
-                trackername = trackers_dict[tracker_id]['label']
-                # Substitute tracker name if substitute is defined
-                try:
-                    trackername = substitutes[trackername]
-                except:
-                    doNothing = True
-
-                # As Nomie 3 doesn't support spaces in tracker names, substitute with underscores
-                trackername = trackername.replace(' ', '_')
-                print(trackername)
-
-                # Value should be time in seconds of the event
-                # Note there is one single event for timer (at the end of timer)
-                event_duration = event['value']
-                # Currently automatically convert lack of value to 0
-                if event_duration == None:
-                    event_duration = 0
-                timestamp_in_millisecs = event['time']
-                timestamp_in_secs = timestamp_in_millisecs / 1000.0
-
-                # Now build event fields
-                # Time stored is that of end
-                enddate = datetime.fromtimestamp(timestamp_in_secs)
-                # Start date is <value> seconds before the end
-                startdate = enddate - timedelta(seconds=event_duration)
-                duration_str = str(timedelta(seconds=event_duration)).split(".")[0]  # drop microseconds
-                title = '#nomie: ' + trackername
-                description = trackername + ' for ' + duration_str
-
-                # Set event color according to group
-                if tracker_id in groups['Exercise']:
-                    color_id = colors_dict['green']
-                else:
-                    color_id = None
-
-                toAdd = {
-                    'title': title,
-                    'startdate': startdate,
-                    'enddate': enddate,
-                    'description': description,
-                    'colorId': color_id,
-                    # Metadata
-                    'time': timestamp_in_millisecs,
-                    'tag': trackername
-                }
-                calendarEvents += [toAdd]
-                addedCount += 1
-            except:
-                corruptedCount += 1
-                print("Shoot! This record seems to be corrupted. Try manually adding it or fixing the file.")
-                print(event)
-
-        print("Corrupted record count: " + str(corruptedCount))
-        print("Events successfully added: " + str(addedCount))
-
-        # Add notes into corresponding event
-        notes = backup_data["notes"]
-        # NOTE: By construction, calendarEvents list is ordered by enddate
-        endtimes = [event['enddate'] for event in calendarEvents]
-        assert all(a < b for a, b in zip(endtimes, endtimes[1:]))
-
-        event_iter = iter(calendarEvents)
-        current_event = event_iter.next()
-        for note in notes:
-            # Advance event until timestamp is larger or raise exemption
-            while current_event['time'] < note['time']:
-                previous_event = current_event
-                try:
-                    current_event = event_iter.next()
-                except StopIteration as err:
-                    # End of events list reached
-                    break
-            # At this point, previous_event should match current note
-
-            # Parse note value
-            lines = note['value'].splitlines()
-            if len(lines) < 2:
-                print("Bad note value (single line? -> Empty content?): \n %s" % note['value'])
-                continue
-            note_header = lines[0]
-            note_short = lines[1]
-            note_long = '\n'.join(lines[2:])
-
-            # Check tag
-            r = re.compile('#(?P<tag>\w+) ((?P<h>\d+)h )*((?P<m>\d+)m )*((?P<s>\d+)s )*\s+at (?P<time_str>\d\d:\d\d)')
-            out = r.match(note_header)
-            if out is None:
-                print("ERROR: Bad parsing of %s" % note_header)
-            parsed_values = out.groupdict()
-            assert parsed_values['tag'].lower() == previous_event['tag'].lower()
-
-            # Add note content to event summary and description
-            previous_event['title'] += " " + note_short
-            previous_event['description'] += "\n" + note_long
-
-        return calendarEvents
-
     # Ensure Nomie backup file exists
     if not os.path.exists(NOMIE_BACKUP_PATH):
         print("Failed - No available backup in %s" % NOMIE_BACKUP_PATH)
@@ -588,14 +470,13 @@ def sync_nomie():
     backup_data = json.loads(open(NOMIE_BACKUP_PATH).read())
 
     # Parse Nomie events into Calendar-like event list
-    events = parse_events(backup_data)
+    events = nomie.parse_events(backup_data)
 
     # Get Calendar service (entrypoint to API)
     service = connect()
 
     # Ensure Nomie calendar exists
-    all_cals = service.calendarList().list().execute()['items']
-    calendar_names = [cal['summary'] for cal in all_cals]
+    calendar_names = [cal['summary'] for cal in PagedList(service.calendarList().list, fields='summary')]
     if 'Nomie' not in calendar_names:
         from termcolor import colored
         print(colored("Warning: Nomie calendar missing, creating it!", 'yellow'))
@@ -615,39 +496,27 @@ def sync_nomie():
             body=calendar_list_entry
         ).execute()
 
-        # Save id of new calendar to local config
-        config['calendars']['Nomie']['id'] = created_calendar['id']
-
-        # Get and save iCal address
+        # Get iCal address
         new_ical_url = input("Paste new Secret address in iCal format (from settings) --> ")
-        config['calendars']['Nomie']['ical_url'] = new_ical_url
 
-        # Ensure new config is stored
-        config.save()
+        # Save id and iCal address of new calendar to local config, in one write
+        with config.batch():
+            config['calendars']['Nomie']['id'] = created_calendar['id']
+            config['calendars']['Nomie']['ical_url'] = new_ical_url
 
     # Ensure local database is up to date
-    from .local import download_all
-    download_all()
+    if download:
+        from .local import download_all
+        download_all()
 
     # Keep only new events
-    new_events = list()
-    from ..database import Event
-    for event in events:
-        # Generate unique Nomie event Id based on data
-        nomie_id = 'nomie' + event['startdate'].strftime('%Y%m%d%H%M%S')
-        try:
-            # If event exists, ignore this in new list
-            Event.get(Event.uid == nomie_id + "@google.com")
-        except Event.DoesNotExist as exc:
-            # Event not found, add it to new list
-            new_events.append(event)
+    new_events = nomie.new_events(events)
 
     # Insert new Nomie events into Calendar
 
-    new_entries_counter = 0
+    bodies = []
     for event in new_events:
-        # Generate unique Nomie event Id based on data
-        nomie_id = 'nomie' + event['startdate'].strftime('%Y%m%d%H%M%S')
+        nomie_id = nomie.event_id(event)
 
         # TODO: Check event does not already exist
         # TODO: Maybe find last non-synced event, or iterate backwards until reaching already-synced id
@@ -668,33 +537,49 @@ def sync_nomie():
         # Add color option if custom color
         if event['colorId'] is not None:
             body['colorId'] = event['colorId']
+        bodies.append(body)
 
-        try:
-            result = service.events().insert(
-                calendarId=config['calendars']['Nomie']['id'],
-                body=body
-            ).execute()
-        except HttpError as err:
-            if int(err.resp['status']) == 409:
-                from termcolor import colored
-                print(colored("Error: event already exists, delete Nomie calendar to reset!", 'red'))
-                # # Event already exists in chosen calendar
-                # body['status'] = "confirmed" # set visible again
-                # result = service.events().update(
-                #     calendarId=config['calendars']['Nomie']['id'],
-                #     eventId=body['id'],
-                #     body=body
-                # ).execute()
-            else:
-                raise
+    requests = (
+        service.events().insert(calendarId=config['calendars']['Nomie']['id'], body=body)
+        for body in bodies
+    )
 
-        if result['status'] == 'confirmed':
-            print("Added new entry! Link: ", result['htmlLink'])
-        else:
-            sys.stdout.write("Failed :( - status %s\n" % result['status'])
-            return False
+    new_entries_counter = 0
+    created_events = []
+    try:
+        # Several inserts in flight at once, results reported in order
+        with closing(bulk.execute_all(requests)) as results:
+            for result, err in results:
+                if err is not None:
+                    if isinstance(err, HttpError) and int(err.resp['status']) == 409:
+                        from termcolor import colored
+                        print(colored("Error: event already exists, delete Nomie calendar to reset!", 'red'))
+                        continue
+                        # # Event already exists in chosen calendar
+                        # body['status'] = "confirmed" # set visible again
+                        # result = service.events().update(
+                        #     calendarId=config['calendars']['Nomie']['id'],
+                        #     eventId=body['id'],
+                        #     body=body
+                        # ).execute()
+                    else:
+                        raise err
+
+                if result['status'] == 'confirmed':
+                    print("Added new entry! Link: ", result['htmlLink'])
+                    created_events.append(result)
+                else:
+                    sys.stdout.write("Failed :( - status %s\n" % result['status'])
+                    return False
 
-        new_entries_counter += 1
+                new_entries_counter += 1
+    finally:
+        # Make the new entries available locally without another download -
+        # failing that mustn't hide why the inserts stopped
+        try:
+            store_api_events('Nomie', created_events)
+        except Exception as exc:
+            print("Warning: could not write new events to the local database:", exc, file=sys.stderr)
 
     print("Added %d new entries!" % new_entries_counter)
     return True
@@ -703,14 +588,19 @@ def sync_nomie():
 sync_nomie.parser = subparsers.add_parser(
     'sync-nomie',
     description="Synchronize Nomie backup events to its own Calendar.")
+sync_nomie.parser.add_argument(
+    '--no-download',
+    dest='download',
+    action='store_false',
+    help="Trust the local database to be up to date (e.g. kept so by watch) "
+         "instead of running download_all first."
+)
 sync_nomie.parser.set_defaults(func=sync_nomie)
 
 
 def for_command(duration, summary):
     summary = ' '.join(summary)
 
-    service = connect()
-
     times = [
         datetime.now(),
         datetime.now() + timedelta(minutes=duration)
@@ -720,8 +610,9 @@ def for_command(duration, summary):
 
     print("Adding %i-minute event >> %s" % (abs(duration), summary))
 
-    result = service.events().insert(
-        calendarId=config['calendar_id'],
+    prepare_queue()
+    journal.queue_insert(
+        config['calendar_id'],
         body={
             'summary': summary,
             'start': {
@@ -733,14 +624,8 @@ def for_command(duration, summary):
                 'timeZone': config['timezone']
             }
         }
-    ).execute()
-
-    if result['status'] == 'confirmed':
-        print("Added! Link: ", result['htmlLink'])
-        return True
-    else:
-        sys.stdout.write("Failed :( - status %s\n" % result['status'])
-        return False
+    )
+    return queued()
 
 
 for_command.parser = subparsers.add_parser(
@@ -780,8 +665,6 @@ def add(summary, start=None, end=None, duration=None):
     if end is None:
         end = start + timedelta(minutes=duration)
 
-    service = connect()
-
     times = [start, end]
     times.sort()
     start, end = times
@@ -794,8 +677,9 @@ def add(summary, start=None, end=None, duration=None):
         summary=summary
     ))
 
-    result = service.events().insert(
-        calendarId=config['calendar_id'],
+    prepare_queue()
+    journal.queue_insert(
+        config['calendar_id'],
         body={
             'summary': summary,
             'start': {
@@ -807,14 +691,8 @@ def add(summary, start=None, end=None, duration=None):
                 'timeZone': config['timezone']
             }
         }
-    ).execute()
-
-    if result['status'] == 'confirmed':
-        print("Added! Link: ", result['htmlLink'])
-        return True
-    else:
-        sys.stdout.write("Failed :( - status %s\n" % result['status'])
-        return False
+    )
+    return queued()
 
 
 add.parser = subparsers.add_parser(
@@ -850,6 +728,136 @@ add.parser.add_argument(
 add.parser.set_defaults(func=add)
 
 
+def import_command(path, input_format, calendar, dry_run, skip_invalid, batch_size, concurrency):
+    """Import events in bulk from CSV or JSON lines, pushing them in batches
+
+    :param path: File to read, or '-' for stdin
+    :param input_format: 'csv' or 'jsonl' - default from the file name or
+                         contents
+    :param calendar: Name of the calendar in the config - default the one
+                     events are added to
+    :param dry_run: Only validate the input
+    :param skip_invalid: Import the valid rows even if some are invalid
+    :param batch_size: Number of events sent per batch request
+    :param concurrency: Number of batch requests in flight at once
+    :return: True if everything got imported
+    """
+    from ..config import calendar_name
+
+    if calendar is None:
+        calendar_id = config['calendar_id']
+        calendar = calendar_name(calendar_id)
+    elif calendar in config['calendars']:
+        calendar_id = config['calendars'][calendar]['id']
+    else:
+        print("Error: calendar %s not in the config" % calendar)
+        return False
+
+    if path == '-':
+        data = getattr(sys.stdin, 'buffer', sys.stdin).read()
+    else:
+        with open(path, 'rb') as f:
+            data = f.read()
+    data = data.decode('utf-8-sig')
+
+    prepare_queue()
+    input_format = input_format or importer.detect_format(path, data)
+    bodies, errors, repeats = importer.prepare(
+        importer.read_rows(data, input_format), calendar_id, config['timezone']
+    )
+
+    for line_no, message in errors:
+        print("Line %d: %s" % (line_no, message), file=sys.stderr)
+    if errors and not skip_invalid:
+        print("%d invalid rows - fix them or pass --skip-invalid." % len(errors))
+        return False
+
+    # Skip what an earlier import already queued or stored - events created
+    # with a given id get uid <id>@google.com
+    queued_ids = set(entry['id'] for entry in journal.pending())
+    stored = set()
+    if calendar is not None:
+        from ..database import stored_uids
+        stored = stored_uids(calendar, [body['id'] + '@google.com' for body in bodies])
+    new_bodies = [
+        body for body in bodies
+        if body['id'] not in queued_ids and body['id'] + '@google.com' not in stored
+    ]
+
+    print("Read %d events (%d invalid, %d repeated, %d already imported) - %d to import." % (
+        len(bodies) + len(errors) + repeats, len(errors), repeats,
+        len(bodies) - len(new_bodies), len(new_bodies)))
+    if dry_run or not new_bodies:
+        return True
+
+    journal.queue_inserts(calendar_id, new_bodies)
+    remaining = journal.flush(connect, batch_size=batch_size, concurrency=concurrency)
+    if remaining is None:
+        print("Queued! Another lifelogger process is flushing - it will push them.")
+        return True
+    elif remaining:
+        print("%d entries still pending - they will be retried on the next flush." % remaining)
+        return False
+    return True
+
+
+import_command.parser = subparsers.add_parser(
+    'import',
+    description="Imports events in bulk from CSV (with a header row) or JSON "
+                "lines, with fields summary, start, and optionally end or "
+                "duration (minutes) and description. Times without an offset "
+                "are in the configured timezone. Events get ids derived from "
+                "their contents, so re-importing the same rows skips them.")
+import_command.parser.add_argument(
+    'path',
+    nargs='?',
+    default='-',
+    help="File to import - default stdin."
+)
+import_command.parser.add_argument(
+    '-f',
+    '--format',
+    dest='input_format',
+    choices=importer.FORMATS,
+    default=None,
+    help="Input format - default guessed from the file name or contents."
+)
+import_command.parser.add_argument(
+    '-c',
+    '--calendar',
+    default=None,
+    help="Calendar (name in the config) to import into - default the one "
+         "events are added to."
+)
+import_command.parser.add_argument(
+    '-n',
+    '--dry-run',
+    action='store_true',
+    help="Only validate the input and report what would be imported."
+)
+import_command.parser.add_argument(
+    '--skip-invalid',
+    action='store_true',
+    help="Import the valid rows even if some are invalid."
+)
+import_command.parser.add_argument(
+    '-b',
+    '--batch-size',
+    type=int,
+    default=journal.BATCH_SIZE,
+    help="Number of events sent per batch request (max 50)."
+)
+import_command.parser.add_argument(
+    '-j',
+    '--concurrency',
+    type=int,
+    default=None,
+    help="Number of batch requests in flight at once - default the "
+         "'max_in_flight' API setting."
+)
+import_command.parser.set_defaults(func=import_command)
+
+
 def quicksearch_command(query):
     """Search query with Google, checking previous existing solutions to this
     E.g. lifelogger websearch How to do this
@@ -910,3 +918,171 @@ quicksearch_command.parser.add_argument(
 )
 
 quicksearch_command.parser.set_defaults(func=quicksearch_command)
+
+
+def sync_calendar(service, calendar_name, full=False):
+    """Bring the local events of a calendar up to date via the Calendar API,
+    fetching only what changed since the last sync (per its sync token)
+
+    :param service: Calendar service
+    :param calendar_name: Name of the calendar in the config
+    :param full: Ignore the sync token, re-fetching and reconciling all events
+    :return: Tuple of (changed, deleted) event counts
+    """
+    from ..cache import bump_generation
+    from ..database import (
+        API_EVENT_FIELDS, Event, check_schema, db, get_sync_token, import_events,
+        refresh_rollup, set_sync_token, store_api_events
+    )
+
+    check_schema()
+    calendar_id = config['calendars'][calendar_name]['id']
+    sync_token = None if full else get_sync_token(calendar_name)
+
+    listing = PagedList(
+        service.events().list,
+        fields=API_EVENT_FIELDS,
+        calendarId=calendar_id,
+        maxResults=MAX_PAGE_SIZE,
+        **({'syncToken': sync_token} if sync_token else {})
+    )
+
+    try:
+        if sync_token is None:
+            # Full sync - reconcile against everything stored
+            events_fields = [
+                Event.fields_from_api_event(calendar_name, e)
+                for e in listing if e.get('status') != 'cancelled'
+            ]
+            with db.atomic():
+                inserted, updated, deleted, days = import_events(calendar_name, events_fields)
+            refresh_rollup(days)
+            bump_generation()
+            changed = inserted + updated
+        else:
+            # Incremental sync - apply each page of changes as it comes
+            changed = deleted = 0
+            for page in listing.pages():
+                items = page.get('items', [])
+                store_api_events(calendar_name, items)
+                cancelled = sum(1 for e in items if e.get('status') == 'cancelled')
+                deleted += cancelled
+                changed += len(items) - cancelled
+    except HttpError as err:
+        if sync_token is not None and int(err.resp['status']) == 410:
+            print("Sync token for %s expired - doing a full sync" % calendar_name)
+            return sync_calendar(service, calendar_name, full=True)
+        raise
+
+    set_sync_token(calendar_name, listing.last_page['nextSyncToken'])
+    return changed, deleted
+
+
+def sync_command(calendars, full):
+    """Incrementally sync the local database with Google Calendar
+
+    :param calendars: Names of the calendars to sync - default all
+    :param full: Re-fetch everything instead of using the sync tokens
+    :return: True if successful
+    """
+    names = calendars or sorted(config['calendars'])
+    unknown = [name for name in names if name not in config['calendars']]
+    if unknown:
+        print("Error: calendars not in config: %s" % ', '.join(unknown))
+        return False
+
+    service = connect()
+    for name in names:
+        changed, deleted = sync_calendar(service, name, full=full)
+        print("%s: %d changed, %d deleted." % (name, changed, deleted))
+
+    return True
+
+
+sync_command.parser = subparsers.add_parser(
+    'sync',
+    description="Brings the local database up to date through the Calendar "
+                "API, fetching only the events changed since the last sync. "
+                "An alternative to download_all that needs no iCal url, and "
+                "costs bytes proportional to what changed.")
+sync_command.parser.add_argument(
+    'calendars',
+    nargs='*',
+    help="Names of the calendars to sync - default all in the config."
+)
+sync_command.parser.add_argument(
+    '--full',
+    action='store_true',
+    help="Ignore the stored sync tokens and re-fetch everything."
+)
+sync_command.parser.set_defaults(func=sync_command)
+
+
+def flush_command(batch_size, concurrency):
+    """Push the journal of queued events to Google Calendar
+
+    :param batch_size: Number of events sent per batch request
+    :param concurrency: Number of batch requests in flight at once
+    :return: True if nothing is left pending
+    """
+    pending = len(journal.pending())
+    if not pending:
+        print("Nothing to flush.")
+        return True
+
+    print("Flushing %d queued entries..." % pending)
+    remaining = journal.flush(connect, batch_size=batch_size, concurrency=concurrency)
+
+    if remaining is None:
+        print("Another lifelogger process is already flushing.")
+        return True
+    elif remaining:
+        print("%d entries still pending - they will be retried on the next flush." % remaining)
+        return False
+    else:
+        print("All flushed!")
+        return True
+
+
+flush_command.parser = subparsers.add_parser(
+    'flush',
+    description="Pushes the events queued by now, add, for and quickadd to "
+                "Google Calendar, in batches, retrying with backoff. Normally "
+                "run in the background straight after queueing, unless "
+                "'journal_autoflush' is false in the config.")
+flush_command.parser.add_argument(
+    '-b',
+    '--batch-size',
+    type=int,
+    default=journal.BATCH_SIZE,
+    help="Number of events sent per batch request (max 50)."
+)
+flush_command.parser.add_argument(
+    '-j',
+    '--concurrency',
+    type=int,
+    default=None,
+    help="Number of batch requests in flight at once - default the "
+         "'max_in_flight' API setting."
+)
+flush_command.parser.set_defaults(func=flush_command)
+
+
+def daemon_command():
+    """Run the lifelogger daemon in the foreground
+
+    :return: True once stopped
+    """
+    from ..daemon import serve
+    return serve()
+
+
+daemon_command.parser = subparsers.add_parser(
+    'daemon',
+    description="Runs a long-lived daemon that keeps the authorized Google "
+                "Calendar service, the local database and the config warm. "
+                "While it runs, the quick commands (now, add, for, quickadd, "
+                "list, csv, sql, stats) are forwarded to it over a Unix "
+                "socket instead of starting from scratch. Set "
+                "LIFELOGGER_NO_DAEMON=1 to bypass it.")
+daemon_command.parser.set_defaults(func=daemon_command)
@@ -4,12 +4,20 @@ All commands that create & use the local copies of the Google Calendar data.
 """
 from __future__ import absolute_import, print_function
 
+import errno
+import hashlib
+import json
+import os
+
 import requests
 
 from icalendar import Calendar
 from termcolor import colored
 
-from ..config import config, ICAL_PATH, ICS_PATH
+from .. import bulk, snapshots
+from ..cache import bump_generation, cached_output
+from ..config import config, write_atomically, ICAL_PATH, ICS_PATH, SNAPSHOT_PATH
+from ..profiling import phase
 from ..utils import nice_format
 
 from .parser import subparsers
@@ -17,9 +25,43 @@ import six
 from six.moves import input
 
 
-def download_all():
+def download_calendar(cal_name, ical_url, only_changed=False):
+    """
+    Downloads a calendar's iCal file into ICS_PATH, saving a snapshot of it.
+
+    :param only_changed: Leave the file as it is if its events are the same
+                         as in the previous snapshot
+    :return: (snapshot, whether the events changed), or None if the download
+             failed
+    """
+    print("Downloading private iCal file for %s..." % cal_name)
+    with phase('download'):
+        req = requests.get(ical_url)
+
+        if req.status_code != 200:
+            print("Could not fetch iCal url for %s - has it expired? " % cal_name)
+            print("Change config field")
+            print(ical_url)
+            return None
+        if not req.content:
+            # Importing that would delete every event of the calendar
+            print("Got an empty iCal file for %s - leaving the last download as it is" % cal_name)
+            return None
+
+    with phase('snapshot'):
+        snapshot = snapshots.store(cal_name, req.content)
+        previous = snapshots.previous_snapshot(snapshot)
+    # Exports differ by their DTSTAMPs alone if nothing changed
+    changed = previous is None or previous.root != snapshot.root
+
+    if changed or not only_changed:
+        write_atomically(os.path.join(ICS_PATH, "%s.ics" % cal_name), req.content)
+
+    print("Download successful! (snapshot {}, {:.1f} KB new)".format(snapshot.id, snapshot.stored / 1e3))
+    return snapshot, changed
 
-    import os
+
+def download_all():
 
     # if not name:
     #     # Download all calendars
@@ -27,23 +69,9 @@ def download_all():
     #         download()
 
     for cal_name, meta in config['calendars'].items():
-        print("Downloading private iCal file for %s..." % cal_name)
-        ical_url = meta['ical_url']
-        req = requests.get(ical_url, stream=True)
-
-        if req.status_code != 200:
-            print("Could not fetch iCal url for %s - has it expired? " % cal_name)
-            print("Change config field")
-            print(ical_url)
+        if download_calendar(cal_name, meta['ical_url']) is None:
             return False
 
-        ics_path = os.path.join(ICS_PATH, "%s.ics" % cal_name)
-        with open(ics_path, 'wb') as f:
-            for chunk in req.iter_content():
-                f.write(chunk)
-
-        print("Download successful!")
-
     make_db_all()
 
     return True
@@ -58,36 +86,60 @@ download_all.parser = subparsers.add_parser(
 download_all.parser.set_defaults(func=download_all)
 
 
+def import_calendar(cal_name):
+    """
+    Brings the database in line with a calendar's downloaded iCal file,
+    returning the days touched.
+    """
+    from ..database import db, import_ical_events
+
+    ics_path = os.path.join(ICS_PATH, "%s.ics" % cal_name)
+
+    with phase('read ical'), open(ics_path, 'rb') as f:
+        ical_data = f.read()
+
+    with phase('parse ical'):
+        ical_events = Calendar.from_ical(ical_data).walk("VEVENT")
+
+    with phase('import'), db.atomic():
+        inserted, updated, deleted, days = import_ical_events(cal_name, ical_events)
+
+    print("{}: {} new, {} changed, {} removed.".format(cal_name, inserted, updated, deleted))
+    return days
+
+
 def make_db_all():
-    from ..database import Event, db
-    import os
+    from datetime import timedelta
+    from ..database import (
+        Event, all_archives, db, ensure_schema, list_archives, prune_calendars, refresh_rollup
+    )
 
     print("Converting iCal files into sqlite database...")
 
-    try:
-        Event.drop_table()
-    except Exception:
-        pass
-
-    try:
-        Event.create_table()
-    except Exception:
-        pass
+    touched_days = set()
+    if ensure_schema():
+        print("(Database schema changed - rebuilding it from scratch)")
+        if any(not archive.is_current() for archive in all_archives()):
+            print("(Archived years are imported again too - run archive afterwards)")
+        # The rollup of the archives still current went with the tables
+        for archive in list_archives():
+            day = archive.start.date()
+            while day < archive.end.date():
+                touched_days.add(day)
+                day += timedelta(days=1)
 
     for cal_name in config['calendars']:
-        ics_path = os.path.join(ICS_PATH, "%s.ics" % cal_name)
+        touched_days.update(import_calendar(cal_name))
 
-        with open(ics_path, 'rb') as f:
-            ical_data = f.read()
+    with phase('import'), db.atomic():
+        touched_days.update(prune_calendars(config['calendars']))
 
-        cal = Calendar.from_ical(ical_data)
-
-        with db.atomic():
-            for event in cal.walk("VEVENT"):
-                Event.create_from_ical_event(cal_name, event)
+    with phase('rollup'):
+        refresh_rollup(touched_days)
+    bump_generation()
 
     print("Imported {} events.".format(
-        Event.select().count()
+        Event.select().count() + sum(archive.events for archive in list_archives())
     ))
 
     return True
@@ -96,12 +148,308 @@ def make_db_all():
 make_db_all.parser = subparsers.add_parser(
     'make_db_all',
     description="Parses all the downloaded iCal file into the local sqlite "
-                "database. Normally done when the download command is run, "
+                "database, only applying the events that changed since the "
+                "last import. Normally done when the download command is run, "
                 "but may need re-running on changes to lifelogger."
 )
 make_db_all.parser.set_defaults(func=make_db_all)
 
 
+def watch_command():
+    import signal
+    import sys
+    import time
+    import traceback
+    from .. import watch
+    from ..config import NOMIE_BACKUP_PATH
+    from ..database import check_schema, refresh_rollup
+    from ..utils import SchemaOutdated
+    from .google import sync_nomie
+
+    if not config['calendars']:
+        print("No calendars in the config file - nothing to watch")
+        return False
+
+    debounce, max_delay, min_poll, max_poll = watch.settings()
+    calendars = dict((os.path.normpath(os.path.join(ICS_PATH, "%s.ics" % name)), name)
+                     for name in config['calendars'])
+    nomie_path = os.path.normpath(NOMIE_BACKUP_PATH)
+
+    targets = set(calendars)
+
+    watcher = watch.open_watcher()
+    directories = [ICS_PATH]
+    if 'Nomie' in config['calendars'] and os.path.isdir(os.path.dirname(nomie_path)):
+        directories.append(os.path.dirname(nomie_path))
+        targets.add(nomie_path)
+    else:
+        print("(Not watching the Nomie backup - no Nomie calendar or no %s)" % os.path.dirname(nomie_path))
+    for directory in directories:
+        watcher.add_watch(directory)
+
+    def refresh(paths):
+        names = sorted(calendars[path] for path in paths if path in calendars)
+        if names:
+            try:
+                check_schema()
+            except SchemaOutdated:
+                make_db_all()  # Rebuilds it
+            else:
+                touched_days = set()
+                for name in names:
+                    touched_days.update(import_calendar(name))
+                with phase('rollup'):
+                    refresh_rollup(touched_days)
+                bump_generation()
+        if nomie_path in paths:
+            sync_nomie(download=False)
+
+    debouncer = watch.Debouncer(debounce, max_delay)
+    polls = watch.PollSchedule(sorted(config['calendars']), min_poll, max_poll, time.time())
+
+    # Stop cleanly on kill as well as on Ctrl-C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    print("Watching %s for changes (%s) - Ctrl-C to stop" % (
+        ', '.join(directories), 'inotify' if isinstance(watcher, watch.Inotify) else 'polling'))
+    try:
+        while True:
+            # There's always a calendar poll coming up
+            deadline = min(when for when in (debouncer.deadline(), polls.deadline()) if when is not None)
+            for path in watcher.read(deadline - time.time()):
+                # None if too many files changed to tell which
+                for target in (targets if path is None else [os.path.normpath(path)]):
+                    if target in targets:
+                        debouncer.add(target, time.time())
+
+            paths = debouncer.due(time.time())
+            if paths:
+                try:
+                    refresh(paths)
+                except Exception:
+                    traceback.print_exc()
+
+            for name in polls.due(time.time()):
+                try:
+                    result = download_calendar(name, config['calendars'][name]['ical_url'], only_changed=True)
+                except Exception:
+                    traceback.print_exc()
+                    result = None
+                changed = result is not None and result[1]
+                interval = polls.record(name, changed, time.time())
+                print("{}: {}, next download in {:.0f} min.".format(
+                    name, "changed" if changed else "unchanged", interval / 60))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+    return True
+
+
+watch_command.parser = subparsers.add_parser(
+    'watch',
+    description="Keeps the local database up to date until stopped: "
+                "downloads each calendar every so often - more often the "
+                "more often it changes - and imports whichever iCal file "
+                "changed, once writes to it settle. Also runs sync-nomie "
+                "when the Nomie backup changes. Configure it with the "
+                "'watch' field of the config file."
+)
+watch_command.parser.set_defaults(func=watch_command)
+
+
+def archive_command(restore, list_only):
+    from ..database import (
+        Event, archive_years, check_schema, closed_years, db, drop_stale_archives, list_archives,
+        restore_archive
+    )
+
+    check_schema()
+
+    if restore is not None:
+        archives = [archive for archive in list_archives()
+                    if archive.first_year <= restore <= archive.last_year]
+        if not archives:
+            print("No archive holds %d." % restore)
+            return False
+        with phase('restore'):
+            restore_archive(archives[0])
+        bump_generation()
+        print("Restored %s: %d events." % (archives[0].name, archives[0].events))
+    elif not list_only:
+        for archive in drop_stale_archives():
+            print("Dropped %s, archived by another version of lifelogger." % archive.name)
+        years = closed_years()
+        if years:
+            with phase('archive'):
+                archive_years(years)
+            with phase('vacuum'):
+                db.execute_sql('VACUUM')
+            bump_generation()
+            print("Archived %s." % ', '.join(str(year) for year in years))
+        else:
+            print("No closed years left to archive.")
+
+    for archive in list_archives():
+        print("{:<10} {:>8} events {:>10.1f} MB".format(
+            archive.name, archive.events, os.path.getsize(archive.path) / 1e6))
+    print("{:<10} {:>8} events {:>10.1f} MB".format(
+        'current', Event.select().count(), os.path.getsize(db.database) / 1e6))
+
+    return True
+
+
+archive_command.parser = subparsers.add_parser(
+    'archive',
+    description="Moves the events of closed years (before the current one) "
+                "out of the local database into read-only, compacted files "
+                "of a year each, so that imports and queries of recent "
+                "events don't wade through years of history. Queries still "
+                "see archived events, attaching only the years they need, "
+                "but imports leave them as they are - restore a year to "
+                "bring in changes to it, then archive it again."
+)
+archive_command.parser.add_argument(
+    '--restore',
+    type=int,
+    metavar='YEAR',
+    help="Move the events of the archive holding this year back into the "
+         "database."
+)
+archive_command.parser.add_argument(
+    '--list',
+    dest='list_only',
+    action='store_true',
+    help="Only list the archives."
+)
+archive_command.parser.set_defaults(func=archive_command)
+
+
+def snapshot_events(calendar_name, chunks):
+    """
+    Events of VEVENT chunks of a snapshot, by (uid, recurrence_id).
+    """
+    from icalendar import Event as ICalEvent
+    from ..database import Event
+
+    events = {}
+    for chunk in chunks:
+        fields = Event.fields_from_ical_event(calendar_name, ICalEvent.from_ical(chunk))
+        events[(fields['uid'], fields['recurrence_id'])] = Event(**fields)
+    return events
+
+
+def diff_snapshots(old, new):
+    removed, added = snapshots.diff(old, new)
+    old_events = snapshot_events(old.calendar, removed)
+    new_events = snapshot_events(new.calendar, added)
+
+    counts = {'added': 0, 'removed': 0, 'changed': 0}
+    keys = set(old_events) | set(new_events)
+    for key in sorted(keys, key=lambda key: (new_events.get(key) or old_events.get(key)).start):
+        if key in old_events:
+            print(colored('-', 'red'), old_events[key].display())
+        if key in new_events:
+            print(colored('+', 'green'), new_events[key].display())
+        if key not in new_events:
+            counts['removed'] += 1
+        elif key not in old_events:
+            counts['added'] += 1
+        else:
+            counts['changed'] += 1
+
+    print("{}: snapshot {} to {}: {added} added, {removed} removed, {changed} changed.".format(
+        new.calendar, old.id, new.id, **counts))
+
+
+def snapshots_command(calendar, diff, restore, output):
+    from ..cache import binary_stdout
+
+    if diff:
+        if len(diff) > 2:
+            print(colored("Error: give one or two snapshots to --diff", 'red'))
+            return False
+        found = [snapshots.get_snapshot(snapshot_id) for snapshot_id in diff]
+        if None in found:
+            print(colored("Error: no snapshot %d" % diff[found.index(None)], 'red'))
+            return False
+        if len(found) == 1:
+            found.insert(0, snapshots.previous_snapshot(found[0]))
+            if found[0] is None:
+                print("Snapshot %d is the first of %s." % (diff[0], found[1].calendar))
+                return False
+        old, new = found
+        if old.calendar != new.calendar:
+            print(colored("Error: snapshots of different calendars", 'red'))
+            return False
+        with phase('diff'):
+            diff_snapshots(old, new)
+        return True
+
+    if restore is not None:
+        snapshot = snapshots.get_snapshot(restore)
+        if snapshot is None:
+            print(colored("Error: no snapshot %d" % restore, 'red'))
+            return False
+        with phase('restore'):
+            data = snapshots.load(snapshot)
+        if output == '-':
+            binary_stdout().write(data)
+            return True
+        path = output or os.path.join(ICS_PATH, "%s.ics" % snapshot.calendar)
+        write_atomically(path, data)
+        print("Restored snapshot {} of {} ({}) to {}{}".format(
+            snapshot.id, snapshot.calendar, snapshot.taken, path,
+            "" if output else " - run make_db_all to import it."))
+        return True
+
+    found = snapshots.list_snapshots(calendar)
+    for snapshot in found:
+        print("{:>5}  {:<12} {}  {:>8} events {:>8.1f} MB {:>10.1f} KB new".format(
+            snapshot.id, snapshot.calendar, snapshot.taken, snapshot.events,
+            snapshot.size / 1e6, snapshot.stored / 1e3))
+    print("{} snapshots of {:.1f} MB, stored in {:.1f} MB.".format(
+        len(found), sum(snapshot.size for snapshot in found) / 1e6,
+        os.path.getsize(SNAPSHOT_PATH) / 1e6))
+
+    return True
+
+
+snapshots_command.parser = subparsers.add_parser(
+    'snapshots',
+    description="Lists the snapshots of the iCal files saved by each "
+                "download_all, restores or compares them. Snapshots only "
+                "store the events that changed since the previous ones, "
+                "compressed."
+)
+snapshots_command.parser.add_argument(
+    '-c', '--calendar',
+    help="Only list the snapshots of this calendar."
+)
+snapshots_command.parser.add_argument(
+    '--diff',
+    type=int,
+    nargs='+',
+    metavar='ID',
+    help="Show the events added, removed and changed from one snapshot to "
+         "another, or from the previous snapshot of its calendar if only "
+         "one is given."
+)
+snapshots_command.parser.add_argument(
+    '--restore',
+    type=int,
+    metavar='ID',
+    help="Write a snapshot back to its calendar's iCal file, for make_db_all "
+         "to import."
+)
+snapshots_command.parser.add_argument(
+    '-o', '--output',
+    help="Write the restored snapshot to this file instead, or - for stdout."
+)
+snapshots_command.parser.set_defaults(func=snapshots_command)
+
+
 def create_md_from_ical_event(calendar_name, ical_event):
     start = normalized(ical_event.get('dtstart').dt)
     end = ical_event.get('dtend')
@@ -122,47 +470,125 @@ def create_md_from_ical_event(calendar_name, ical_event):
     )
 
 
-def make_mdnotes_from_search():
-    import os
+NOTES_MANIFEST = '.lifelogger-notes.json'
+
+
+def note_hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def read_notes_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def note_unchanged(path, digest, known):
+    """
+    Whether the note at path already holds the contents with the given hash.
+    Trusts the manifest while the file looks as lifelogger left it, and
+    hashes the file otherwise (edited, or exported before there was one).
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+
+    if known is not None and known['hash'] == digest \
+            and [stat.st_size, stat.st_mtime] == [known['size'], known['mtime']]:
+        return True
+
+    with open(path, 'rb') as f:
+        return note_hash(f.read()) == digest
 
-    print("Converting search events in iCal file into md notes...")
 
-    # Create temporary folder for markdown notes
-    tmp_path = os.path.expanduser("~/tmp/search")
-    if not os.path.exists(tmp_path):
+def make_mdnotes_from_search(output, jobs):
+    from ..database import (
+        Event, attached_archives, check_schema, list_archives, select_with_descriptions,
+        unpack_description
+    )
+
+    print("Exporting search events in the database into md notes...")
+
+    output = os.path.expanduser(output)
+    if not os.path.exists(output):
         try:
-            os.makedirs(tmp_path)
+            os.makedirs(output)
         except OSError as exc:  # Guard against race condition
             if exc.errno != errno.EEXIST:
                 raise
 
-    for cal_name in ['lifelogger']:  # Read only from lifelogger
-        ics_path = os.path.join(ICS_PATH, "%s.ics" % cal_name)
-
-        with open(ics_path, 'rb') as f:
-            ical_data = f.read()
-
-        cal = Calendar.from_ical(ical_data)
-        for event in cal.walk("VEVENT"):
-            # Use original uid from Google (remove suffix)
-            uid = str(event.get('uid')).replace('@google.com', '.md')
-            # Remove tag from title
-            summary = str(event.get('summary'))
+    check_schema()
+    # LIKE narrows the scan down in SQLite, but ignores case
+    events = (
+        select_with_descriptions(Event.summary)
+        .where((Event.calendar == 'lifelogger') & Event.summary.contains('#search: '))
+        .order_by(Event.start)
+        .tuples()
+    )
+    notes = {}  # The latest event wins a title
+    with attached_archives(list_archives()):
+        for summary, data, compressed in events:
             if '#search: ' not in summary:
                 continue
+            # Remove tag from title
             title = summary.replace('#search: ', '') + '.md'
-            try:
-                with open(os.path.join(tmp_path, title), 'w') as f:
-                    f.write(event.get('description'))
-            except:
-                print(colored("ERROR: Saving %s" % title), 'red')
+            notes[title] = unpack_description(data, compressed).encode('utf-8')
 
-    return True
+    manifest_path = os.path.join(output, NOTES_MANIFEST)
+    manifest = read_notes_manifest(manifest_path)
+
+    def export(note):
+        title, data = note
+        path = os.path.join(output, title)
+        digest = note_hash(data)
+        try:
+            if note_unchanged(path, digest, manifest.get(title)):
+                result = 'skipped'
+            else:
+                write_atomically(path, data)
+                result = 'written'
+            stat = os.stat(path)
+        except (IOError, OSError) as exc:
+            return title, 'failed', exc
+        return title, result, {'hash': digest, 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    counts = {'written': 0, 'skipped': 0, 'failed': 0}
+    try:
+        for title, result, value in bulk.imap(export, sorted(notes.items()), jobs):
+            counts[result] += 1
+            if result == 'failed':
+                print(colored("ERROR: Saving %s: %s" % (title, value), 'red'))
+            else:
+                manifest[title] = value
+    finally:
+        write_atomically(manifest_path, json.dumps(manifest, sort_keys=True).encode('utf-8'))
+
+    print("Wrote %(written)d notes, skipped %(skipped)d unchanged" % counts
+          + (colored(", %(failed)d failed" % counts, 'red') if counts['failed'] else ''))
+    return counts['failed'] == 0
 
 
 make_mdnotes_from_search.parser = subparsers.add_parser(
     'make_mdnotes_from_search',
-    description="Parses all the downloaded iCal file into markdown notes. "
+    description="Exports the #search: events in the lifelogger calendar of "
+                "the local database into markdown notes, named after their "
+                "summary and holding their description. Only new and changed "
+                "notes are written, so run make_db_all or sync first to "
+                "bring the database up to date."
+)
+make_mdnotes_from_search.parser.add_argument(
+    '-o', '--output',
+    default="~/tmp/search",
+    help="Folder to write the notes to. Default ~/tmp/search."
+)
+make_mdnotes_from_search.parser.add_argument(
+    '-j', '--jobs',
+    type=int,
+    default=1,
+    help="Write this many notes at once. Default 1."
 )
 make_mdnotes_from_search.parser.set_defaults(func=make_mdnotes_from_search)
 
@@ -184,17 +610,18 @@ def download(reset=None):
         config['ical_url[Nomie]'] = ical_url
 
     print("Downloading private iCal file...")
-    req = requests.get(ical_url, stream=True)
+    with phase('download'):
+        req = requests.get(ical_url, stream=True)
 
-    if req.status_code != 200:
-        print("Could not fetch iCal url - has it expired? ")
-        print("To change, run download --reset")
-        print(ical_url)
-        return False
+        if req.status_code != 200:
+            print("Could not fetch iCal url - has it expired? ")
+            print("To change, run download --reset")
+            print(ical_url)
+            return False
 
-    with open(ICAL_PATH, 'wb') as f:
-        for chunk in req.iter_content():
-            f.write(chunk)
+        with open(ICAL_PATH, 'wb') as f:
+            for chunk in req.iter_content():
+                f.write(chunk)
 
     print("Download successful!")
 
@@ -225,10 +652,11 @@ def make_db():
 
     print("Converting iCal file into sqlite database...")
 
-    with open(ICAL_PATH, 'rb') as f:
+    with phase('read ical'), open(ICAL_PATH, 'rb') as f:
         ical_data = f.read()
 
-    cal = Calendar.from_ical(ical_data)
+    with phase('parse ical'):
+        cal = Calendar.from_ical(ical_data)
 
     try:
         Event.drop_table()
@@ -240,10 +668,12 @@ def make_db():
     except Exception:
         pass
 
-    with db.atomic():
+    with phase('import'), db.atomic():
         for event in cal.walk("VEVENT"):
             Event.create_from_ical_event(event)
 
+    bump_generation()
+
     print("Imported {} events.".format(
         Event.select().count()
     ))
@@ -262,10 +692,11 @@ make_db.parser.set_defaults(func=make_db)
 
 def shell():
     from datetime import datetime, date  # noqa
-    from ..database import Event, regexp, db  # noqa
+    from ..database import Event, regexp, db, attached_archives, list_archives  # noqa
 
     from IPython import embed
-    embed()
+    with attached_archives(list_archives()):
+        embed()
 
 
 shell.parser = subparsers.add_parser(
@@ -276,12 +707,37 @@ shell.parser = subparsers.add_parser(
 shell.parser.set_defaults(func=shell)
 
 
-def sql(statement, separator):
-    from ..database import conn
+def is_read_only(statement, **kwargs):
+    words = ' '.join(statement).split(None, 1)
+    return bool(words) and words[0].lower() in ('select', 'with', 'explain', 'values')
+
+
+@cached_output(cacheable=is_read_only)
+def sql(statement, separator, explain, timeout):
+    from ..database import attached_archives, db, list_archives, query_plan, query_timeout
+    read_only = is_read_only(statement)
     statement = ' '.join(statement)
+    # Reads see the archived events too, writes only change the database's
+    archives = list_archives() if read_only else []
+
+    if explain:
+        with attached_archives(archives):
+            print('\n'.join(query_plan(statement)))
+        return True
+
+    with attached_archives(archives), query_timeout(timeout):
+        with phase('query'):
+            cursor = db.execute_sql(statement)
+
+        if not read_only:
+            bump_generation()
 
-    cursor = conn.cursor()
-    cursor.execute(statement)
+        if cursor.description is None:
+            # Statement returns no rows
+            return True
+
+        with phase('query'):
+            rows = cursor.fetchall()
 
     separator = {
         'comma': ',',
@@ -293,8 +749,11 @@ def sql(statement, separator):
     print(separator.join([d[0] for d in cursor.description]))
 
     # Data
-    for row in cursor.fetchall():
-        print(separator.join([str(v) for v in row]))
+    with phase('output'):
+        for row in rows:
+            print(separator.join([str(v) for v in row]))
+
+    return True
 
 
 sql.parser = subparsers.add_parser(
@@ -317,38 +776,150 @@ sql.parser.add_argument(
     choices=['comma', 'semicolon', 'tab'],
     help="Separator for the output - default comma."
 )
+sql.parser.add_argument(
+    '--no-cache',
+    action='store_true',
+    help="Bypass the cache of query results."
+)
+sql.parser.add_argument(
+    '--explain',
+    action='store_true',
+    help="Show SQLite's plan for the query instead of running it."
+)
+sql.parser.add_argument(
+    '--timeout',
+    type=float,
+    metavar='SECONDS',
+    help="Abort the query if it runs for longer than this."
+)
 sql.parser.set_defaults(func=sql)
 
 
-def list_command(filter_re):
-    filter_re = ' '.join(filter_re)
-    from ..database import Event, regexp
+def select_events(filter_re, query_text):
+    """
+    The events matching a regex on their summary and/or a query (see
+    query.py), or None after reporting a bad query.
+    """
+    from ..database import Event, regex_search
+    from ..query import QuerySyntaxError, compile_query
+
+    conditions = []
+    if filter_re:
+        conditions.append(regex_search('summary', ' '.join(filter_re)))
+        # conditions.append(regex_search('description', ' '.join(filter_re)))
+    try:
+        if query_text:
+            conditions.append(compile_query(query_text))
+    except QuerySyntaxError as exc:
+        print(colored("Error: bad query: %s" % exc, 'red'))
+        return None
+    if not conditions:
+        print(colored("Error: give a regex or a --query", 'red'))
+        return None
+    return Event.select().where(*conditions)
+
+
+def events_archives(query_text):
+    """
+    The archives to attach for select_events() - those of the years its
+    query is limited to, or all.
+    """
+    from ..database import archives_between
+    from ..query import query_span
+
+    return archives_between(*query_span(query_text)) if query_text else archives_between()
+
+
+def explain_events(query):
+    from ..database import attached, partition, partitions, query_plan
+
+    sql, params = query.sql()
+    print(sql)
+    print(params)
+    if not attached:
+        print('\n'.join(query_plan(sql, params)))
+        return
+    # Run on each partition in turn - see select_by_partition()
+    for schema in partitions():
+        with partition(schema):
+            print("-- %s" % schema)
+            print('\n'.join(query_plan(sql, params)))
+
+
+@cached_output()
+def list_command(filter_re, query, explain, timeout, jobs):
+    from .. import parallel
+    from ..database import attached_archives, load_descriptions, query_timeout, select_by_partition
+
+    events_query = select_events(filter_re, query)
+    if events_query is None:
+        return False
 
-    events = Event.select().where(regexp(Event.summary, filter_re))
-    # events = Event.select().where(regexp(Event.description, filter_re))
+    with attached_archives(events_archives(query)):
+        if explain:
+            explain_events(events_query)
+            return True
 
-    for event in events:
-        print(event.display()+'\n')
+        with query_timeout(timeout), phase('query'):
+            events = (parallel.select(events_query, jobs, timeout) if jobs > 1
+                      else select_by_partition(events_query, descriptions=True))
+            load_descriptions(events)
+
+    with phase('output'):
+        for event in events:
+            print(event.display()+'\n')
 
     return True
 
 
 list_command.parser = subparsers.add_parser(
     'list',
-    description="Lists the events that match a given regex."
+    description="Lists the events that match a given regex or query."
 )
 list_command.parser.add_argument(
     'filter_re',
-    nargs="+",
+    nargs="*",
     type=six.text_type,
     help="The regex to filter events by."
 )
+list_command.parser.add_argument(
+    '-q',
+    '--query',
+    type=six.text_type,
+    help="Filter events by a query instead of (or as well as) a regex, e.g. "
+         "'#exercise and not #cont in:2018-03' or '#weight kg > 80' - see "
+         "lifelogger/query.py for the syntax. Unlike regexes, most queries "
+         "are answered from indexes."
+)
+list_command.parser.add_argument(
+    '--no-cache',
+    action='store_true',
+    help="Bypass the cache of query results."
+)
+list_command.parser.add_argument(
+    '--explain',
+    action='store_true',
+    help="Show SQLite's plan for the query instead of running it."
+)
+list_command.parser.add_argument(
+    '--timeout',
+    type=float,
+    metavar='SECONDS',
+    help="Abort the query if it runs for longer than this."
+)
+list_command.parser.add_argument(
+    '-j', '--jobs',
+    type=int,
+    default=1,
+    help="Scan the events on this many processes at once - worth it on "
+         "large calendars for regexes that still have to check every event, "
+         "e.g. '[0-9.]+kg'. Default 1."
+)
 list_command.parser.set_defaults(func=list_command)
 
 
-def csv(filter_re, separator, varnames):
-    filter_re = ' '.join(filter_re)
-
+@cached_output()
+def csv(filter_re, query, separator, varnames, explain, timeout, jobs):
     varnames = varnames.split(',')
 
     separator = {
@@ -357,18 +928,35 @@ def csv(filter_re, separator, varnames):
         'tab': '\t',
     }[separator]
 
-    from ..database import Event, regexp
+    from .. import parallel
+    from ..database import attached_archives, load_descriptions, query_timeout, select_by_partition
+
+    events_query = select_events(filter_re, query)
+    if events_query is None:
+        return False
 
-    events = Event.select().where(regexp(Event.summary, filter_re))
+    with attached_archives(events_archives(query)):
+        if explain:
+            explain_events(events_query)
+            return True
+
+        with query_timeout(timeout), phase('query'):
+            events = (parallel.select(events_query, jobs, timeout) if jobs > 1
+                      else select_by_partition(events_query, descriptions='description' in varnames))
+            if 'description' in varnames:
+                load_descriptions(events)
 
     # Header
     print(separator.join(varnames))
 
     # Data
-    for event in events:
-        print(separator.join([
-            nice_format(event.get_var(varname)) for varname in varnames
-        ]))
+    with phase('output'):
+        for event in events:
+            print(separator.join([
+                nice_format(event.get_var(varname)) for varname in varnames
+            ]))
+
+    return True
 
 
 csv.parser = subparsers.add_parser(
@@ -398,8 +986,213 @@ csv.parser.add_argument(
 )
 csv.parser.add_argument(
     'filter_re',
-    nargs="+",
+    nargs="*",
     type=six.text_type,
     help="The regex to filter events by."
 )
+csv.parser.add_argument(
+    '-q',
+    '--query',
+    type=six.text_type,
+    help="Filter events by a query instead of (or as well as) a regex, e.g. "
+         "'#exercise and not #cont in:2018-03' or '#weight kg > 80' - see "
+         "lifelogger/query.py for the syntax. Unlike regexes, most queries "
+         "are answered from indexes."
+)
+csv.parser.add_argument(
+    '--no-cache',
+    action='store_true',
+    help="Bypass the cache of query results."
+)
+csv.parser.add_argument(
+    '--explain',
+    action='store_true',
+    help="Show SQLite's plan for the query instead of running it."
+)
+csv.parser.add_argument(
+    '--timeout',
+    type=float,
+    metavar='SECONDS',
+    help="Abort the query if it runs for longer than this."
+)
+csv.parser.add_argument(
+    '-j', '--jobs',
+    type=int,
+    default=1,
+    help="Scan the events on this many processes at once - worth it on "
+         "large calendars for regexes that still have to check every event, "
+         "e.g. '[0-9.]+kg'. Default 1."
+)
 csv.parser.set_defaults(func=csv)
+
+
+@cached_output()
+def stats(tags, period, since, until, calendar, separator, explain, timeout):
+    import dateutil.parser
+    from peewee import OperationalError, fn
+    from ..database import DailyRollup, query_plan, query_timeout
+
+    formats = {
+        'day': '%Y-%m-%d',
+        'week': '%Y-W%W',
+        'month': '%Y-%m',
+        'year': '%Y',
+    }
+
+    separator = {
+        'comma': ',',
+        'semicolon': ';',
+        'tab': '\t',
+    }[separator]
+
+    period_col = fn.strftime(formats[period], DailyRollup.day)
+    query = (DailyRollup
+             .select(
+                 period_col,
+                 DailyRollup.tag,
+                 fn.SUM(DailyRollup.count),
+                 fn.SUM(DailyRollup.total_seconds),
+                 fn.SUM(DailyRollup.kg_sum),
+                 fn.SUM(DailyRollup.mg_sum),
+                 fn.SUM(DailyRollup.percentage_sum),
+             )
+             .group_by(period_col, DailyRollup.tag)
+             .order_by(period_col, DailyRollup.tag))
+
+    if tags:
+        # '' stands for the untagged events
+        tags = [('#' + tag.lstrip('#').lower()) if tag else '' for tag in tags]
+        query = query.where(DailyRollup.tag << tags)
+    if since:
+        query = query.where(DailyRollup.day >= dateutil.parser.parse(since).date())
+    if until:
+        query = query.where(DailyRollup.day <= dateutil.parser.parse(until).date())
+    if calendar:
+        query = query.where(DailyRollup.calendar == calendar)
+
+    try:
+        if explain:
+            print('\n'.join(query_plan(*query.sql())))
+            return True
+
+        with query_timeout(timeout), phase('query'):
+            rows = list(query.tuples())
+    except OperationalError:
+        print("No daily rollup in the local database - run make_db_all first.")
+        return False
+
+    # Header
+    print(separator.join([
+        period, 'tag', 'count', 'total_seconds', 'kg_sum', 'mg_sum', 'percentage_sum'
+    ]))
+
+    # Data
+    with phase('output'):
+        for row in rows:
+            print(separator.join([nice_format(v) for v in row]))
+
+    return True
+
+
+stats.parser = subparsers.add_parser(
+    'stats',
+    description="Outputs per-tag totals (event count, total duration and "
+                "measurement sums) for each day, week, month or year, as csv. "
+                "Read from the daily rollup maintained on import, so it stays "
+                "fast on years of history."
+)
+stats.parser.add_argument(
+    'tags',
+    nargs="*",
+    type=six.text_type,
+    help="The tags to report, e.g. '#exercise' - default all. Use '' for "
+         "untagged events."
+)
+stats.parser.add_argument(
+    '-p',
+    '--period',
+    default="month",
+    choices=['day', 'week', 'month', 'year'],
+    help="The period to total over - default month."
+)
+stats.parser.add_argument(
+    '--since',
+    default=None,
+    help="Only include days from this date on."
+)
+stats.parser.add_argument(
+    '--until',
+    default=None,
+    help="Only include days up to this date."
+)
+stats.parser.add_argument(
+    '-c',
+    '--calendar',
+    default=None,
+    help="Only include events from this calendar - default all."
+)
+stats.parser.add_argument(
+    '-s',
+    '--separator',
+    nargs="?",
+    type=six.text_type,
+    default="comma",
+    choices=['comma', 'semicolon', 'tab'],
+    help="Separator for the output - default comma."
+)
+stats.parser.add_argument(
+    '--no-cache',
+    action='store_true',
+    help="Bypass the cache of query results."
+)
+stats.parser.add_argument(
+    '--explain',
+    action='store_true',
+    help="Show SQLite's plan for the query instead of running it."
+)
+stats.parser.add_argument(
+    '--timeout',
+    type=float,
+    metavar='SECONDS',
+    help="Abort the query if it runs for longer than this."
+)
+stats.parser.set_defaults(func=stats)
+
+
+def cache_command(clear):
+    from .. import cache
+
+    if clear:
+        cache.clear()
+        print("Cache cleared.")
+        return True
+
+    enabled, max_entries, max_bytes = cache.settings()
+    stats = cache.read_stats()
+    entries = cache.entries()
+
+    lookups = stats['hits'] + stats['misses']
+    print("Enabled:    {}".format(enabled))
+    print("Generation: {}".format(cache.generation()))
+    print("Entries:    {} / {}".format(len(entries), max_entries))
+    print("Size:       {} / {} bytes".format(sum(size for _, size, _ in entries), max_bytes))
+    print("Hits:       {}".format(stats['hits']))
+    print("Misses:     {}".format(stats['misses']))
+    if lookups:
+        print("Hit rate:   {:.1%}".format(stats['hits'] / float(lookups)))
+
+    return True
+
+
+cache_command.parser = subparsers.add_parser(
+    'cache',
+    description="Shows the hit/miss counters and size of the cache of query "
+                "results (list, csv, sql, stats). Configure it with the "
+                "'cache' field of the config file."
+)
+cache_command.parser.add_argument(
+    '--clear',
+    action='store_true',
+    help="Remove all cached results and reset the counters."
+)
+cache_command.parser.set_defaults(func=cache_command)
@@ -3,6 +3,8 @@ from __future__ import absolute_import
 
 import argparse
 
+from ..config import PROFILE_PATH
+
 description = """
 lifelogger: Track your life like a pro on Google Calendar via your terminal.
 
@@ -22,4 +24,31 @@ parser = argparse.ArgumentParser(
     epilog="Enjoy! Adam, Jesus"
 )
 
+parser.add_argument(
+    '-v', '--verbose',
+    action='count',
+    default=0,
+    help="Log details such as API pages and bytes fetched, and totals of the "
+         "SQL run, to stderr. Give it twice to also log every SQL statement."
+)
+parser.add_argument(
+    '--profile',
+    action='store_true',
+    help="Report the wall time, CPU time and peak memory of each phase of "
+         "the command (downloading, parsing, importing, querying, output...) "
+         "on stderr, and save them as JSON. Tracing memory slows it down."
+)
+parser.add_argument(
+    '--profile-output',
+    metavar='JSON',
+    default=PROFILE_PATH,
+    help="Where --profile saves its JSON - default %s" % PROFILE_PATH
+)
+parser.add_argument(
+    '--cprofile',
+    metavar='FILE',
+    help="Also dump cProfile stats of the command to FILE, for pstats or "
+         "snakeviz. Implies --profile."
+)
+
 subparsers = parser.add_subparsers()
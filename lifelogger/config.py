@@ -1,8 +1,12 @@
 # coding=utf-8
 from __future__ import absolute_import, print_function
 
+import copy
+import errno
 import json
 import os
+import tempfile
+from contextlib import contextmanager
 
 from collections import MutableMapping
 
@@ -12,6 +16,11 @@ ICS_PATH = os.path.join(DATA_PATH, "ics")
 CONFIG_PATH = os.path.join(DATA_PATH, "config.json")
 ICAL_PATH = os.path.join(DATA_PATH, "calendar.ics")
 DB_PATH = os.path.join(DATA_PATH, "calendar.sqlite")
+ARCHIVE_PATH = os.path.join(DATA_PATH, "archive")
+SNAPSHOT_PATH = os.path.join(DATA_PATH, "snapshots.sqlite")
+CACHE_PATH = os.path.join(DATA_PATH, "cache")
+GENERATION_PATH = os.path.join(DATA_PATH, "generation")
+PROFILE_PATH = os.path.join(DATA_PATH, "profile.json")
 
 # Setup paths for Nomie
 NOMIE_PATH = os.path.expanduser("~/Dropbox/Apps/Nomie/")
@@ -42,63 +51,212 @@ if not os.path.exists(ICS_PATH):
         if exc.errno != errno.EEXIST:
             raise
 
+# Ensure subfolder for archived years exists
+if not os.path.exists(ARCHIVE_PATH):
+    try:
+        os.makedirs(ARCHIVE_PATH)
+    except OSError as exc:  # Guard against race condition
+        if exc.errno != errno.EEXIST:
+            raise
+
+# Ensure subfolder for cached query results exists
+if not os.path.exists(CACHE_PATH):
+    try:
+        os.makedirs(CACHE_PATH)
+    except OSError as exc:  # Guard against race condition
+        if exc.errno != errno.EEXIST:
+            raise
+
+
+def write_atomically(path, data, durable=False):
+    """
+    Writes data to path via a temporary file and a rename, so readers never
+    see a partially written file.
+
+    :param durable: fsync before renaming, so a crash leaves either the old
+                    or the new contents - never an empty file
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+class TrackedDict(MutableMapping):
+    """
+    View of a dict nested in the config, telling it about mutations so they
+    get saved like top level ones.
+    """
+
+    def __init__(self, data, root):
+        self._data = data
+        self._root = root
+
+    def __getitem__(self, key):
+        return self._root._wrap(self._data[key])
+
+    def __setitem__(self, key, value):
+        self._data[key] = unwrap(value)
+        self._root._changed()
+
+    def __delitem__(self, key):
+        del self._data[key]
+        self._root._changed()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __repr__(self):
+        return repr(self._data)
+
+
+def unwrap(value):
+    return value._data if isinstance(value, TrackedDict) else value
+
 
 class ConfigDict(MutableMapping):
+    """
+    The config file as a dict. Mutations - nested ones included - are saved
+    straight away, or once at the end of a batch():
+
+        with config.batch():
+            config['calendars']['Nomie']['id'] = calendar_id
+            config['timezone'] = timezone
+
+    The file is only parsed again if it changed on disk.
+    """
 
     def __init__(self, path):
         self._path = path
         self._loaded = False
         self._data = {}
+        self._stat_key = None  # Identifies the version of the file loaded
+        self._batch_depth = 0
+        self._dirty = False
+
+    def _file_stat_key(self):
+        try:
+            st = os.stat(self._path)
+        except OSError:
+            return None
+        # Saves replace the file, so the inode changes even within the
+        # mtime's resolution
+        return (st.st_ino, st.st_mtime, st.st_size)
 
     def _load(self):
+        stat_key = self._file_stat_key()
+        if self._loaded and (stat_key == self._stat_key or self._dirty):
+            return
+
+        data = {}
         try:
             with open(self._path) as cfile:
-                self._data.update(json.load(cfile))
+                data = json.load(cfile)
         except IOError:
             print("(Config file {} missing - creating afresh)".format(self._path))
         except ValueError:
             raise ValueError("Config file {} corrupt!".format(self._path))
 
+        self._data = data
+        self._stat_key = stat_key
         self._loaded = True
 
     def _save(self):
-        if not os.path.exists(DATA_PATH):
-            os.makedirs(DATA_PATH)
+        folder = os.path.dirname(self._path)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        write_atomically(self._path, json.dumps(self._data, indent=2).encode('utf-8'), durable=True)
+        self._stat_key = self._file_stat_key()
+        self._dirty = False
 
-        with open(CONFIG_PATH, 'w') as cfile:
-            cfile.write(json.dumps(self._data, indent=2))
+    def _changed(self):
+        if self._batch_depth:
+            self._dirty = True
+        else:
+            self._save()
+
+    def _wrap(self, value):
+        return TrackedDict(value, self) if isinstance(value, dict) else value
 
     def save(self):
         """Force save manually
         """
         self._save()
 
-    def __getitem__(self, key):
-        if not self._loaded:
+    def reload(self):
+        """Drop the loaded values, so they are re-read on next access
+        """
+        self._data = {}
+        self._loaded = False
+        self._dirty = False
+
+    @contextmanager
+    def batch(self):
+        """Coalesce the mutations made inside into a single write at the end.
+        If an exception escapes, they are all dropped instead.
+        """
+        if not self._batch_depth:
             self._load()
-        return self._data[key]
+            snapshot = copy.deepcopy(self._data)
+        self._batch_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                self._data = snapshot
+                self._dirty = False
+            raise
+        else:
+            self._batch_depth -= 1
+            if not self._batch_depth and self._dirty:
+                self._save()
+
+    def __getitem__(self, key):
+        self._load()
+        return self._wrap(self._data[key])
 
     def __setitem__(self, key, value):
-        if not self._loaded:
-            self._load()
+        self._load()
 
-        self._data[key] = value
+        self._data[key] = unwrap(value)
 
-        self._save()
+        self._changed()
 
     def __delitem__(self, key):
-        if not self._loaded:
-            self._load()
+        self._load()
 
         del self._data[key]
 
-        self._save()
+        self._changed()
 
     def __len__(self):
+        self._load()
         return len(self._data)
 
     def __iter__(self):
+        self._load()
         return iter(self._data)
 
 
 config = ConfigDict(CONFIG_PATH)
+
+
+def calendar_name(calendar_id):
+    """Name of the configured calendar with the given id, or None
+    """
+    for name, meta in config.get('calendars', {}).items():
+        if meta.get('id') == calendar_id:
+            return name
+    return None
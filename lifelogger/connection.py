@@ -4,15 +4,23 @@ Handles connecting to Google API and authenticating.
 """
 from __future__ import absolute_import
 import argparse
+import functools
 import httplib2
+import json
+import logging
 import os
 import sys
+from datetime import datetime, timedelta
 
 from apiclient import discovery as apc_discovery
+from apiclient.http import HttpRequest
 from oauth2client import file as oa2c_file
 from oauth2client import client as oa2c_client
 from oauth2client import tools as oa2c_tools
 
+from .scheduler import DEFAULT_MAX_IN_FLIGHT
+from .transport import DEFAULT_TIMEOUT, PooledHttp
+
 CLIENT_SECRETS_PATH = os.path.join(
     os.path.abspath(os.path.dirname(__file__)),
     'client_secrets.json'
@@ -35,14 +43,72 @@ FLOW = oa2c_client.flow_from_clientsecrets(
     message="Error - client_secrets.json file missing."
 )
 
+log = logging.getLogger(__name__)
+
+# Largest page size the Calendar API allows for events
+MAX_PAGE_SIZE = 2500
+
+
+class ScheduledRequest(HttpRequest):
+    """API request paced and retried by the request scheduler (see
+    scheduler.py)
+    """
+
+    def idempotent(self):
+        """Whether the request is safe to repeat - all but POSTs creating
+        something under an id the server picks, like events().insert()
+        without an "id" or events().quickAdd()
+        """
+        if self.method != 'POST':
+            return True
+        if self.uri.split('?')[0].endswith('/import'):  # Matched by iCalUID
+            return True
+        try:
+            body = json.loads(self.body or '{}')
+        except (TypeError, ValueError):
+            return False
+        return isinstance(body, dict) and 'id' in body
+
+    def execute(self, http=None, num_retries=0):
+        from . import scheduler
+
+        return scheduler.get().call(
+            functools.partial(HttpRequest.execute, self, http=http, num_retries=num_retries),
+            idempotent=self.idempotent()
+        )
+
+
+# The service and credentials, kept once connected so long-running processes
+# (e.g. the daemon) reuse them
+_service = None
+_credentials = None
+
+
+def credentials_stored():
+    """Whether lifelogger has been authorized with Google already
+
+    Returns: bool
+    """
+    from .config import DATA_PATH
+
+    return os.path.exists(os.path.join(DATA_PATH, 'google_auth.json'))
+
+
+def connected():
+    return _service is not None
+
 
 def connect():
     """Connect to Google Calendar API
 
     Returns: service
     """
+    global _service, _credentials
     from .config import config, DATA_PATH
 
+    if _service is not None:
+        return _service
+
     flags = parser.parse_args([])
 
     # If the credentials don't exist or are invalid run through the native client
@@ -53,14 +119,19 @@ def connect():
     if credentials is None or credentials.invalid:
         credentials = oa2c_tools.run_flow(FLOW, storage, flags)
 
-    # Create an httplib2.Http object to handle our HTTP requests and authorize it
-    # with our good Credentials.
-    http = httplib2.Http()
+    # Create a pool of keep-alive httplib2.Http objects to handle our HTTP
+    # requests, shareable between threads, and authorize it with our good
+    # Credentials.
+    api_settings = config.get('api', {})
+    http = PooledHttp(
+        size=api_settings.get('max_in_flight', DEFAULT_MAX_IN_FLIGHT),
+        timeout=api_settings.get('timeout', DEFAULT_TIMEOUT),
+    )
     http = credentials.authorize(http)
 
     # Construct the service object for the interacting with the Calendar API.
     try:
-        service = apc_discovery.build('calendar', 'v3', http=http)
+        service = apc_discovery.build('calendar', 'v3', http=http, requestBuilder=ScheduledRequest)
     except httplib2.ServerNotFoundError:
         sys.stderr.write("Error: server not found - are you connected to the internet?\n")
         sys.exit()
@@ -79,4 +150,92 @@ def connect():
         settings = dict([(item['id'], item['value']) for item in settings])
         config['timezone'] = settings.get('timezone', "Europe/London")
 
+    _service = service
+    _credentials = credentials
     return service
+
+
+def refresh_token(margin=timedelta(minutes=5)):
+    """Refresh the access token of the connected service ahead of its expiry
+
+    :param margin: How long before expiry to refresh
+    :return: True if the token was refreshed
+    """
+    if _credentials is None:
+        return False
+
+    expiry = _credentials.token_expiry  # naive UTC
+    if expiry is not None and expiry - datetime.utcnow() > margin:
+        return False
+
+    _credentials.refresh(httplib2.Http())
+    return True
+
+
+class PagedList(object):
+    """Lazily iterate over every item of a Calendar API list call, following
+    nextPageToken, e.g.
+
+        listing = PagedList(service.events().list, fields='summary,start',
+                            calendarId=calendar_id)
+        for event in listing:
+            ...
+        sync_token = listing.last_page.get('nextSyncToken')
+
+    Only the given item fields are requested (partial response), and the
+    responses are asked for gzipped. The number of pages and bytes fetched
+    are logged once the listing is exhausted.
+    """
+
+    def __init__(self, method, fields=None, **kwargs):
+        """
+        :param method: List method, e.g. service.events().list
+        :param fields: Comma separated item fields to fetch - default all
+        :param kwargs: Arguments to the list method
+        """
+        self.method = method
+        self.kwargs = kwargs
+        if fields is not None:
+            # The page level fields are always needed to keep on paging
+            self.kwargs['fields'] = 'nextPageToken,nextSyncToken,items(%s)' % fields
+        self.pages_fetched = 0
+        self.bytes_fetched = 0
+        self.last_page = None
+
+    def fetch(self, page_token):
+        request = self.method(pageToken=page_token, **self.kwargs)
+
+        # Google only gzips responses for user agents that mention it
+        request.headers['accept-encoding'] = 'gzip'
+        request.headers['user-agent'] = request.headers.get('user-agent', 'lifelogger') + ' (gzip)'
+
+        postproc = request.postproc
+
+        def counting_postproc(resp, content):
+            # Decoded size, as httplib2 has gunzipped it by now
+            self.bytes_fetched += len(content)
+            return postproc(resp, content)
+
+        request.postproc = counting_postproc
+        page = request.execute()
+        self.pages_fetched += 1
+        self.last_page = page
+        return page
+
+    def pages(self):
+        """Yield each page of results as it is fetched
+        """
+        page_token = None
+        while True:
+            page = self.fetch(page_token)
+            yield page
+            page_token = page.get('nextPageToken')
+            if not page_token:
+                break
+        log.info("Listed %d pages, %d bytes (%s fields)",
+                 self.pages_fetched, self.bytes_fetched, 'selected' if 'fields' in self.kwargs else 'all')
+
+    def __iter__(self):
+        for page in self.pages():
+            for item in page.get('items', []):
+                yield item
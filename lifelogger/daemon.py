@@ -0,0 +1,230 @@
+# coding=utf-8
+"""
+Optional long-running daemon that keeps the authorized Calendar service, the
+SQLite connection and the config in memory, plus the thin client that
+forwards CLI commands to it over a Unix socket. It also pushes the journal of
+queued events (see journal.py) as they come in, and keeps the recent events
+cache (see recent.py) fresh.
+
+The client side only needs the standard library, so forwarding a command
+skips importing googleapiclient, peewee and friends altogether.
+
+Wire protocol: the client sends one JSON line {"argv": [...], "isatty": [...]},
+the latter telling whether its stdout and stderr are terminals, and the daemon
+answers with frames of a 1-byte kind and a 4-byte big-endian length - 'O'
+(stdout) and 'E' (stderr) frames carry output, and a final 'X' frame carries
+the exit status in place of the length.
+"""
+from __future__ import absolute_import, print_function
+
+import json
+import os
+import socket
+import struct
+import sys
+from contextlib import closing
+
+from .config import DATA_PATH
+
+SOCKET_PATH = os.path.join(DATA_PATH, "daemon.sock")
+
+# Commands that make sense to run inside the daemon - quick, non-interactive
+FORWARDED_COMMANDS = ('now', 'add', 'for', 'quickadd', 'list', 'csv', 'sql', 'stats')
+
+# How often the daemon refreshes the access token if needed, and retries
+# flushing the journal
+TICK_INTERVAL = 60
+
+FRAME_HEADER = struct.Struct('!cI')
+
+
+def forwardable(argv):
+    return (
+        bool(argv) and
+        argv[0] in FORWARDED_COMMANDS and
+        not os.environ.get('LIFELOGGER_NO_DAEMON') and
+        os.path.exists(SOCKET_PATH)
+    )
+
+
+def forward(argv):
+    """Run a command on the daemon, streaming back its output
+
+    :param argv: Command line arguments, without the program name
+    :return: The command's exit status, or None if no daemon is listening
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(SOCKET_PATH)
+    except socket.error:
+        sock.close()
+        return None
+
+    streams = {
+        b'O': getattr(sys.stdout, 'buffer', sys.stdout),
+        b'E': getattr(sys.stderr, 'buffer', sys.stderr),
+    }
+
+    with closing(sock):
+        request = {'argv': argv, 'isatty': [sys.stdout.isatty(), sys.stderr.isatty()]}
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        rfile = sock.makefile('rb')
+        while True:
+            header = rfile.read(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                sys.stderr.write("Error: lifelogger daemon hung up\n")
+                return 1
+
+            kind, length = FRAME_HEADER.unpack(header)
+            if kind == b'X':
+                return length
+
+            stream = streams[kind]
+            stream.write(rfile.read(length))
+            stream.flush()
+
+
+class FrameWriter(object):
+    """
+    File-like object standing in for stdout/stderr inside the daemon, sending
+    everything written to the client as frames. It's a terminal if the
+    client's stream is.
+    """
+
+    def __init__(self, wfile, kind, tty=False):
+        self.wfile = wfile
+        self.kind = kind
+        self.tty = tty
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        if data:
+            self.wfile.write(FRAME_HEADER.pack(self.kind, len(data)) + data)
+
+    def flush(self):
+        self.wfile.flush()
+
+    def isatty(self):
+        return self.tty
+
+
+def serve():
+    """Run the daemon in the foreground until interrupted
+    """
+    import signal
+    import time
+    import traceback
+    from six.moves import socketserver
+
+    from . import journal, recent
+    from .__main__ import run
+    from .connection import connect, refresh_token
+    from . import database  # noqa - opens the SQLite connection
+
+    # Everything runs on the main thread, one request at a time: commands
+    # swap sys.stdout and share its SQLite connection. The config picks up
+    # changes to its file by itself.
+
+    def flush_journal():
+        # A single attempt, so an outage doesn't stall the daemon - whatever
+        # is left gets retried on the next tick
+        try:
+            journal.flush(connect, max_attempts=1)
+        except Exception:
+            traceback.print_exc()
+
+    class Handler(socketserver.StreamRequestHandler):
+
+        def handle(self):
+            line = self.rfile.readline()
+            if not line:
+                return  # Just probed by is_running()
+            request = json.loads(line.decode('utf-8'))
+
+            stdout, stderr = sys.stdout, sys.stderr
+            stdout_tty, stderr_tty = request.get('isatty', (False, False))
+            sys.stdout = FrameWriter(self.wfile, b'O', stdout_tty)
+            sys.stderr = FrameWriter(self.wfile, b'E', stderr_tty)
+            try:
+                status = run(request['argv'])
+            except SystemExit as exc:  # e.g. from argparse
+                status = exc.code if isinstance(exc.code, int) else 1
+            except Exception:
+                sys.stderr.write(traceback.format_exc())
+                status = 1
+            finally:
+                sys.stdout, sys.stderr = stdout, stderr
+
+            self.wfile.write(FRAME_HEADER.pack(b'X', status))
+            self.wfile.flush()
+
+            # The client has its answer - now push anything it journaled, in
+            # a process of its own so the next request needn't wait on Google
+            try:
+                if journal.pending():
+                    journal.flush_in_background()
+            except Exception:
+                traceback.print_exc()
+
+    if os.path.exists(SOCKET_PATH):
+        if is_running():
+            print("Error: lifelogger daemon already running on %s" % SOCKET_PATH)
+            return False
+        os.remove(SOCKET_PATH)  # Stale, from a daemon that died
+
+    # Adding commands leave their journal entries for us to flush
+    journal.spawn_flush = False
+
+    print("Connecting to Google Calendar API...")
+    connect()
+    refresh_token()
+
+    # Only we may connect, as the daemon acts with our Google credentials -
+    # from the moment the socket exists, hence the umask
+    umask = os.umask(0o077)
+    try:
+        server = socketserver.UnixStreamServer(SOCKET_PATH, Handler)
+    finally:
+        os.umask(umask)
+    server.timeout = TICK_INTERVAL
+    os.chmod(SOCKET_PATH, 0o600)
+
+    # Clean up the socket on kill as well as on Ctrl-C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    print("lifelogger daemon listening on %s" % SOCKET_PATH)
+    try:
+        last_tick = time.time()
+        while True:
+            server.handle_request()  # Returns after a request or a timeout
+
+            if time.time() - last_tick >= TICK_INTERVAL:
+                last_tick = time.time()
+                try:
+                    if refresh_token():
+                        print("Refreshed access token")
+                    if recent.is_stale(recent.load()):
+                        recent.refresh(connect())
+                except Exception:
+                    traceback.print_exc()
+                flush_journal()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(SOCKET_PATH)
+
+    return True
+
+
+def is_running():
+    """Check whether a daemon is listening on the socket
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with closing(sock):
+        try:
+            sock.connect(SOCKET_PATH)
+        except socket.error:
+            return False
+    return True
@@ -1,12 +1,49 @@
 # coding=utf-8
 from __future__ import absolute_import
+import logging
+import os
 import re
-from datetime import datetime, time
+import sqlite3
+import threading
+import time as clock
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, time, timedelta
 
-from peewee import CharField, DateTimeField, Expression, Model, SqliteDatabase
+import dateutil.parser
+from dateutil import tz
+from peewee import (
+    JOIN, SQL, BlobField, BooleanField, CharField, DateField, DateTimeField,
+    Expression, FloatField, IntegerField, Model, OperationalError,
+    SqliteDatabase, Using, fn
+)
 
-from .config import DB_PATH
-from .utils import blue, highlight_tags, pink
+from .cache import bump_generation
+from .config import ARCHIVE_PATH, DB_PATH
+from .profiling import phase
+from .trigrams import required_trigrams, text_trigrams
+from .utils import QueryTimeout, SchemaOutdated, blue, extract_tags, highlight_tags, parse_api_datetime, pink
+
+log = logging.getLogger(__name__)
+
+# Bump whenever the tables change, so the next import rebuilds them
+SCHEMA_VERSION = 7
+
+# Units of the measurements that can be extracted from event summaries, and
+# how they're written
+MEASUREMENT_UNITS = ('kg', 'mg', 'percentage')
+MEASUREMENT_PATTERNS = {
+    # Used for #weight measurements
+    'kg': '([0-9.]+)kg\\b',
+    # Used for drug intake, e.g. #caffeine measurements
+    'mg': '([0-9.]+)mg\\b',
+    # Used for #bodyfat measurements
+    'percentage': '\\b([0-9.]+)%',
+}
+
+# Descriptions of at least this many bytes are stored zlib-compressed, if
+# that makes them any smaller
+COMPRESS_MIN_BYTES = 128
 
 
 # Add regex function to SqliteDatabase
@@ -19,9 +56,138 @@ def regexp(lhs, rhs):
 
 SqliteDatabase.register_ops({OP_REGEXP: 'REGEXP'})
 
+# SQLite virtual machine instructions between checks of a query's deadline
+PROGRESS_INTERVAL = 10000
+
+# Most archives kept apart - SQLite attaches at most 10 databases at once,
+# and one is left for building a new archive. Past that, the oldest are
+# merged.
+MAX_ARCHIVES = 9
+
+
+class QueryStats(object):
+    """
+    Running totals of the statements run through db since the last reset,
+    logged at the end of each command (with -v, and every statement with
+    -vv), like the API usage in scheduler.py.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = set()
+        self.reset_usage()
+
+    def reset_usage(self):
+        self.usage = dict.fromkeys(('statements', 'seconds', 'rows', 'regexp_calls'), 0)
+
+    def started(self, statement):
+        with self.lock:
+            self.running.add(statement)
+
+    def finished(self, statement):
+        with self.lock:
+            if statement not in self.running:
+                return
+            self.running.remove(statement)
+            self.usage['statements'] += 1
+            self.usage['seconds'] += statement.seconds
+            self.usage['rows'] += statement.rows
+        log.debug("SQL %.1fms, %d rows: %s", statement.seconds * 1000, statement.rows, statement.sql)
+
+    def log_usage(self):
+        for statement in list(self.running):
+            self.finished(statement)
+        if self.usage['statements']:
+            log.info(
+                "SQL: %(statements)d statements, %(seconds).3fs, %(rows)d rows, "
+                "%(regexp_calls)d REGEXP calls",
+                self.usage
+            )
+
+
+query_stats = QueryStats()
+
+
+class Statement(object):
+    def __init__(self, sql):
+        self.sql = ' '.join(sql.split())
+        self.seconds = 0.0
+        self.rows = 0
+
+
+class TimedCursor(object):
+    """
+    Wraps a sqlite3 cursor, timing the statement run on it (including
+    fetching its rows, when SQLite does most of the work) and counting the
+    rows fetched, for query_stats.
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.statement = None
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    @contextmanager
+    def timing(self):
+        start = clock.time()
+        try:
+            yield
+        finally:
+            self.statement.seconds += clock.time() - start
+
+    def execute(self, sql, params=()):
+        self.close_statement()
+        self.statement = Statement(sql)
+        query_stats.started(self.statement)
+        with self.timing():
+            self.cursor.execute(sql, params)
+        return self
+
+    def fetchone(self):
+        with self.timing():
+            row = self.cursor.fetchone()
+        if row is None:
+            self.close_statement()
+        else:
+            self.statement.rows += 1
+        return row
+
+    def fetchmany(self, *args):
+        with self.timing():
+            rows = self.cursor.fetchmany(*args)
+        self.statement.rows += len(rows)
+        if not rows:
+            self.close_statement()
+        return rows
+
+    def fetchall(self):
+        with self.timing():
+            rows = self.cursor.fetchall()
+        self.statement.rows += len(rows)
+        self.close_statement()
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def close_statement(self):
+        if self.statement is not None:
+            query_stats.finished(self.statement)
+
+    def close(self):
+        self.close_statement()
+        self.cursor.close()
+
+
+class InstrumentedSqliteDatabase(SqliteDatabase):
+    def get_cursor(self):
+        return TimedCursor(SqliteDatabase.get_cursor(self))
+
 
 # Create database reference
-db = SqliteDatabase(DB_PATH)
+db = InstrumentedSqliteDatabase(DB_PATH)
 
 
 # Define REGEXP function in sqlite database connection
@@ -29,10 +195,80 @@ conn = db.get_conn()
 
 
 def regex_matches(regex, string):
-    return bool(re.search(regex, string, flags=re.IGNORECASE))
+    query_stats.usage['regexp_calls'] += 1
+    return bool(re.search(regex, string or '', flags=re.IGNORECASE))
+
+
+def measurement(string, units):
+    """The measurement in units found in string, or None
+    """
+    match = re.search(MEASUREMENT_PATTERNS[units], string or '')
+    try:
+        return float(match.group(1))
+    except (AttributeError, ValueError):
+        return None
+
+
+def pack_description(text):
+    """Returns the (data, compressed) EventDescription stores a description as
+    """
+    data = text.encode('utf-8')
+    if len(data) >= COMPRESS_MIN_BYTES:
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data):
+            return sqlite3.Binary(compressed), True
+    return sqlite3.Binary(data), False
+
+
+def unpack_description(data, compressed):
+    if data is None:
+        return u''
+    data = bytes(data)
+    return (zlib.decompress(data) if compressed else data).decode('utf-8')
 
 
 conn.create_function('REGEXP', 2, regex_matches)
+conn.create_function('MEASUREMENT', 2, measurement)
+conn.create_function('DESCRIPTION', 2, unpack_description)
+
+
+@contextmanager
+def query_timeout(seconds):
+    """Abort the queries run in the body if they take over seconds in all
+
+    :param seconds: Time budget - None or 0 for no limit
+    :raises QueryTimeout: Once the time is up
+    """
+    if not seconds:
+        yield
+        return
+
+    deadline = clock.time() + seconds
+    conn.set_progress_handler(lambda: clock.time() > deadline, PROGRESS_INTERVAL)
+    try:
+        yield
+    except (OperationalError, sqlite3.OperationalError) as exc:
+        if clock.time() > deadline and 'interrupted' in str(exc):
+            raise QueryTimeout("Query aborted after its %gs timeout" % seconds)
+        raise
+    finally:
+        conn.set_progress_handler(None, PROGRESS_INTERVAL)
+
+
+def query_plan(sql, params=()):
+    """
+    Returns SQLite's plan for a statement, as lines indented by depth.
+    """
+    rows = db.execute_sql('EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+    if sqlite3.sqlite_version_info >= (3, 24, 0):
+        # Rows of (id, parent, unused, detail) - a tree
+        depths = {0: -1}
+        lines = []
+        for node_id, parent, _, detail in rows:
+            depths[node_id] = depths.get(parent, -1) + 1
+            lines.append('  ' * depths[node_id] + detail)
+        return lines
+    return [row[-1] for row in rows]
 
 
 # Models
@@ -42,19 +278,58 @@ class Event(Model):
     summary = CharField()
     start = DateTimeField()
     end = DateTimeField()
-    description = CharField()
+    # Original start of a modified instance of a recurring event, as the
+    # instances share the uid of the series - empty for other events
+    recurrence_id = CharField(default='')
 
     class Meta:
         database = db
         indexes = (
-            (('summary'), False),
-            (('start'), False),
-            (('end'), False),
+            (('summary',), False),
+            (('start',), False),
+            (('end',), False),
+            (('uid',), False),
         )
         order_by = ('start',)
 
     @classmethod
     def create_from_ical_event(cls, calendar_name, ical_event):
+        event = cls.create(**cls.fields_from_ical_event(calendar_name, ical_event))
+        insert_descriptions([(event.id, event.description)])
+        return event
+
+    @property
+    def description(self):
+        """
+        Kept in EventDescription and only loaded when first needed - see
+        load_descriptions() to load those of many events at once.
+        """
+        if '_description' not in self.__dict__:
+            load_descriptions([self])
+        return self._description
+
+    @description.setter
+    def description(self, value):
+        self._description = value
+
+    @staticmethod
+    def fields_from_api_event(calendar_name, api_event):
+        recurrence_id = api_event.get('originalStartTime')
+        if recurrence_id is not None:
+            recurrence_id = normalized_api_time(recurrence_id).isoformat()
+
+        return dict(
+            calendar=calendar_name,
+            uid=api_event_uid(api_event),
+            summary=api_event.get('summary', ''),
+            start=normalized_api_time(api_event['start']),
+            end=normalized_api_time(api_event.get('end', api_event['start'])),
+            description=api_event.get('description', ''),
+            recurrence_id=recurrence_id or '',
+        )
+
+    @staticmethod
+    def fields_from_ical_event(calendar_name, ical_event):
         start = normalized(ical_event.get('dtstart').dt)
         end = ical_event.get('dtend')
 
@@ -64,13 +339,18 @@ class Event(Model):
         else:
             end = start
 
-        return cls.create(
+        recurrence_id = ical_event.get('recurrence-id')
+        if recurrence_id is not None:
+            recurrence_id = normalized(recurrence_id.dt).isoformat()
+
+        return dict(
             calendar=calendar_name,
             uid=ical_event.get('uid'),
             summary=ical_event.get('summary'),
             start=start,
             end=end,
             description=ical_event.get('description', ''),
+            recurrence_id=recurrence_id or '',
         )
 
     def __unicode__(self):
@@ -133,18 +413,15 @@ class Event(Model):
 
     @property
     def percentage(self):
-        # Used for #bodyfat measurements
-        return self.measurement_property('percentage', '\\b([0-9.]+)%')
+        return self.measurement_property('percentage', MEASUREMENT_PATTERNS['percentage'])
 
     @property
     def kg(self):
-        # Used for #weight measurements
-        return self.measurement_property('kg', '([0-9.]+)kg\\b')
+        return self.measurement_property('kg', MEASUREMENT_PATTERNS['kg'])
 
     @property
     def mg(self):
-        # Used for drug intake, e.g. #caffeine measurements
-        return self.measurement_property('mg', '([0-9.]+)mg\\b')
+        return self.measurement_property('mg', MEASUREMENT_PATTERNS['mg'])
 
     def measurement_property(self, units, regex):
         """
@@ -158,6 +435,951 @@ class Event(Model):
         except (ValueError, AttributeError):
             raise ValueError("Event {} doesn't match for property {}".format(self, units))
 
+    def measurements(self):
+        """
+        Returns a dict of the measurements found in the summary, keyed by
+        units, e.g. {'kg': 80.0}
+        """
+        values = {}
+        for units in MEASUREMENT_UNITS:
+            try:
+                values[units] = getattr(self, units)
+            except ValueError:
+                pass
+        return values
+
+
+class DailyRollup(Model):
+    """
+    Materialized per-day totals of events for each (calendar, tag), kept up to
+    date by refresh_rollup() as events are imported. Events are counted on the
+    day they start; those without any hashtag go under the empty tag.
+    """
+    day = DateField()
+    calendar = CharField()
+    tag = CharField()
+    count = IntegerField()
+    total_seconds = FloatField()
+    kg_sum = FloatField()
+    mg_sum = FloatField()
+    percentage_sum = FloatField()
+
+    class Meta:
+        database = db
+        indexes = (
+            (('day', 'calendar', 'tag'), True),
+            (('tag', 'day'), False),
+        )
+
+
+class EventTag(Model):
+    """
+    The hashtags in each event's summary, lower-cased, so queries on tags
+    can use an index instead of matching every summary. Kept in step with
+    the events by insert_events(), index_tags() and delete_events().
+    """
+    # Id of the Event - not a foreign key, as events are replaced in bulk
+    event = IntegerField()
+    tag = CharField()
+
+    class Meta:
+        database = db
+        indexes = (
+            (('tag', 'event'), False),
+            (('event',), False),
+        )
+
+
+class EventTrigram(Model):
+    """
+    The trigrams in each event's summary and description (see trigrams.py),
+    so a regex only has to run on the events holding the trigrams it needs.
+    Kept in step with the events like EventTag.
+    """
+    event = IntegerField()
+    # TRIGRAM_FIELDS code of the field the trigram is in
+    field = CharField()
+    trigram = CharField()
+
+    class Meta:
+        database = db
+        indexes = (
+            (('field', 'trigram', 'event'), True),
+            (('event',), False),
+        )
+
+
+# Fields in the trigram index, and their codes in EventTrigram.field
+TRIGRAM_FIELDS = {'summary': 's', 'description': 'd'}
+
+
+class EventDescription(Model):
+    """
+    The descriptions of events, out of the event table so that scans of
+    summaries and times read narrow rows - long #search: notes would
+    otherwise fill most of its pages. Empty descriptions aren't stored.
+    Kept in step with the events like EventTag.
+    """
+    # Id of the Event, and so also the rowid
+    event = IntegerField(primary_key=True)
+    # UTF-8 text, zlib-compressed if compressed - see pack_description()
+    data = BlobField()
+    compressed = BooleanField()
+
+    class Meta:
+        database = db
+
+
+# A description's text, in SQL
+DESCRIPTION_TEXT = fn.DESCRIPTION(EventDescription.data, EventDescription.compressed)
+
+
+class SyncToken(Model):
+    """
+    Calendar API sync token of each calendar, from which the next 'sync'
+    fetches only what changed. Kept alongside the events, so a rebuilt
+    database starts over with a full sync.
+    """
+    calendar = CharField(unique=True)
+    token = CharField()
+
+    class Meta:
+        database = db
+
+
+class Archive(Model):
+    """
+    A closed year - or run of years, once there are too many archives - whose
+    events were moved out of the database, with their tags, trigrams and
+    descriptions, into a read-only file of their own (see archive_years()).
+    Queries attach the archives they need (see attached_archives()), and
+    imports leave the archived events alone.
+    """
+    first_year = IntegerField(unique=True)
+    last_year = IntegerField()
+    events = IntegerField()
+    # Largest id of its events, so that new events don't reuse it
+    max_id = IntegerField()
+
+    class Meta:
+        database = db
+
+    @property
+    def name(self):
+        if self.first_year == self.last_year:
+            return str(self.first_year)
+        return '%d-%d' % (self.first_year, self.last_year)
+
+    @property
+    def path(self):
+        return os.path.join(ARCHIVE_PATH, self.name + '.sqlite')
+
+    @property
+    def alias(self):
+        return 'archive_%d' % self.first_year
+
+    @property
+    def start(self):
+        return datetime(self.first_year, 1, 1)
+
+    @property
+    def end(self):
+        return datetime(self.last_year + 1, 1, 1)
+
+    def is_current(self):
+        """
+        Whether the archive's file is there, with the tables of this version
+        of lifelogger.
+        """
+        if not os.path.exists(self.path):
+            return False
+        archive_conn = sqlite3.connect(self.path)
+        try:
+            return archive_conn.execute('PRAGMA user_version').fetchone()[0] == SCHEMA_VERSION
+        finally:
+            archive_conn.close()
+
+
+MODELS = (Event, DailyRollup, EventTag, EventTrigram, EventDescription, SyncToken, Archive)
+
+# Tables split between the database and the archives
+PARTITIONED_MODELS = (Event, EventTag, EventTrigram, EventDescription)
+
+
+def ensure_schema():
+    """
+    Creates the tables, rebuilding them from scratch if the database was made
+    by a different version of lifelogger. Returns True if they were rebuilt.
+
+    The Archive table and the archive files are kept: archives made by
+    another version are left out (see list_archives()), so the import that
+    follows brings their events back, until archive_years() replaces them.
+    """
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version == SCHEMA_VERSION:
+        return False
+
+    db.drop_tables([model for model in MODELS if model is not Archive], safe=True)
+    db.create_tables(MODELS, safe=True)
+    conn.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+    return True
+
+
+def check_schema():
+    """
+    Makes sure the tables are those of this version of lifelogger, creating
+    them in a new database. Rebuilding them drops every event, so only
+    make_db_all does that, filling them in again right after.
+
+    :raises SchemaOutdated: If the database was made by another version
+    """
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version == SCHEMA_VERSION:
+        return
+    if version == 0 and not db.get_tables():
+        ensure_schema()
+        return
+    raise SchemaOutdated("The local database is out of date - run make_db_all to rebuild it")
+
+
+def insert_rows(model, rows, batch_size=100):
+    """
+    Bulk inserts dicts of field values, in batches small enough for SQLite's
+    limit on the number of query variables.
+    """
+    for i in range(0, len(rows), batch_size):
+        model.insert_many(rows[i:i + batch_size]).execute()
+
+
+def insert_events(rows):
+    """
+    Bulk inserts dicts of Event field values (and description), indexing
+    their tags and trigrams.
+    """
+    # New rows get ids past the largest one, archived ones included
+    first_id = max(Event.select(fn.MAX(Event.id)).scalar() or 0,
+                   Archive.select(fn.MAX(Archive.max_id)).scalar() or 0) + 1
+    ids = range(first_id, first_id + len(rows))
+    insert_rows(Event, [
+        dict([(k, v) for k, v in row.items() if k != 'description'], id=event_id)
+        for event_id, row in zip(ids, rows)
+    ])
+    insert_descriptions(zip(ids, (row.get('description') for row in rows)))
+    index_events(Event.id >= first_id)
+
+
+def insert_descriptions(descriptions):
+    """
+    Stores the descriptions of new events, from (event id, text) pairs.
+    """
+    rows = ((event_id,) + pack_description(text) for event_id, text in descriptions if text)
+    # Many, and large
+    conn.executemany(
+        'INSERT INTO %s (event, data, compressed) VALUES (?, ?, ?)' % EventDescription._meta.db_table, rows)
+
+
+def load_descriptions(events, batch_size=500):
+    """
+    Loads the descriptions of Events in bulk, rather than with a query each
+    as they're used.
+    """
+    events = [event for event in events if '_description' not in event.__dict__]
+    for i in range(0, len(events), batch_size):
+        batch = events[i:i + batch_size]
+        query = (EventDescription
+                 .select(EventDescription.event, EventDescription.data, EventDescription.compressed)
+                 .where(EventDescription.event << [event.id for event in batch])
+                 .tuples())
+        found = dict((event_id, unpack_description(data, compressed)) for event_id, data, compressed in query)
+        for event in batch:
+            event.description = found.get(event.id, u'')
+
+
+def select_with_descriptions(*fields):
+    """
+    Event.select() of some fields, then the data and compressed flag of the
+    description - None for events without one.
+    """
+    return (Event
+            .select(*(fields + (EventDescription.data, EventDescription.compressed)))
+            .join(EventDescription, JOIN.LEFT_OUTER, on=(EventDescription.event == Event.id)))
+
+
+def description_condition(condition):
+    """
+    Condition on Event of one on its description (DESCRIPTION_TEXT), never
+    met by events without one.
+    """
+    return Event.id << EventDescription.select(EventDescription.event).where(condition)
+
+
+def index_events(where):
+    """
+    (Re-)indexes the tags and trigrams of the events matching a condition on
+    Event.
+    """
+    index_tags(where)
+    index_trigrams(where)
+
+
+def index_tags(where):
+    """
+    (Re-)indexes the tags of the events matching a condition on Event.
+    """
+    events = Event.select(Event.id, Event.summary).where(where).tuples()
+    rows = [dict(event=event_id, tag=tag) for event_id, summary in events for tag in extract_tags(summary)]
+    EventTag.delete().where(EventTag.event << Event.select(Event.id).where(where)).execute()
+    insert_rows(EventTag, rows, batch_size=400)
+
+
+def index_trigrams(where):
+    """
+    (Re-)indexes the trigrams of the events matching a condition on Event.
+    """
+    EventTrigram.delete().where(EventTrigram.event << Event.select(Event.id).where(where)).execute()
+    events = select_with_descriptions(Event.id, Event.summary).where(where).tuples()
+    rows = (
+        (event_id, TRIGRAM_FIELDS[name], trigram)
+        for event_id, summary, data, compressed in events
+        for name, text in (('summary', summary), ('description', unpack_description(data, compressed)))
+        for trigram in text_trigrams(text)
+    )
+    # Far too many rows for insert_rows() to be quick
+    conn.executemany(
+        'INSERT INTO %s (event, field, trigram) VALUES (?, ?, ?)' % EventTrigram._meta.db_table, rows)
+
+
+def trigram_subquery(code, condition):
+    """
+    Returns the SQL selecting the ids of events whose field of the given
+    code meets a condition on its trigrams (see
+    trigrams.required_trigrams()) and its params, or None if every event
+    might.
+    """
+    if not isinstance(condition, tuple):
+        condition = ('and', (condition,))
+    kind, children = condition
+
+    if kind == 'or':
+        parts = [trigram_subquery(code, child) for child in children]
+        if not parts or None in parts:
+            return None
+        compound = ' UNION '
+    else:
+        parts = [trigram_subquery(code, child) for child in children if isinstance(child, tuple)]
+        parts = [part for part in parts if part is not None]
+        trigrams = [child for child in children if not isinstance(child, tuple)]
+        if trigrams:
+            # Events with all the trigrams
+            parts.append((
+                'SELECT event FROM %s WHERE field = ? AND trigram IN (%s) '
+                'GROUP BY event HAVING count(*) = %d' % (
+                    EventTrigram._meta.db_table, ', '.join('?' * len(trigrams)), len(trigrams)),
+                [code] + trigrams,
+            ))
+        if not parts:
+            return None
+        compound = ' INTERSECT '
+
+    if len(parts) == 1:
+        return parts[0]
+    # SQLite has no parentheses for nesting compound selects
+    return (compound.join('SELECT event FROM (%s)' % sql for sql, _ in parts),
+            [param for _, params in parts for param in params])
+
+
+def regex_search(name, pattern):
+    """
+    Condition on Event of a regex search, ignoring case, on its 'summary' or
+    'description' - run only on the events the trigram index says may match.
+    """
+    if name == 'summary':
+        column, event_id = Event.summary, Event.id
+    else:
+        column, event_id = DESCRIPTION_TEXT, EventDescription.event
+    condition = regexp(column, pattern)
+
+    subquery = trigram_subquery(TRIGRAM_FIELDS[name], required_trigrams(pattern))
+    if subquery is not None:
+        # A single IN, so SQLite looks the candidates up by id
+        sql, params = subquery
+        condition = (event_id << SQL('(%s)' % sql, *params)) & condition
+    return condition if name == 'summary' else description_condition(condition)
+
+
+def import_ical_events(calendar_name, ical_events):
+    """
+    Brings the stored events of a calendar in line with its iCal events. See
+    import_events().
+    """
+    return import_events(
+        calendar_name,
+        (Event.fields_from_ical_event(calendar_name, ical_event) for ical_event in ical_events),
+    )
+
+
+def import_events(calendar_name, events_fields):
+    """
+    Brings the stored events of a calendar in line with the given complete
+    list of its events (dicts of field values), only inserting, updating and
+    deleting those that changed. Events are matched on (uid, recurrence_id).
+    Archived events are left as they are.
+
+    Returns a tuple (inserted, updated, deleted, touched days).
+    """
+    fields = ('summary', 'start', 'end', 'description')
+
+    existing = {}
+    stale_ids = []
+    touched_days = set()
+    query = (select_with_descriptions(Event.id, Event.uid, Event.recurrence_id,
+                                      Event.summary, Event.start, Event.end)
+             .where(Event.calendar == calendar_name)
+             .tuples())
+    for row in query:
+        event_id, key = row[0], row[1:3]
+        old = row[3:6] + (unpack_description(*row[6:]),)
+        if key in existing:
+            # Duplicate from an older import
+            stale_ids.append(event_id)
+            touched_days.add(old[1].date())
+        else:
+            existing[key] = (event_id, old)
+
+    archived = archived_keys(calendar_name)
+    to_insert = []
+    inserted_keys = set()
+    updated = 0
+    reindexed_ids = []
+    new_descriptions = []
+    for values in events_fields:
+        key = (values['uid'], values['recurrence_id'])
+        new = tuple(values[field] for field in fields)
+        if key in archived:
+            continue
+
+        if key not in existing:
+            if key not in inserted_keys:
+                inserted_keys.add(key)
+                to_insert.append(values)
+                touched_days.add(values['start'].date())
+            continue
+
+        event_id, old = existing.pop(key)
+        if old != new:
+            Event.update(**dict(zip(fields[:3], new[:3]))).where(Event.id == event_id).execute()
+            if old[3] != new[3]:
+                new_descriptions.append((event_id, new[3]))
+            if old[0] != new[0] or old[3] != new[3]:
+                reindexed_ids.append(event_id)
+            touched_days.add(old[1].date())
+            touched_days.add(values['start'].date())
+            updated += 1
+
+    # Whatever is left over has been deleted upstream
+    for event_id, old in existing.values():
+        stale_ids.append(event_id)
+        touched_days.add(old[1].date())
+
+    insert_events(to_insert)
+    for i in range(0, len(new_descriptions), 500):
+        batch = new_descriptions[i:i + 500]
+        EventDescription.delete().where(EventDescription.event << [event_id for event_id, _ in batch]).execute()
+        insert_descriptions(batch)
+    for i in range(0, len(reindexed_ids), 500):
+        index_events(Event.id << reindexed_ids[i:i + 500])
+    delete_events(stale_ids)
+
+    return len(to_insert), updated, len(stale_ids), touched_days
+
+
+def store_api_events(calendar_name, api_events):
+    """
+    Writes events returned by the Calendar API (just inserted, or changed
+    since the last sync) straight into the database, replacing any stored
+    version and deleting cancelled ones, so local analysis is current
+    without a full re-import. They carry the same uid as in the iCal export,
+    so the next import reconciles them rather than duplicating them.
+    """
+    check_schema()
+
+    # The latest version of each (uid, recurrence id) - None if cancelled -
+    # and the uids whose whole series got deleted before it
+    latest = {}
+    deleted_uids = set()
+    for api_event in api_events:
+        uid = api_event_uid(api_event)
+        if api_event.get('status') == 'cancelled' and 'recurringEventId' not in api_event:
+            # Whole event (or series) deleted
+            for key in [key for key in latest if key[0] == uid]:
+                del latest[key]
+            deleted_uids.add(uid)
+            continue
+
+        if api_event.get('status') == 'cancelled':
+            # One instance of a recurring event deleted
+            recurrence_id = normalized_api_time(api_event['originalStartTime']).isoformat()
+            latest[(uid, recurrence_id)] = None
+        else:
+            values = Event.fields_from_api_event(calendar_name, api_event)
+            latest[(uid, values['recurrence_id'])] = values
+
+    uids = list(deleted_uids | set(uid for uid, _ in latest))
+    # Archived events are left as they are
+    for key in archived_keys(calendar_name, uids):
+        latest.pop(key, None)
+    touched_days = set()
+    with phase('store events'), db.atomic():
+        stale_ids = []
+        for i in range(0, len(uids), 500):
+            existing = (Event
+                        .select(Event.id, Event.uid, Event.recurrence_id, Event.start)
+                        .where((Event.calendar == calendar_name) & (Event.uid << uids[i:i + 500]))
+                        .tuples())
+            for event_id, uid, recurrence_id, start in existing:
+                if uid in deleted_uids or (uid, recurrence_id) in latest:
+                    stale_ids.append(event_id)
+                    touched_days.add(start.date())
+        delete_events(stale_ids)
+
+        rows = [fields for fields in latest.values() if fields is not None]
+        insert_events(rows)
+        touched_days.update(row['start'].date() for row in rows)
+
+    with phase('rollup'):
+        refresh_rollup(touched_days)
+    bump_generation()
+
+
+def get_sync_token(calendar_name):
+    try:
+        return SyncToken.get(SyncToken.calendar == calendar_name).token
+    except SyncToken.DoesNotExist:
+        return None
+
+
+def set_sync_token(calendar_name, token):
+    with db.atomic():
+        SyncToken.delete().where(SyncToken.calendar == calendar_name).execute()
+        if token is not None:
+            SyncToken.create(calendar=calendar_name, token=token)
+
+
+def stored_uids(calendar_name, uids, batch_size=500):
+    """
+    Returns which of the given uids are stored for a calendar.
+    """
+    check_schema()
+
+    uids = list(uids)
+    found = set()
+    for i in range(0, len(uids), batch_size):
+        query = (Event
+                 .select(Event.uid)
+                 .where((Event.calendar == calendar_name) & (Event.uid << uids[i:i + batch_size]))
+                 .tuples())
+        found.update(uid for uid, in query)
+    found.update(uid for uid, _ in archived_keys(calendar_name, uids))
+    return found
+
+
+def delete_events(event_ids, batch_size=500):
+    for i in range(0, len(event_ids), batch_size):
+        EventTag.delete().where(EventTag.event << event_ids[i:i + batch_size]).execute()
+        EventTrigram.delete().where(EventTrigram.event << event_ids[i:i + batch_size]).execute()
+        EventDescription.delete().where(EventDescription.event << event_ids[i:i + batch_size]).execute()
+        Event.delete().where(Event.id << event_ids[i:i + batch_size]).execute()
+
+
+def prune_calendars(calendar_names):
+    """
+    Deletes the events of calendars no longer in the config. Returns the
+    touched days.
+    """
+    query = Event.select(Event.id, Event.start).where(~(Event.calendar << list(calendar_names)))
+    event_ids = []
+    touched_days = set()
+    for event_id, start in query.tuples():
+        event_ids.append(event_id)
+        touched_days.add(start.date())
+
+    delete_events(event_ids)
+    return touched_days
+
+
+def refresh_rollup(days):
+    """
+    Recomputes the DailyRollup rows of the given days from the events that
+    start on them.
+    """
+    if not days:
+        return
+    archives = archives_between(datetime.combine(min(days), time(0)),
+                                datetime.combine(max(days) + timedelta(days=1), time(0)))
+    with attached_archives(archives), db.atomic():
+        for first, last in day_ranges(days):
+            DailyRollup.delete().where(DailyRollup.day.between(first, last)).execute()
+
+            events = (Event
+                      .select(Event.calendar, Event.summary, Event.start, Event.end)
+                      .where((Event.start >= datetime.combine(first, time(0))) &
+                             (Event.start < datetime.combine(last + timedelta(days=1), time(0)))))
+
+            totals = {}
+            for event in events:
+                measurements = event.measurements()
+                for tag in extract_tags(event.summary) or ['']:
+                    key = (event.start_date, event.calendar, tag)
+                    if key not in totals:
+                        totals[key] = dict(
+                            day=key[0], calendar=key[1], tag=key[2], count=0, total_seconds=0.0,
+                            kg_sum=0.0, mg_sum=0.0, percentage_sum=0.0,
+                        )
+                    row = totals[key]
+                    row['count'] += 1
+                    row['total_seconds'] += event.duration_seconds
+                    for units, value in measurements.items():
+                        row[units + '_sum'] += value
+
+            insert_rows(DailyRollup, list(totals.values()))
+
+
+def day_ranges(days):
+    """
+    Groups dates into sorted (first, last) runs of consecutive days.
+    """
+    ranges = []
+    for day in sorted(set(days)):
+        if ranges and day - ranges[-1][1] == timedelta(days=1):
+            ranges[-1][1] = day
+        else:
+            ranges.append([day, day])
+    return [tuple(r) for r in ranges]
+
+
+# Archives attached to conn, in the order of their years - see
+# attached_archives()
+attached = []
+
+
+def all_archives():
+    try:
+        return list(Archive.select().order_by(Archive.first_year))
+    except OperationalError:
+        # No database yet
+        return []
+
+
+def list_archives():
+    """
+    Returns the Archives, oldest first - only those made by this version of
+    lifelogger, whose tables match the database's.
+    """
+    return [archive for archive in all_archives() if archive.is_current()]
+
+
+def drop_stale_archives():
+    """
+    Deletes the archives made by another version of lifelogger, whose events
+    the import after the schema was rebuilt brought back into the database.
+    Returns them.
+    """
+    stale = [archive for archive in all_archives() if not archive.is_current()]
+    for archive in stale:
+        archive.delete_instance()
+        if os.path.exists(archive.path):
+            os.remove(archive.path)
+    return stale
+
+
+def archives_between(start=None, end=None):
+    """
+    Returns the Archives holding events that start from start to end
+    (exclusive) - None for no bound.
+    """
+    return [archive for archive in list_archives()
+            if (start is None or archive.end > start) and (end is None or archive.start < end)]
+
+
+def union_views(connection, schemas):
+    """
+    Shadows the partitioned tables of a connection with temporary views of
+    the union of their rows in the given schemas - 'main' for the database
+    itself, and the aliases of attached archives - or drops the views, given
+    just 'main'. Temporary tables and views come before those of the
+    database, so queries don't need to change, and SQLite pushes their
+    conditions down into each schema, to use its indexes.
+    """
+    for model in PARTITIONED_MODELS:
+        table = model._meta.db_table
+        connection.execute('DROP VIEW IF EXISTS temp."%s"' % table)
+        if schemas == ['main']:
+            continue
+        columns = ', '.join('"%s"' % field.db_column for field in model._meta.sorted_fields)
+        connection.execute('CREATE TEMP VIEW "%s" AS %s' % (table, ' UNION ALL '.join(
+            'SELECT %s FROM "%s"."%s"' % (columns, schema, table) for schema in schemas)))
+
+
+def archived_fields(model):
+    """
+    The fields of a partitioned model copied in and out of archives - all
+    but the ids of tags and trigrams, which nothing refers to.
+    """
+    return [field for field in model._meta.sorted_fields if model is Event or field.name != 'id']
+
+
+def attach_archives(archives):
+    """
+    Makes conn's queries see the events of exactly the given Archives, on
+    top of the database's.
+    """
+    aliases = [archive.alias for archive in archives]
+    if aliases == [archive.alias for archive in attached]:
+        return
+
+    union_views(conn, ['main'])
+    for archive in attached:
+        if archive.alias not in aliases:
+            conn.execute('DETACH DATABASE "%s"' % archive.alias)
+    attached_aliases = [archive.alias for archive in attached]
+    for archive in archives:
+        if archive.alias not in attached_aliases:
+            conn.execute('ATTACH DATABASE ? AS "%s"' % archive.alias, (archive.path,))
+    union_views(conn, ['main'] + aliases)
+    attached[:] = archives
+
+
+@contextmanager
+def attached_archives(archives):
+    """
+    Attaches the given Archives for the queries in the body (see
+    attach_archives()). Writes to the partitioned tables fail meanwhile, as
+    they're views, and as SQLite can't attach in a transaction, the body
+    mustn't be inside one.
+    """
+    previous = list(attached)
+    attach_archives(archives)
+    try:
+        yield
+    finally:
+        attach_archives(previous)
+
+
+def partitions():
+    """
+    The schemas holding events: 'main', then the attached archives.
+    """
+    return ['main'] + [archive.alias for archive in attached]
+
+
+@contextmanager
+def partition(schema):
+    """
+    Narrows the views of the attached archives down to one of partitions()
+    for the body.
+    """
+    union_views(conn, [schema])
+    try:
+        yield
+    finally:
+        union_views(conn, partitions())
+
+
+def select_by_partition(query, descriptions=False):
+    """
+    Returns the Events a query on Event selects, ordered by start, running
+    it on each partition in turn. On the union of them all, SQLite would
+    run its subqueries - on tags, trigrams, descriptions - over every
+    partition once for each partition.
+
+    :param descriptions: Also load the events' descriptions (see
+                         load_descriptions()), from their own partition
+    """
+    if not attached:
+        events = list(query)
+        if descriptions:
+            load_descriptions(events)
+        return events
+
+    events = []
+    for schema in partitions():
+        with partition(schema):
+            found = list(query.clone())
+            if descriptions:
+                load_descriptions(found)
+        events.extend(found)
+    # Ties as SQLite orders them, by id
+    events.sort(key=lambda event: (event.start, event.id))
+    return events
+
+
+def archived_keys(calendar_name, uids=None, batch_size=500):
+    """
+    Returns the (uid, recurrence_id) of the archived events of a calendar -
+    only of those with the given uids, if any. Reads each archive on a
+    connection of its own, so it works in transactions too.
+    """
+    keys = set()
+    if uids is not None:
+        uids = list(uids)
+    sql = 'SELECT uid, recurrence_id FROM "%s" WHERE calendar = ?' % Event._meta.db_table
+    for archive in list_archives():
+        archive_conn = sqlite3.connect(archive.path)
+        try:
+            if uids is None:
+                keys.update(archive_conn.execute(sql, (calendar_name,)))
+                continue
+            for i in range(0, len(uids), batch_size):
+                batch = uids[i:i + batch_size]
+                keys.update(archive_conn.execute(
+                    sql + ' AND uid IN (%s)' % ', '.join('?' * len(batch)), [calendar_name] + batch))
+        finally:
+            archive_conn.close()
+    return keys
+
+
+def closed_years():
+    """
+    Returns the years before the current one that have events in the
+    database rather than archived.
+    """
+    year = fn.strftime('%Y', Event.start)
+    query = (Event
+             .select(year)
+             .where(Event.start < datetime(datetime.utcnow().year, 1, 1))
+             .group_by(year)
+             .tuples())
+    return sorted(int(value) for value, in query)
+
+
+def archive_years(years):
+    """
+    Moves the events of the given closed years into archives of a year each,
+    then merges the oldest archives while there are more than MAX_ARCHIVES.
+    Call drop_stale_archives() first, as those would be in the way.
+    """
+    for year in years:
+        write_archive(year, year)
+
+    archives = list_archives()
+    while len(archives) > MAX_ARCHIVES:
+        write_archive(archives[0].first_year, archives[1].last_year)
+        archives = list_archives()
+
+
+def write_archive(first_year, last_year):
+    """
+    Moves the events that start in a run of years, whether in the database
+    or in archives, into a new archive of those years. The archive is
+    written in full, compacted and made read-only before the database
+    changes, so an interruption leaves the events where they were.
+    """
+    start, end = datetime(first_year, 1, 1), datetime(last_year + 1, 1, 1)
+    replaced = archives_between(start, end)
+    first_year = min([first_year] + [archive.first_year for archive in replaced])
+    last_year = max([last_year] + [archive.last_year for archive in replaced])
+    archive = Archive(first_year=first_year, last_year=last_year)
+    start, end = archive.start, archive.end
+
+    path = archive.path + '.tmp'
+    if os.path.exists(path):
+        os.remove(path)
+    # Using() connects to it for the body only
+    archive_db = SqliteDatabase(path)
+    with Using(archive_db, PARTITIONED_MODELS):
+        archive_db.create_tables(PARTITIONED_MODELS)
+
+    events = Event.select(Event.id).where((Event.start >= start) & (Event.start < end))
+    with attached_archives(replaced):
+        conn.execute('ATTACH DATABASE ? AS new_archive', (path,))
+        try:
+            with db.atomic():
+                for model in PARTITIONED_MODELS:
+                    fields = archived_fields(model)
+                    if model is Event:
+                        query = events.select(*fields)
+                    else:
+                        query = model.select(*fields).where(model._meta.fields['event'] << events)
+                    sql, params = query.sql()
+                    db.execute_sql('INSERT INTO new_archive."%s" (%s) %s' % (
+                        model._meta.db_table, ', '.join('"%s"' % field.db_column for field in fields), sql
+                    ), params)
+            archive.events, archive.max_id = db.execute_sql(
+                'SELECT count(*), max(id) FROM new_archive."%s"' % Event._meta.db_table).fetchone()
+            archive.max_id = archive.max_id or 0
+        finally:
+            conn.execute('DETACH DATABASE new_archive')
+
+    archive_conn = sqlite3.connect(path, isolation_level=None)
+    try:
+        archive_conn.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+        archive_conn.execute('VACUUM')
+    finally:
+        archive_conn.close()
+    os.chmod(path, 0o444)
+    os.rename(path, archive.path)
+
+    with db.atomic():
+        for model in (EventTag, EventTrigram, EventDescription):
+            model.delete().where(model.event << events).execute()
+        Event.delete().where((Event.start >= start) & (Event.start < end)).execute()
+        Archive.delete().where(Archive.first_year << [old.first_year for old in replaced]).execute()
+        archive.save()
+
+    for old in replaced:
+        if old.path != archive.path:
+            os.remove(old.path)
+    return archive
+
+
+def restore_archive(archive):
+    """
+    Moves the events of an Archive back into the database, to import
+    changes to them or archive them anew.
+    """
+    conn.execute('ATTACH DATABASE ? AS restored_archive', (archive.path,))
+    try:
+        with db.atomic():
+            for model in PARTITIONED_MODELS:
+                columns = ', '.join('"%s"' % field.db_column for field in archived_fields(model))
+                db.execute_sql('INSERT INTO main."%s" (%s) SELECT %s FROM restored_archive."%s"' % (
+                    model._meta.db_table, columns, columns, model._meta.db_table))
+            archive.delete_instance()
+    finally:
+        conn.execute('DETACH DATABASE restored_archive')
+    os.remove(archive.path)
+
+
+# The API event fields read by Event.fields_from_api_event and
+# store_api_events, to list only those
+API_EVENT_FIELDS = 'id,iCalUID,recurringEventId,originalStartTime,status,summary,description,start,end'
+
+
+def api_event_uid(api_event):
+    """
+    The uid an API event has in the iCal export. Cancelled events from a sync
+    may come without their iCalUID.
+    """
+    if 'iCalUID' in api_event:
+        return api_event['iCalUID']
+    return api_event.get('recurringEventId', api_event['id']) + '@google.com'
+
+
+def normalized_api_time(value):
+    """
+    Converts an API event time - {'dateTime': ..., 'timeZone': ...} or
+    {'date': ...} for all-day events - to a naive datetime like the ones
+    imported from the iCal export, which are in UTC.
+    """
+    if 'date' in value:
+        return normalized(dateutil.parser.parse(value['date']).date())
+
+    dt = parse_api_datetime(value['dateTime'])
+    if dt.tzinfo is None and value.get('timeZone'):
+        dt = dt.replace(tzinfo=tz.gettz(value['timeZone']))
+
+    return normalized(dt).replace(microsecond=0)
+
 
 def normalized(dt):
     # Fix the broken API for ical events - dt may be a date or datetime, so
@@ -165,7 +1387,9 @@ def normalized(dt):
     if not isinstance(dt, datetime):
         dt = datetime.combine(dt, time(0))
 
+    # Store everything as naive UTC - most of the export is in UTC already,
+    # but recurring events come in their own timezone
     if dt.tzinfo is not None:
-        dt = dt.replace(tzinfo=None)
+        dt = dt.astimezone(tz.tzutc()).replace(tzinfo=None)
 
     return dt
@@ -0,0 +1,172 @@
+# coding=utf-8
+"""
+Reading events to import in bulk, from CSV (with a header row) or JSON lines.
+Each row has:
+- "summary": required
+- "start": required - anything dateutil understands; times without an offset
+  are in the configured timezone
+- "end" or "duration" (minutes): optional - default a 0-minute event
+- "description": optional
+
+Every event gets an id derived from its calendar, summary and times, so
+importing the same rows twice (or rows repeated in the input) doesn't
+duplicate them - the copies are skipped, and Google answers 409 for any that
+slip through.
+"""
+from __future__ import absolute_import
+
+import csv
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta
+
+import dateutil.parser
+import six
+from dateutil import tz
+
+FORMATS = ('csv', 'jsonl')
+
+# Tried before falling back to dateutil's much slower guesswork
+FAST_TIME_FORMATS = ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M')
+
+
+class InvalidRow(ValueError):
+    pass
+
+
+def detect_format(path, data):
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ('.jsonl', '.json'):
+        return 'jsonl'
+    if extension == '.csv':
+        return 'csv'
+    return 'jsonl' if data.lstrip()[:1] in (b'{', u'{') else 'csv'
+
+
+def read_rows(data, input_format):
+    """
+    Yields (line number, row dict) for each row of the input. Rows that
+    can't be parsed are yielded as InvalidRow instead of a dict.
+    """
+    lines = data.splitlines(True)
+
+    if input_format == 'jsonl':
+        for line_no, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as exc:
+                yield line_no, InvalidRow("not valid JSON: %s" % exc)
+                continue
+            if not isinstance(row, dict):
+                yield line_no, InvalidRow("expected an object")
+                continue
+            yield line_no, row
+    else:
+        if six.PY2:
+            lines = [line.encode('utf-8') for line in lines]  # Its csv only reads bytes
+        reader = csv.DictReader(lines)
+        for row in reader:
+            if six.PY2:
+                row = dict(
+                    (key.decode('utf-8'), value.decode('utf-8') if value is not None else None)
+                    for key, value in row.items() if key is not None
+                )
+            yield reader.line_num, row
+
+
+def parse_time(value, timezone):
+    """
+    Parses a time, returning it in UTC and as given (with or without offset).
+    """
+    if not isinstance(value, six.string_types) or not value.strip():
+        raise InvalidRow("missing time")
+    for time_format in FAST_TIME_FORMATS:
+        try:
+            dt = datetime.strptime(value, time_format)
+            break
+        except ValueError:
+            pass
+    else:
+        try:
+            dt = dateutil.parser.parse(value)
+        except (ValueError, OverflowError):
+            raise InvalidRow("bad time %r" % value)
+
+    aware = dt if dt.tzinfo is not None else dt.replace(tzinfo=timezone)
+    return aware.astimezone(tz.tzutc()).replace(tzinfo=None), dt
+
+
+def event_body(row, timezone_name):
+    """
+    Validates a row and turns it into the body of an API insert.
+    """
+    summary = (row.get('summary') or '').strip()
+    if not summary:
+        raise InvalidRow("missing summary")
+
+    timezone = tz.gettz(timezone_name)
+    start_utc, start = parse_time(row.get('start'), timezone)
+
+    if row.get('end'):
+        end_utc, end = parse_time(row['end'], timezone)
+    else:
+        try:
+            duration = float(row.get('duration') or 0)
+        except ValueError:
+            raise InvalidRow("bad duration %r" % row['duration'])
+        end_utc, end = start_utc + timedelta(minutes=duration), start + timedelta(minutes=duration)
+
+    if end_utc < start_utc:
+        (start_utc, start), (end_utc, end) = (end_utc, end), (start_utc, start)
+
+    body = {
+        'summary': summary,
+        'start': {'dateTime': start.isoformat(), 'timeZone': timezone_name},
+        'end': {'dateTime': end.isoformat(), 'timeZone': timezone_name},
+        'utc': (start_utc, end_utc),
+    }
+    if row.get('description'):
+        body['description'] = row['description']
+    return body
+
+
+def event_id(calendar_id, body):
+    # Hex is part of base32hex, which event ids must be made of
+    start_utc, end_utc = body['utc']
+    key = json.dumps([calendar_id, body['summary'], start_utc.isoformat(), end_utc.isoformat()])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def prepare(rows, calendar_id, timezone_name):
+    """
+    Turns rows into API insert bodies with deterministic ids, dropping
+    repeated events.
+
+    :return: Tuple of (bodies, errors as (line number, message), number of
+             repeats dropped)
+    """
+    bodies = []
+    errors = []
+    seen = set()
+    repeats = 0
+    for line_no, row in rows:
+        try:
+            if isinstance(row, InvalidRow):
+                raise row
+            body = event_body(row, timezone_name)
+        except InvalidRow as exc:
+            errors.append((line_no, str(exc)))
+            continue
+
+        body['id'] = event_id(calendar_id, body)
+        del body['utc']
+        if body['id'] in seen:
+            repeats += 1
+            continue
+        seen.add(body['id'])
+        bodies.append(body)
+
+    return bodies, errors, repeats
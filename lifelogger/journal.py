@@ -0,0 +1,367 @@
+# coding=utf-8
+"""
+Durable local journal of the events waiting to be written to Google Calendar.
+
+Commands that add events append them here, fsync and return straight away;
+flush() pushes the pending entries to the API later on, in batches, retrying
+with backoff. Inserted events carry a client-generated id, so re-sending one
+whose response got lost is harmless - Google answers 409 and it counts as
+done.
+
+The journal is an append-only JSON lines file, one record per line:
+- {"op": "insert", "id": ..., "calendarId": ..., "body": {...}}
+- {"op": "quickAdd", "id": ..., "calendarId": ..., "text": ...}
+- {"op": "done", "id": ..., "link": ...}
+- {"op": "dropped", "id": ..., "error": ...} for entries the API rejected
+Once everything is done it is compacted back to empty.
+"""
+from __future__ import absolute_import, print_function
+
+import fcntl
+import json
+import os
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+
+from . import bulk
+from .config import DATA_PATH
+
+JOURNAL_PATH = os.path.join(DATA_PATH, "journal.jsonl")
+FLUSH_LOCK_PATH = os.path.join(DATA_PATH, "flush.lock")
+FLUSH_LOG_PATH = os.path.join(DATA_PATH, "flush.log")
+
+# Google Calendar accepts at most 50 requests per batch
+BATCH_SIZE = 50
+MAX_ATTEMPTS = 5
+
+# Whether adding commands spawn a background flush; the daemon turns this
+# off as it flushes by itself
+spawn_flush = True
+
+
+def new_event_id():
+    # Event ids must be 5-1024 characters of base32hex, which hex is part of
+    return uuid.uuid4().hex
+
+
+@contextmanager
+def locked_journal(mode='a+b'):
+    """
+    Opens the journal holding an exclusive lock on it. Retries if it gets
+    compacted (replaced) between opening and locking.
+    """
+    while True:
+        f = open(JOURNAL_PATH, mode)
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            current = os.stat(JOURNAL_PATH)
+        except OSError:
+            current = None
+        if current is not None and current.st_ino == os.fstat(f.fileno()).st_ino:
+            break
+        f.close()
+
+    try:
+        yield f
+    finally:
+        f.close()  # Releases the lock
+
+
+def append(*records):
+    """
+    Durably appends records to the journal.
+    """
+    data = b''.join(json.dumps(record).encode('utf-8') + b'\n' for record in records)
+    with locked_journal() as f:
+        f.seek(0, os.SEEK_END)
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def queue_insert(calendar_id, body):
+    """
+    Journals an event insert, returning its event id.
+    """
+    return queue_inserts(calendar_id, [body])[0]
+
+
+def queue_inserts(calendar_id, bodies):
+    """
+    Journals many event inserts in one write, returning their event ids.
+    Bodies may carry their own (e.g. deterministic) id.
+    """
+    records = []
+    for body in bodies:
+        body = dict(body, id=body.get('id') or new_event_id())
+        records.append({'op': 'insert', 'id': body['id'], 'calendarId': calendar_id, 'body': body})
+    append(*records)
+    return [record['id'] for record in records]
+
+
+def queue_quickadd(calendar_id, text):
+    """
+    Journals a quick add. Unlike inserts these can't carry our id, so if a
+    response gets lost the retry may add the event twice.
+    """
+    entry_id = new_event_id()
+    append({'op': 'quickAdd', 'id': entry_id, 'calendarId': calendar_id, 'text': text})
+    return entry_id
+
+
+def read_records(f):
+    f.seek(0)
+    records = []
+    for line in f:
+        try:
+            records.append(json.loads(line.decode('utf-8')))
+        except ValueError:
+            pass  # Torn write from a crash - the entry never got acknowledged
+    return records
+
+
+def pending_entries(records):
+    finished = set(r['id'] for r in records if r['op'] in ('done', 'dropped'))
+    return [r for r in records if r['op'] in ('insert', 'quickAdd') and r['id'] not in finished]
+
+
+def pending():
+    if not os.path.exists(JOURNAL_PATH):
+        return []
+    with locked_journal() as f:
+        return pending_entries(read_records(f))
+
+
+def compact():
+    """
+    Rewrites the journal keeping only the pending entries.
+    """
+    with locked_journal() as f:
+        entries = pending_entries(read_records(f))
+        tmp_path = JOURNAL_PATH + '.tmp'
+        with open(tmp_path, 'wb') as tmp:
+            for entry in entries:
+                tmp.write(json.dumps(entry).encode('utf-8') + b'\n')
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        os.rename(tmp_path, JOURNAL_PATH)
+
+
+def build_request(service, entry):
+    if entry['op'] == 'insert':
+        return service.events().insert(calendarId=entry['calendarId'], body=entry['body'])
+    else:
+        return service.events().quickAdd(calendarId=entry['calendarId'], text=entry['text'])
+
+
+def classify_error(exc):
+    """
+    Returns 'done', 'retry' or 'drop' for an exception from the API.
+    """
+    from .scheduler import error_status, retryable
+
+    status = error_status(exc)
+    if status is None:
+        return 'retry'  # Network trouble
+    if status == 409:
+        return 'done'  # Our id already exists - an earlier attempt got through
+    if retryable(exc):
+        return 'retry'  # Rate limited or server trouble
+    return 'drop'
+
+
+def backoff(attempt):
+    from .scheduler import backoff_delay
+
+    time.sleep(backoff_delay(attempt))
+
+
+def push_batch(service, entries, created):
+    """
+    Sends entries as one batch request. Safe to call from several threads at
+    once.
+
+    :param created: List the (calendar id, API event) of the events created
+                    get appended to
+    :return: Tuple of (entries to retry, report as (is error, message) pairs)
+    """
+    by_id = dict((entry['id'], entry) for entry in entries)
+    records = []
+    retry = []
+    report = []
+
+    def callback(request_id, response, exception):
+        entry = by_id[request_id]
+        if exception is None:
+            outcome = 'done'
+        else:
+            outcome = classify_error(exception)
+
+        if outcome == 'done':
+            if response is None and entry['op'] == 'insert':
+                # Inserted by an earlier attempt - we know what it holds
+                response = dict(entry['body'], status='confirmed')
+            if response is not None:
+                created.append((entry['calendarId'], response))
+
+            link = (response or {}).get('htmlLink')
+            records.append({'op': 'done', 'id': entry['id'], 'link': link})
+            report.append((False, "Added! >> %s Link: %s" % (describe(entry), link)))
+        elif outcome == 'drop':
+            records.append({'op': 'dropped', 'id': entry['id'], 'error': str(exception)})
+            report.append((True, "Rejected by Google Calendar >> %s %s" % (describe(entry), exception)))
+        else:
+            retry.append(entry)
+
+    from . import scheduler
+
+    batch = service.new_batch_http_request()
+    for entry in entries:
+        batch.add(build_request(service, entry), callback=callback, request_id=entry['id'])
+
+    try:
+        # Each request in the batch counts against the quota; retries are
+        # left to flush(), per entry
+        scheduler.get().call(batch.execute, cost=len(entries), retry=False)
+    except Exception as exc:
+        if classify_error(exc) != 'retry':
+            raise
+        retry = [entry for entry in entries if entry['id'] not in set(r['id'] for r in records)]
+
+    if records:
+        append(*records)
+    return retry, report
+
+
+def write_through(created):
+    """
+    Stores newly created events in the local database and the recent events
+    cache straight away.
+    Failing that is no reason to fail the flush - the next import will pick
+    them up anyway.
+    """
+    from .config import calendar_name
+
+    by_calendar = {}
+    for calendar_id, api_event in created:
+        name = calendar_name(calendar_id)
+        if name is not None:  # Calendars not in the config aren't imported
+            by_calendar.setdefault(name, []).append(api_event)
+
+    if not by_calendar:
+        return
+
+    from . import recent
+    for name, api_events in by_calendar.items():
+        recent.record(name, api_events)
+
+    try:
+        from .database import store_api_events
+        for name, api_events in by_calendar.items():
+            store_api_events(name, api_events)
+    except Exception as exc:
+        print("Warning: could not write new events to the local database:", exc, file=sys.stderr)
+
+
+def describe(entry):
+    if entry['op'] == 'insert':
+        return entry['body'].get('summary', '')
+    return entry['text']
+
+
+@contextmanager
+def flush_lock():
+    """
+    Held while flushing, so only one process pushes the journal at a time.
+    Yields False if another process holds it.
+    """
+    with open(FLUSH_LOCK_PATH, 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            yield False
+        else:
+            yield True
+
+
+def flush(service_factory, batch_size=BATCH_SIZE, max_attempts=MAX_ATTEMPTS, concurrency=None):
+    """
+    Pushes the pending journal entries to Google Calendar.
+
+    :param service_factory: Callable returning the Calendar service - only
+                            called if there is anything to push
+    :param concurrency: Batches in flight at once - see bulk.imap()
+    :return: Number of entries still pending, or None if another process is
+             already flushing
+    """
+    with flush_lock() as acquired:
+        if not acquired:
+            return None
+
+        service = None
+        tried = set()
+        remaining = 0
+        # Entries journaled meanwhile are pushed too, as the flush started
+        # for them finds the lock taken and leaves them to this one
+        while True:
+            entries = [entry for entry in pending() if entry['id'] not in tried]
+            if not entries:
+                return remaining
+            tried.update(entry['id'] for entry in entries)
+
+            if service is None:
+                service = service_factory()
+            remaining += len(push_entries(service, entries, batch_size, max_attempts, concurrency))
+            compact()
+
+
+def push_entries(service, entries, batch_size, max_attempts, concurrency):
+    """
+    Pushes journal entries in batches, retrying those that failed.
+
+    :return: The entries still pending
+    """
+    created = []
+    try:
+        for attempt in range(max_attempts):
+            if attempt:
+                backoff(attempt - 1)
+
+            batches = [entries[i:i + batch_size] for i in range(0, len(entries), batch_size)]
+            retry = []
+            for batch_retry, report in bulk.imap(
+                lambda batch: push_batch(service, batch, created), batches, concurrency
+            ):
+                retry += batch_retry
+                for is_error, message in report:
+                    print(message, file=sys.stderr if is_error else sys.stdout)
+
+            entries = retry
+            if not entries:
+                break
+    finally:
+        # Once for all batches, as refreshing the rollup of the days
+        # touched costs about the same for one event as for many
+        write_through(created)
+    return entries
+
+
+def flush_in_background():
+    """
+    Starts 'lifelogger flush' detached from this process, logging to
+    FLUSH_LOG_PATH.
+    """
+    import subprocess
+
+    with open(FLUSH_LOG_PATH, 'ab') as log:
+        subprocess.Popen(
+            [sys.executable, '-m', 'lifelogger', 'flush'],
+            stdin=open(os.devnull, 'rb'),
+            stdout=log,
+            stderr=log,
+            close_fds=True,
+            preexec_fn=os.setsid,
+            env=dict(os.environ, LIFELOGGER_NO_DAEMON='1'),
+        )
@@ -0,0 +1,169 @@
+# coding=utf-8
+"""
+Reading Nomie backups (https://nomie.io) into Calendar-like events, for the
+sync-nomie command.
+"""
+from __future__ import absolute_import, print_function
+
+import re
+from datetime import datetime, timedelta
+
+
+def parse_events(backup_data):
+    """Parse all events from Nomie backup into a list
+
+    :param backup_data: json-like backup data
+    :return: list of events data
+    """
+
+    # Store tracker metadata, keyed by Nomie id
+    trackers = backup_data['trackers']
+    trackers_dict = {}
+    # Save human-readable label
+    for tracker in trackers:
+        trackers_dict[tracker['_id']] = dict()
+        trackers_dict[tracker['_id']]['label'] = tracker['label']
+
+    # Save groups trackers belong to
+    groups = backup_data['meta'][1]['groups']
+    # NOTE: Below is not really necessary
+    # for group, ids in groups.iteritems():
+    #     for tracker_id in ids:
+    #         if 'groups' not in trackers_dict[tracker_id]:
+    #             # ensure groups list is initialized
+    #             trackers_dict[tracker_id]['groups'] = list()
+    #         # add current group to list for this tracker
+    #         trackers_dict[tracker_id]['groups'].append(group)
+
+    # Set special group colors
+    colors_dict = {
+        'green': '2',
+        'cocoa': '7'  # check log
+    }
+
+    # Support for changing the name of a tracker for a substitute
+    substitutes = {}
+
+    # Event fields: title, startdate, enddate, description
+    events = backup_data['events']
+    calendarEvents = []
+    corruptedCount = 0
+    addedCount = 0
+    for event in events:
+        # Extract needed data
+        try:
+            tracker_id = event['parent']
+            trackername = trackers_dict[tracker_id]['label']
+            # Substitute tracker name if substitute is defined
+            try:
+                trackername = substitutes[trackername]
+            except:
+                doNothing = True
+
+            # As Nomie 3 doesn't support spaces in tracker names, substitute with underscores
+            trackername = trackername.replace(' ', '_')
+            print(trackername)
+
+            # Value should be time in seconds of the event
+            # Note there is one single event for timer (at the end of timer)
+            event_duration = event['value']
+            # Currently automatically convert lack of value to 0
+            if event_duration == None:
+                event_duration = 0
+            timestamp_in_millisecs = event['time']
+            timestamp_in_secs = timestamp_in_millisecs / 1000.0
+
+            # Now build event fields
+            # Time stored is that of end
+            enddate = datetime.fromtimestamp(timestamp_in_secs)
+            # Start date is <value> seconds before the end
+            startdate = enddate - timedelta(seconds=event_duration)
+            duration_str = str(timedelta(seconds=event_duration)).split(".")[0]  # drop microseconds
+            title = '#nomie: ' + trackername
+            description = trackername + ' for ' + duration_str
+
+            # Set event color according to group
+            if tracker_id in groups['Exercise']:
+                color_id = colors_dict['green']
+            else:
+                color_id = None
+
+            toAdd = {
+                'title': title,
+                'startdate': startdate,
+                'enddate': enddate,
+                'description': description,
+                'colorId': color_id,
+                # Metadata
+                'time': timestamp_in_millisecs,
+                'tag': trackername
+            }
+            calendarEvents += [toAdd]
+            addedCount += 1
+        except:
+            corruptedCount += 1
+            print("Shoot! This record seems to be corrupted. Try manually adding it or fixing the file.")
+            print(event)
+
+    print("Corrupted record count: " + str(corruptedCount))
+    print("Events successfully added: " + str(addedCount))
+
+    # Add notes into corresponding event
+    notes = backup_data["notes"]
+    # NOTE: By construction, calendarEvents list is ordered by enddate
+    endtimes = [event['enddate'] for event in calendarEvents]
+    assert all(a < b for a, b in zip(endtimes, endtimes[1:]))
+
+    event_iter = iter(calendarEvents)
+    current_event = event_iter.next()
+    for note in notes:
+        # Advance event until timestamp is larger or raise exemption
+        while current_event['time'] < note['time']:
+            previous_event = current_event
+            try:
+                current_event = event_iter.next()
+            except StopIteration as err:
+                # End of events list reached
+                break
+        # At this point, previous_event should match current note
+
+        # Parse note value
+        lines = note['value'].splitlines()
+        if len(lines) < 2:
+            print("Bad note value (single line? -> Empty content?): \n %s" % note['value'])
+            continue
+        note_header = lines[0]
+        note_short = lines[1]
+        note_long = '\n'.join(lines[2:])
+
+        # Check tag
+        r = re.compile('#(?P<tag>\w+) ((?P<h>\d+)h )*((?P<m>\d+)m )*((?P<s>\d+)s )*\s+at (?P<time_str>\d\d:\d\d)')
+        out = r.match(note_header)
+        if out is None:
+            print("ERROR: Bad parsing of %s" % note_header)
+        parsed_values = out.groupdict()
+        assert parsed_values['tag'].lower() == previous_event['tag'].lower()
+
+        # Add note content to event summary and description
+        previous_event['title'] += " " + note_short
+        previous_event['description'] += "\n" + note_long
+
+    return calendarEvents
+
+
+def event_id(event):
+    """Unique Calendar event id of a Nomie event, based on its data
+    """
+    return 'nomie' + event['startdate'].strftime('%Y%m%d%H%M%S')
+
+
+def new_events(events):
+    """Keep only the events not in the local database yet
+
+    :param events: list of events from parse_events()
+    :return: list of the new events, in order
+    """
+    from .database import stored_uids
+
+    stored = stored_uids('Nomie', (event_id(event) + "@google.com" for event in events))
+    return [event for event in events if event_id(event) + "@google.com" not in stored]
@@ -0,0 +1,131 @@
+# coding=utf-8
+"""
+Scans of the events on several processes at once, for queries SQLite can
+only answer by calling back into Python - REGEXP, MEASUREMENT - for every
+row, which it does on a single core.
+
+The events are split into ranges of ids, more than there are workers so
+those finishing early take on more - ranges of the database and of each
+attached archive, see database.select_by_partition(). Each worker process
+opens its own read-only connection to the database, attaching the same
+archives as the parent's, and runs the query on one range at a time, and
+the results of all ranges are merged back in order of start.
+"""
+from __future__ import absolute_import
+
+import multiprocessing
+import signal
+import sqlite3
+import time
+
+from . import database
+from .bulk import WAIT_TIMEOUT
+from .config import DB_PATH
+from .database import PROGRESS_INTERVAL, Event, measurement, regex_matches, union_views, unpack_description
+from .utils import QueryTimeout
+
+# Ranges of events per worker
+RANGES_PER_JOB = 4
+
+# Set in worker processes
+_conn = None
+
+
+def open_connection(archives):
+    """Pool initializer giving each worker its own connection
+
+    :param archives: (alias, path) of the archives to attach
+    """
+    global _conn
+    # Ctrl-C is for the parent to handle
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _conn = sqlite3.connect(DB_PATH)
+    for alias, path in archives:
+        _conn.execute('ATTACH DATABASE ? AS "%s"' % alias, (path,))
+    _conn.execute('PRAGMA query_only = ON')
+    _conn.create_function('REGEXP', 2, regex_matches)
+    _conn.create_function('MEASUREMENT', 2, measurement)
+    _conn.create_function('DESCRIPTION', 2, unpack_description)
+
+
+def scan(task):
+    """
+    Runs a range's query in a worker, returning its rows as Python values.
+    """
+    schema, sql, params, field_names, deadline = task
+    # Temporary views are writes too
+    _conn.execute('PRAGMA query_only = OFF')
+    union_views(_conn, [schema])
+    _conn.execute('PRAGMA query_only = ON')
+    if deadline is not None:
+        _conn.set_progress_handler(lambda: time.time() > deadline, PROGRESS_INTERVAL)
+    try:
+        rows = _conn.execute(sql, params).fetchall()
+    except sqlite3.OperationalError as exc:
+        if deadline is not None and time.time() > deadline and 'interrupted' in str(exc):
+            raise QueryTimeout("Query aborted after its timeout")
+        raise
+    finally:
+        _conn.set_progress_handler(None, PROGRESS_INTERVAL)
+
+    converters = [Event._meta.fields[name].python_value for name in field_names]
+    return [[convert(value) for convert, value in zip(converters, row)] for row in rows]
+
+
+def id_ranges(count, schema='main'):
+    """
+    Splits the ids of the events in a schema into up to count (lowest,
+    highest) ranges.
+    """
+    lowest, highest = database.db.execute_sql(
+        'SELECT min(id), max(id) FROM "%s"."%s"' % (schema, Event._meta.db_table)).fetchone()
+    if lowest is None:
+        return []
+    total = highest - lowest + 1
+    bounds = sorted(set(lowest + total * i // count for i in range(count + 1)))
+    return [(start, end - 1) for start, end in zip(bounds, bounds[1:])]
+
+
+def select(query, jobs, timeout=None):
+    """
+    Returns the Events a query on Event selects, ordered by start, running
+    it on jobs processes at once.
+
+    :param query: SelectQuery of Event, whose other ordering is ignored
+    :param timeout: Seconds after which to abort, raising QueryTimeout
+    """
+    fields = Event._meta.sorted_fields
+    field_names = [field.name for field in fields]
+    query = query.select(*fields)
+    deadline = time.time() + timeout if timeout else None
+
+    tasks = []
+    schemas = database.partitions()
+    for schema in schemas:
+        for lowest, highest in id_ranges(max(jobs * RANGES_PER_JOB // len(schemas), 1), schema):
+            sql, params = query.where(Event.id.between(lowest, highest)).sql()
+            tasks.append((schema, sql, params, field_names, deadline))
+
+    events = []
+    archives = [(archive.alias, archive.path) for archive in database.attached]
+    pool = multiprocessing.Pool(jobs, initializer=open_connection, initargs=(archives,))
+    try:
+        results = pool.imap_unordered(scan, tasks)
+        for _ in tasks:
+            # With a timeout, so Ctrl-C gets through on Python 2, and a
+            # worker stuck in one long REGEXP call can't overrun the deadline
+            wait = WAIT_TIMEOUT if deadline is None else max(deadline - time.time(), 0)
+            try:
+                rows = results.next(wait)
+            except multiprocessing.TimeoutError:
+                raise QueryTimeout("Query aborted after its %gs timeout" % timeout)
+            for values in rows:
+                events.append(Event(**dict(zip(field_names, values))))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    # Ties as SQLite orders them, by id
+    events.sort(key=lambda event: (event.start, event.id))
+    return events
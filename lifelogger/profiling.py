@@ -0,0 +1,167 @@
+# coding=utf-8
+"""
+Per-phase timing for the global --profile option: wall time, CPU time and
+peak memory of named phases of a command (downloading, parsing the iCal
+file, importing into the database, querying, printing...), reported as a
+table on stderr and as JSON.
+
+Code marks its phases with `with phase('name'):`, which costs next to
+nothing unless profiling is on. Phases may nest, repeat (their numbers add
+up) and run on several threads at once. CPU time is the whole process's,
+and peak memory comes from tracemalloc where there is one (Python 3), or
+else is the peak resident size of the process so far.
+"""
+from __future__ import absolute_import, division
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Set while profiling
+_profile = None
+
+
+def cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def peak_memory():
+    """Peak memory use in bytes since the last reset, or None if unknown
+    """
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[1]
+    if resource is not None:
+        # Kilobytes on Linux, bytes on macOS
+        scale = 1 if os.uname()[0] == 'Darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    return None
+
+
+class Phase(object):
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.peak = None
+
+    def as_dict(self):
+        return OrderedDict([
+            ('name', self.name),
+            ('calls', self.calls),
+            ('wall_seconds', round(self.wall, 6)),
+            ('cpu_seconds', round(self.cpu, 6)),
+            ('peak_bytes', self.peak),
+        ])
+
+
+class Profile(object):
+    def __init__(self):
+        self.phases = OrderedDict()
+        self.open = []  # Phases running now, innermost last
+        self.lock = threading.Lock()
+        self.memory = 'tracemalloc' if tracemalloc is not None else 'maxrss'
+
+    def note_peak(self):
+        """
+        Credit the peak since the last reset to every phase still running,
+        so nested phases can each track their own peak.
+        """
+        peak = peak_memory()
+        if peak is None:
+            return
+        for entry in self.open:
+            entry.peak = max(entry.peak or 0, peak)
+        if tracemalloc is not None and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+
+    @contextmanager
+    def phase(self, name):
+        with self.lock:
+            entry = self.phases.get(name)
+            if entry is None:
+                entry = self.phases[name] = Phase(name)
+            self.note_peak()
+            self.open.append(entry)
+        start_wall, start_cpu = time.time(), cpu_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.time() - start_wall, cpu_time() - start_cpu
+            with self.lock:
+                self.note_peak()
+                self.open.remove(entry)
+                entry.calls += 1
+                entry.wall += wall
+                entry.cpu += cpu
+
+    def record(self, name, wall, cpu):
+        """Add a phase timed some other way
+        """
+        with self.lock:
+            entry = self.phases.setdefault(name, Phase(name))
+            entry.calls += 1
+            entry.wall += wall
+            entry.cpu += cpu
+
+    def as_dict(self):
+        return OrderedDict([
+            ('memory', self.memory),
+            ('phases', [entry.as_dict() for entry in self.phases.values()]),
+        ])
+
+    def write_table(self, stream):
+        stream.write("%-28s %6s %10s %10s %10s\n" % ("phase", "calls", "wall s", "cpu s", "peak MB"))
+        for entry in self.phases.values():
+            peak = "%10.1f" % (entry.peak / 1024 / 1024) if entry.peak is not None else "%10s" % '-'
+            stream.write("%-28s %6d %10.3f %10.3f %s\n" % (
+                entry.name[:28], entry.calls, entry.wall, entry.cpu, peak))
+        stream.write("(peak memory from %s)\n" % self.memory)
+
+
+@contextmanager
+def phase(name):
+    """Time the body as the phase name, if profiling
+    """
+    if _profile is None:
+        yield
+        return
+    with _profile.phase(name):
+        yield
+
+
+def start():
+    global _profile
+    if tracemalloc is not None:
+        tracemalloc.start()
+    _profile = Profile()
+    return _profile
+
+
+def stop():
+    global _profile
+    profile, _profile = _profile, None
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    return profile
+
+
+def save(profile, path, **extra):
+    data = OrderedDict(extra)
+    data.update(profile.as_dict())
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
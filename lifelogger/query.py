@@ -0,0 +1,337 @@
+# coding=utf-8
+"""
+A small query language for picking events, compiled into a condition on
+Event that SQLite can mostly answer from its indexes:
+
+    #exercise and not #cont in:2018-03 kg > 50
+    (#run or #ride) duration >= 30m since:2018-01-01
+    description:"knee pain" or /^#weight \\d+/
+
+Terms:
+- #tag: events tagged so, looked up in the EventTag index
+- word or "some words": text in the summary, ignoring case
+- /regex/: regex search on the summary, run only on the events holding
+  the trigrams it needs (see trigrams.py)
+- summary:..., description:...: a word, phrase, tag or regex in that field
+- calendar:NAME: events in that calendar
+- in:DATE, since:DATE, until:DATE: events starting in a year (2018), month
+  (2018-03) or day (2018-03-05), from it on, or up to it (inclusive)
+- duration OP N[s|m|h|d]: duration comparison, in minutes by default
+- kg/mg/percentage OP N: measurement comparison, e.g. kg > 50
+
+Terms next to each other must all match; combine them with and, or, not
+(or -term) and parentheses.
+
+query_span() works out the dates a query is limited to, so only the archives
+of those years need attaching.
+"""
+from __future__ import absolute_import
+
+import re
+from datetime import datetime, timedelta
+
+from peewee import fn
+
+from .database import (
+    DESCRIPTION_TEXT, MEASUREMENT_UNITS, Event, EventTag, description_condition, regex_search
+)
+
+TOKEN_RE = re.compile(r'''
+    \s*(?:
+        (?P<paren>[()])
+      | (?P<op><=|>=|!=|<|>|=)
+      | (?P<regex>/(?:[^/\\]|\\.)*/)
+      | (?P<quoted>"(?:[^"\\]|\\.)*")
+      | (?P<word>\w+:(?=[/"])|[^\s()<>=!"]+)
+    )
+''', re.VERBOSE)
+
+FIELD_RE = re.compile(r'^(\w+):(.*)$')
+TAG_RE = re.compile(r'^#\w+')
+
+TEXT_FIELDS = {
+    'summary': 'summary',
+    'description': 'description',
+    'desc': 'description',
+}
+
+FIELDS = tuple(TEXT_FIELDS) + ('calendar', 'in', 'since', 'until')
+
+DATE_FORMATS = (('%Y-%m-%d', 'day'), ('%Y-%m', 'month'), ('%Y', 'year'))
+
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+
+OPERATORS = {
+    '<': lambda lhs, rhs: lhs < rhs,
+    '<=': lambda lhs, rhs: lhs <= rhs,
+    '>': lambda lhs, rhs: lhs > rhs,
+    '>=': lambda lhs, rhs: lhs >= rhs,
+    '=': lambda lhs, rhs: lhs == rhs,
+    '!=': lambda lhs, rhs: lhs != rhs,
+}
+
+
+class QuerySyntaxError(ValueError):
+    pass
+
+
+def tokenize(text):
+    """
+    Splits a query into (kind, value) tokens, kind being one of 'paren',
+    'op', 'regex', 'quoted' and 'word'.
+    """
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = TOKEN_RE.match(text, position)
+        if match is None:
+            raise QuerySyntaxError("can't make sense of %r" % text[position:])
+        position = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'regex':
+            value = value[1:-1].replace('\\/', '/')
+        elif kind == 'quoted':
+            value = re.sub(r'\\(.)', r'\1', value[1:-1])
+        tokens.append((kind, value))
+    return tokens
+
+
+def parse_date(value):
+    """
+    Returns the start and end (exclusive) of the year, month or day a date
+    like 2018, 2018-03 or 2018-03-05 stands for.
+    """
+    for date_format, period in DATE_FORMATS:
+        try:
+            start = datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+        if period == 'day':
+            return start, start + timedelta(days=1)
+        if period == 'month':
+            return start, (start + timedelta(days=32)).replace(day=1)
+        return start, start.replace(year=start.year + 1)
+    raise QuerySyntaxError("bad date %r - expected YYYY, YYYY-MM or YYYY-MM-DD" % value)
+
+
+def contains(field, text):
+    return fn.instr(fn.lower(field), text.lower()) > 0
+
+
+class Parser(object):
+    """
+    Recursive descent parser of the grammar:
+
+        query := and ('or' and)*
+        and := not (['and'] not)*
+        not := ('not' | '-') not | '(' query ')' | term
+    """
+
+    def __init__(self, text):
+        self.tokens = tokenize(text)
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None, None
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise QuerySyntaxError("unexpected end of query")
+        self.position += 1
+        return token
+
+    def keyword(self, word):
+        kind, value = self.peek()
+        if kind == 'word' and value.lower() == word:
+            self.position += 1
+            return True
+        return False
+
+    def parse(self):
+        if not self.tokens:
+            raise QuerySyntaxError("empty query")
+        condition = self.parse_or()
+        if self.peek()[0] is not None:
+            raise QuerySyntaxError("unexpected %r" % self.peek()[1])
+        return condition
+
+    def parse_or(self):
+        condition = self.parse_and()
+        while self.keyword('or'):
+            condition = condition | self.parse_and()
+        return condition
+
+    def parse_and(self):
+        condition = self.parse_not()
+        while True:
+            kind, value = self.peek()
+            if kind is None or (kind, value) == ('paren', ')') or \
+                    (kind == 'word' and value.lower() == 'or'):
+                return condition
+            self.keyword('and')
+            condition = condition & self.parse_not()
+
+    def parse_not(self):
+        if self.keyword('not'):
+            return ~self.parse_not()
+
+        kind, value = self.next()
+        if kind == 'word' and value.startswith('-') and len(value) > 1:
+            return ~self.term(kind, value[1:])
+        if (kind, value) == ('paren', '('):
+            condition = self.parse_or()
+            if self.next() != ('paren', ')'):
+                raise QuerySyntaxError("missing )")
+            return condition
+        return self.term(kind, value)
+
+    def term(self, kind, value):
+        if kind == 'word':
+            if self.peek()[0] == 'op':
+                return self.comparison(value)
+
+            match = FIELD_RE.match(value)
+            if match is not None and match.group(1).lower() in FIELDS:
+                name, argument = match.groups()
+                if not argument:
+                    # Field applying to the next token, e.g. description:"a b"
+                    kind, argument = self.next()
+                else:
+                    kind = 'word'
+                return self.field(name.lower(), kind, argument)
+
+        return self.text('summary', kind, value)
+
+    def text(self, name, kind, value):
+        if kind == 'regex':
+            return regex_search(name, value)
+        if kind == 'word' and name == 'summary' and TAG_RE.match(value):
+            tag = TAG_RE.match(value).group(0).lower()
+            return Event.id << EventTag.select(EventTag.event).where(EventTag.tag == tag)
+        if kind in ('word', 'quoted'):
+            if name == 'summary':
+                return contains(Event.summary, value)
+            return description_condition(contains(DESCRIPTION_TEXT, value))
+        raise QuerySyntaxError("expected text, got %r" % value)
+
+    def field(self, name, kind, value):
+        if name in TEXT_FIELDS:
+            return self.text(TEXT_FIELDS[name], kind, value)
+        if name == 'calendar':
+            return Event.calendar == value
+        if name == 'in':
+            start, end = parse_date(value)
+            return (Event.start >= start) & (Event.start < end)
+        if name == 'since':
+            return Event.start >= parse_date(value)[0]
+        if name == 'until':
+            return Event.start < parse_date(value)[1]
+
+    def comparison(self, name):
+        operator = OPERATORS[self.next()[1]]
+        kind, value = self.next()
+        name = name.lower()
+
+        if name == 'duration':
+            match = re.match(r'^([0-9.]+)([smhd]?)$', value)
+            if match is None:
+                raise QuerySyntaxError("bad duration %r - expected e.g. 90, 90m or 1.5h" % value)
+            seconds = float(match.group(1)) * DURATION_UNITS[match.group(2) or 'm']
+            duration = (fn.julianday(Event.end) - fn.julianday(Event.start)) * (24 * 60 * 60)
+            # Round off the floating point error of julianday
+            return operator(fn.round(duration, 3), seconds)
+
+        if name in MEASUREMENT_UNITS:
+            try:
+                number = float(value)
+            except ValueError:
+                raise QuerySyntaxError("bad number %r" % value)
+            # Only parse the summaries that can hold such a measurement, and
+            # make those without one a plain no rather than NULL, so that
+            # 'not' picks them
+            marker = '%' if name == 'percentage' else name
+            return (fn.instr(Event.summary, marker) > 0) & \
+                fn.coalesce(operator(fn.measurement(Event.summary, name), number), 0)
+
+        raise QuerySyntaxError("can't compare %r - try duration, %s" % (name, ', '.join(MEASUREMENT_UNITS)))
+
+
+def compile_query(text):
+    """
+    Compiles a query into a condition on Event.
+
+    :raises QuerySyntaxError: If the query is malformed
+    """
+    return Parser(text).parse()
+
+
+def later(*dates):
+    dates = [date for date in dates if date is not None]
+    return max(dates) if dates else None
+
+
+def earlier(*dates):
+    dates = [date for date in dates if date is not None]
+    return min(dates) if dates else None
+
+
+class Span(object):
+    """
+    Bounds on the start of the events a query can pick, from start to end
+    (exclusive) - None for no bound. Combines like conditions, so
+    SpanParser can work it out with Parser's grammar.
+    """
+
+    def __init__(self, start=None, end=None):
+        self.start = start
+        self.end = end
+
+    def __and__(self, other):
+        return Span(later(self.start, other.start), earlier(self.end, other.end))
+
+    def __or__(self, other):
+        return Span(None if None in (self.start, other.start) else earlier(self.start, other.start),
+                    None if None in (self.end, other.end) else later(self.end, other.end))
+
+    def __invert__(self):
+        return Span()
+
+
+class SpanParser(Parser):
+    """
+    Parses a query into its Span rather than its condition.
+    """
+
+    def text(self, name, kind, value):
+        Parser.text(self, name, kind, value)
+        return Span()
+
+    def field(self, name, kind, value):
+        if name == 'in':
+            return Span(*parse_date(value))
+        if name == 'since':
+            return Span(start=parse_date(value)[0])
+        if name == 'until':
+            return Span(end=parse_date(value)[1])
+        Parser.field(self, name, kind, value)
+        return Span()
+
+    def comparison(self, name):
+        Parser.comparison(self, name)
+        return Span()
+
+
+def query_span(text):
+    """
+    Returns the (start, end) datetimes the starts of the events a query picks
+    are limited to - None for no bound.
+
+    :raises QuerySyntaxError: If the query is malformed
+    """
+    span = SpanParser(text).parse()
+    return span.start, span.end
@@ -0,0 +1,149 @@
+# coding=utf-8
+"""
+Small local cache of the latest events on the lifelogger calendar, answering
+"when did the last event end" (new's 'last' keyword) and "what were the last
+N summaries" (cont's picker) without a round trip to Google.
+
+It is fed by write-through of the events lifelogger creates, and refreshed
+from a narrow API query (only the fields used, bounded, ordered) whenever it
+is older than the "recent_max_age" config field (in minutes), as events can
+also be added from other devices.
+"""
+from __future__ import absolute_import
+
+import json
+import os
+from datetime import datetime, timedelta
+
+import dateutil.parser
+from dateutil import tz
+
+from .config import DATA_PATH, config, write_atomically
+from .utils import parse_api_datetime
+
+RECENT_PATH = os.path.join(DATA_PATH, "recent.json")
+
+CALENDAR = 'lifelogger'
+
+# How far back the cache (and the API query refreshing it) looks
+WINDOW = timedelta(days=2)
+MAX_EVENTS = 250
+DEFAULT_MAX_AGE = 30  # minutes
+
+FIELDS = 'summary,start,end,updated,status'
+
+
+def load():
+    try:
+        with open(RECENT_PATH) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {'refreshed': None, 'events': []}
+
+
+def save(data):
+    write_atomically(RECENT_PATH, json.dumps(data).encode('utf-8'))
+
+
+def is_stale(data):
+    if data['refreshed'] is None:
+        return True
+    max_age = timedelta(minutes=config.get('recent_max_age', DEFAULT_MAX_AGE))
+    return datetime.utcnow() - dateutil.parser.parse(data['refreshed']) > max_age
+
+
+def parse_time(value):
+    """
+    Converts an API event time to a naive datetime in local time.
+    """
+    if 'date' in value:
+        return dateutil.parser.parse(value['date'])
+
+    dt = parse_api_datetime(value['dateTime'])
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=tz.gettz(value.get('timeZone')) or tz.tzlocal())
+    return dt.astimezone(tz.tzlocal()).replace(tzinfo=None)
+
+
+def trimmed(events):
+    """
+    Keeps the events inside the window, most recently updated first.
+    """
+    oldest = datetime.now() - WINDOW
+    events = [e for e in events if e.get('status') != 'cancelled' and parse_time(e['end']) > oldest]
+    events.sort(key=lambda e: e.get('updated', ''), reverse=True)
+    return events[:MAX_EVENTS]
+
+
+def refresh(service):
+    """
+    Replaces the cache with the latest events from the API.
+    """
+    from .connection import PagedList
+
+    # Ordered by last update, oldest first, so all pages are needed to get
+    # the latest
+    now = datetime.utcnow()
+    events = list(PagedList(
+        service.events().list,
+        fields=FIELDS,
+        calendarId=config['calendars'][CALENDAR]['id'],
+        timeMin=(now - WINDOW).isoformat() + "Z",
+        timeMax=now.isoformat() + "Z",
+        orderBy="updated",
+        maxResults=MAX_EVENTS,
+    ))
+
+    data = {'refreshed': now.isoformat(), 'events': trimmed(events)}
+    save(data)
+    return data
+
+
+def record(calendar_name, api_events):
+    """
+    Adds events just created on a calendar, keeping the cache current
+    without waiting for a refresh.
+    """
+    if calendar_name != CALENDAR or not api_events:
+        return
+
+    data = load()
+    updated = datetime.utcnow().isoformat() + "Z"
+    for api_event in api_events:
+        data['events'].append(dict(
+            (key, api_event[key]) for key in ('summary', 'start', 'end', 'status') if key in api_event
+        ))
+        data['events'][-1]['updated'] = api_event.get('updated', updated)
+    data['events'] = trimmed(data['events'])
+    save(data)
+
+
+def recent_events(service_factory):
+    """
+    Returns the cached events that started before now, refreshing them first
+    if stale.
+
+    :param service_factory: Callable returning the Calendar service - only
+                            called when a refresh is needed
+    """
+    data = load()
+    if is_stale(data):
+        data = refresh(service_factory())
+
+    now = datetime.now()
+    return [e for e in data['events'] if parse_time(e['start']) <= now]
+
+
+def latest_end(service_factory):
+    """
+    End time (local) of the last event that started before now, or None.
+    """
+    ends = [parse_time(e['end']) for e in recent_events(service_factory)]
+    return max(ends) if ends else None
+
+
+def last_summaries(num, service_factory):
+    """
+    Summaries of the num most recently updated events, newest first.
+    """
+    return [e.get('summary', '') for e in recent_events(service_factory)[:num]]
@@ -0,0 +1,223 @@
+# coding=utf-8
+"""
+Central scheduler for Calendar API requests. Every request made through the
+service from connection.connect() goes through it, which:
+- paces requests with a token bucket, halving the rate whenever Google
+  answers with a rate limit error and creeping back up as requests succeed
+- retries rate limit (403/429) and server (5xx) errors with jittered
+  exponential backoff, honouring Retry-After - server errors only for calls
+  that are safe to repeat, as the first try may have gone through
+- bounds how many requests are in flight at once, across threads
+- accounts the quota (requests, batched ones included) used by the run
+
+Settings live under the "api" key of the config file:
+- "rate": requests per second, default 10 - Google's default quota is 600
+  requests per minute per user
+- "burst": requests allowed at once after a quiet spell, default 10
+- "max_in_flight": concurrent requests, default 4
+- "max_retries": retries per request, default 5
+"""
+from __future__ import absolute_import
+
+import json
+import logging
+import random
+import threading
+import time
+
+from .config import config
+from .profiling import phase
+
+log = logging.getLogger(__name__)
+
+DEFAULT_RATE = 10.0
+DEFAULT_BURST = 10
+DEFAULT_MAX_IN_FLIGHT = 4
+DEFAULT_MAX_RETRIES = 5
+
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+# Slowest the bucket gets throttled down to, and how much of the configured
+# rate each success wins back
+MIN_RATE = 0.5
+RECOVERY = 0.05
+
+# 403 reasons meaning "slow down" rather than "not allowed"
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+USAGE_COUNTERS = ('requests', 'retries', 'throttled', 'failed')
+
+
+def backoff_delay(attempt):
+    """Seconds to wait before retry number attempt (from 0), with jitter
+    """
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+    return delay * random.uniform(0.5, 1.5)
+
+
+def error_status(exc):
+    """HTTP status of an API error, or None for other exceptions
+    """
+    from googleapiclient.errors import HttpError
+
+    if not isinstance(exc, HttpError):
+        return None
+    return int(exc.resp.status)
+
+
+def error_reason(exc):
+    try:
+        content = exc.content
+        if not isinstance(content, str):
+            content = content.decode('utf-8')
+        return json.loads(content)['error']['errors'][0]['reason']
+    except (AttributeError, ValueError, KeyError, IndexError, TypeError):
+        return None
+
+
+def rate_limited(exc):
+    status = error_status(exc)
+    return status == 429 or (status == 403 and error_reason(exc) in RATE_LIMIT_REASONS)
+
+
+def retryable(exc):
+    """Whether an API error is worth retrying - rate limits and server trouble
+    """
+    status = error_status(exc)
+    return status is not None and (rate_limited(exc) or status >= 500)
+
+
+def retry_after(exc):
+    try:
+        return float(exc.resp.get('retry-after', 0))
+    except (AttributeError, ValueError):
+        return 0.0
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket. Callers reserve tokens in turn, going into debt
+    if need be, and sleep until their reservation is covered - so a request
+    costing more than the burst (e.g. a big batch) still gets through, at the
+    right pace.
+    """
+
+    def __init__(self, rate, burst):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """Wait until tokens are available
+
+        :return: Seconds waited
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= tokens
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+        if delay:
+            time.sleep(delay)
+        return delay
+
+    def slow_down(self):
+        with self.lock:
+            self.rate = max(MIN_RATE, self.rate / 2)
+
+    def speed_up(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * RECOVERY)
+
+
+class Scheduler(object):
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST,
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT, max_retries=DEFAULT_MAX_RETRIES):
+        self.bucket = TokenBucket(rate, burst)
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.max_retries = max_retries
+        self.lock = threading.Lock()
+        self.reset_usage()
+
+    def reset_usage(self):
+        with self.lock:
+            self.usage = dict((counter, 0) for counter in USAGE_COUNTERS)
+            self.usage['waited'] = 0.0
+
+    def count(self, counter, amount=1):
+        with self.lock:
+            self.usage[counter] += amount
+
+    def call(self, func, cost=1, retry=True, idempotent=True):
+        """Run an API call when the rate allows, retrying it on rate limit
+        and server errors
+
+        :param func: Callable making the request
+        :param cost: Quota units used, e.g. the number of requests in a batch
+        :param retry: Whether to retry - off for calls whose caller retries
+                      (or not) by itself, like journal batches
+        :param idempotent: Whether repeating the call is harmless - if not,
+                           only rate limit errors are retried, as those are
+                           answered before doing anything
+        :return: Whatever func returns
+        """
+        attempt = 0
+        while True:
+            self.count('waited', self.bucket.acquire(cost))
+            with self.in_flight:
+                self.count('requests', cost)
+                try:
+                    with phase('api'):
+                        result = func()
+                except Exception as exc:
+                    if rate_limited(exc):
+                        self.bucket.slow_down()
+                        self.count('throttled')
+                    if (not retry or attempt >= self.max_retries or not retryable(exc) or
+                            not (idempotent or rate_limited(exc))):
+                        self.count('failed')
+                        raise
+                    delay = max(backoff_delay(attempt), retry_after(exc))
+                    status = error_status(exc)  # exc is unbound after this block on Python 3
+                else:
+                    self.bucket.speed_up()
+                    return result
+
+            log.info("API error %s, retrying in %.1fs (rate now %.1f/s)",
+                     status, delay, self.bucket.rate)
+            self.count('retries')
+            time.sleep(delay)
+            attempt += 1
+
+    def log_usage(self):
+        if self.usage['requests']:
+            log.info(
+                "API quota used: %(requests)d requests, %(retries)d retries, "
+                "%(throttled)d rate limited, %(failed)d failed, %(waited).1fs waiting",
+                self.usage
+            )
+
+
+_scheduler = None
+
+
+def get():
+    """The process-wide scheduler, set up from the config on first use
+    """
+    global _scheduler
+    if _scheduler is None:
+        settings = config.get('api', {})
+        _scheduler = Scheduler(
+            rate=settings.get('rate', DEFAULT_RATE),
+            burst=settings.get('burst', DEFAULT_BURST),
+            max_in_flight=settings.get('max_in_flight', DEFAULT_MAX_IN_FLIGHT),
+            max_retries=settings.get('max_retries', DEFAULT_MAX_RETRIES),
+        )
+    return _scheduler
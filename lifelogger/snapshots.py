@@ -0,0 +1,358 @@
+# coding=utf-8
+"""
+History of the downloaded iCal files, kept as snapshots in a content-addressed
+store (SNAPSHOT_PATH) that only grows by what changed since the last one.
+
+A file is cut into chunks - one per VEVENT, plus whatever comes before,
+between and after them - each stored once under its SHA-1, however many
+snapshots hold it. New chunks are zlib-compressed together in packs of up to
+PACK_SIZE bytes, as a single VEVENT is too small to compress well.
+
+The list of a snapshot's chunk hashes is cut into pages in turn - after each
+hash that ends in a multiple of PAGE_FANOUT, so a change only moves the
+boundaries around it - stored as chunks, and so on up to a single root hash.
+So a stretch of unchanged events costs nothing either.
+
+Google stamps every event of an export with the time of the export
+(DTSTAMP), which would make every chunk new each day: the stamp shared by a
+snapshot's events is kept with the snapshot instead and put back on loading,
+so files come back byte for byte.
+"""
+from __future__ import absolute_import
+
+import collections
+import hashlib
+import re
+import sqlite3
+import zlib
+from datetime import datetime
+
+import six
+
+from .config import SNAPSHOT_PATH
+
+# Uncompressed bytes of new chunks compressed together
+PACK_SIZE = 1024 * 1024
+
+# Average number of hashes per page
+PAGE_FANOUT = 64
+
+HASH_SIZE = 20
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS pack (
+    id INTEGER PRIMARY KEY,
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chunk (
+    hash BLOB PRIMARY KEY,
+    pack INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS snapshot (
+    id INTEGER PRIMARY KEY,
+    calendar TEXT NOT NULL,
+    taken TEXT NOT NULL,
+    root BLOB NOT NULL,
+    height INTEGER NOT NULL,
+    dtstamp BLOB,
+    size INTEGER NOT NULL,
+    events INTEGER NOT NULL,
+    stored INTEGER NOT NULL,
+    sha1 TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS snapshot_calendar ON snapshot (calendar, id);
+'''
+
+SNAPSHOT_FIELDS = ('id', 'calendar', 'taken', 'root', 'height', 'dtstamp', 'size', 'events', 'stored', 'sha1')
+
+BLOB_FIELDS = ('root', 'dtstamp')
+
+Snapshot = collections.namedtuple('Snapshot', SNAPSHOT_FIELDS)
+
+VEVENT_RE = re.compile(br'^BEGIN:VEVENT\r?$.*?^END:VEVENT\r?(?:\n|\Z)', re.M | re.S)
+DTSTAMP_RE = re.compile(br'^DTSTAMP:([^\r\n]*)\r?$', re.M)
+
+# Takes the place of the shared DTSTAMP line - not a valid content line, as
+# it has no colon, so it can't be mistaken for one
+STAMP_MARKERS = (b'\nDTSTAMP\r\n', b'\nDTSTAMP\n')
+
+
+def connect():
+    conn = sqlite3.connect(SNAPSHOT_PATH)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def digest(chunk):
+    return hashlib.sha1(chunk).digest()
+
+
+def split_chunks(data):
+    """
+    Cuts iCal data into its VEVENTs and the pieces around them, which join
+    back into the same data.
+    """
+    chunks = []
+    position = 0
+    for match in VEVENT_RE.finditer(data):
+        if match.start() > position:
+            chunks.append(data[position:match.start()])
+        chunks.append(match.group(0))
+        position = match.end()
+    if position < len(data):
+        chunks.append(data[position:])
+    return chunks
+
+
+def is_event(chunk):
+    return chunk.startswith(b'BEGIN:VEVENT')
+
+
+def shared_stamp(data):
+    """
+    The DTSTAMP most events of iCal data have, or None.
+    """
+    if any(marker in data for marker in STAMP_MARKERS):
+        return None
+    stamps = collections.Counter(DTSTAMP_RE.findall(data))
+    return stamps.most_common(1)[0][0] if stamps else None
+
+
+def unstamp(data, stamp):
+    for marker in STAMP_MARKERS:
+        data = data.replace(b'\nDTSTAMP:' + stamp + marker[len(b'\nDTSTAMP'):], marker)
+    return data
+
+
+def restamp(data, stamp):
+    for marker in STAMP_MARKERS:
+        data = data.replace(marker, b'\nDTSTAMP:' + stamp + marker[len(b'\nDTSTAMP'):])
+    return data
+
+
+def paginate(digests):
+    """
+    Cuts a list of hashes into pages, after each hash ending in a multiple
+    of PAGE_FANOUT.
+    """
+    pages = [[]]
+    for value in digests:
+        pages[-1].append(value)
+        if six.indexbytes(value, -1) % PAGE_FANOUT == 0:
+            pages.append([])
+    return [b''.join(page) for page in pages if page]
+
+
+def unpaginate(pages):
+    return [page[i:i + HASH_SIZE] for page in pages for i in range(0, len(page), HASH_SIZE)]
+
+
+def known_digests(conn, digests, batch_size=500):
+    """
+    Returns which of some hashes the store already holds.
+    """
+    digests = list(set(digests))
+    known = set()
+    for i in range(0, len(digests), batch_size):
+        batch = digests[i:i + batch_size]
+        rows = conn.execute('SELECT hash FROM chunk WHERE hash IN (%s)' % ', '.join('?' * len(batch)),
+                            [sqlite3.Binary(value) for value in batch])
+        known.update(bytes(value) for value, in rows)
+    return known
+
+
+def read_chunks(conn, digests, batch_size=500):
+    """
+    Returns the chunks with the given hashes, in order.
+    """
+    locations = {}
+    unique = list(set(digests))
+    for i in range(0, len(unique), batch_size):
+        batch = unique[i:i + batch_size]
+        rows = conn.execute('SELECT hash, pack, offset, length FROM chunk WHERE hash IN (%s)'
+                            % ', '.join('?' * len(batch)),
+                            [sqlite3.Binary(value) for value in batch])
+        for value, pack_id, offset, length in rows:
+            locations[bytes(value)] = (pack_id, offset, length)
+
+    packs = {}
+    chunks = []
+    for value in digests:
+        if value not in locations:
+            raise ValueError("Snapshot store {} is missing a chunk!".format(SNAPSHOT_PATH))
+        pack_id, offset, length = locations[value]
+        if pack_id not in packs:
+            data, = conn.execute('SELECT data FROM pack WHERE id = ?', (pack_id,)).fetchone()
+            packs[pack_id] = zlib.decompress(bytes(data))
+        chunks.append(packs[pack_id][offset:offset + length])
+    return chunks
+
+
+def write_packs(conn, chunks):
+    """
+    Stores new chunks, compressed in packs, returning the bytes written.
+
+    :param chunks: (hash, chunk) of each
+    """
+    stored = 0
+    pending = []
+    size = 0
+    for i, (value, chunk) in enumerate(chunks):
+        pending.append((value, chunk))
+        size += len(chunk)
+        if size < PACK_SIZE and i + 1 < len(chunks):
+            continue
+
+        data = zlib.compress(b''.join(chunk for _, chunk in pending))
+        pack_id = conn.execute('INSERT INTO pack (data) VALUES (?)', (sqlite3.Binary(data),)).lastrowid
+        rows = []
+        offset = 0
+        for value, chunk in pending:
+            rows.append((sqlite3.Binary(value), pack_id, offset, len(chunk)))
+            offset += len(chunk)
+        conn.executemany('INSERT INTO chunk (hash, pack, offset, length) VALUES (?, ?, ?, ?)', rows)
+        stored += len(data)
+        pending = []
+        size = 0
+    return stored
+
+
+def store(calendar_name, data, taken=None):
+    """
+    Saves iCal data of a calendar as a new snapshot, returning it.
+    """
+    stamp = shared_stamp(data)
+    body = unstamp(data, stamp) if stamp is not None else data
+    chunks = split_chunks(body)
+
+    conn = connect()
+    try:
+        with conn:
+            new = collections.OrderedDict()
+
+            def add(level_chunks):
+                digests = [digest(chunk) for chunk in level_chunks]
+                known = known_digests(conn, digests)
+                for value, chunk in zip(digests, level_chunks):
+                    if value not in known:
+                        new.setdefault(value, chunk)
+                return digests
+
+            level = add(chunks)
+            height = 0
+            while height == 0 or len(level) > 1:
+                # An empty page stands for no data at all
+                level = add(paginate(level) or [b''])
+                height += 1
+
+            snapshot = Snapshot(
+                id=None,
+                calendar=calendar_name,
+                taken=(taken or datetime.utcnow()).strftime('%Y-%m-%d %H:%M:%S'),
+                root=level[0],
+                height=height,
+                dtstamp=stamp,
+                size=len(data),
+                events=sum(1 for chunk in chunks if is_event(chunk)),
+                stored=write_packs(conn, list(new.items())),
+                sha1=hashlib.sha1(data).hexdigest(),
+            )
+            values = [sqlite3.Binary(value) if name in BLOB_FIELDS and value is not None else value
+                      for name, value in zip(SNAPSHOT_FIELDS, snapshot)][1:]
+            snapshot_id = conn.execute(
+                'INSERT INTO snapshot (%s) VALUES (%s)'
+                % (', '.join(SNAPSHOT_FIELDS[1:]), ', '.join('?' * len(values))),
+                values
+            ).lastrowid
+    finally:
+        conn.close()
+    return snapshot._replace(id=snapshot_id)
+
+
+def row_snapshot(row):
+    return Snapshot(*[bytes(value) if name in BLOB_FIELDS and value is not None else value
+                      for name, value in zip(SNAPSHOT_FIELDS, row)])
+
+
+def list_snapshots(calendar_name=None):
+    """
+    Returns the snapshots, of one calendar or all, oldest first.
+    """
+    conn = connect()
+    try:
+        sql = 'SELECT %s FROM snapshot' % ', '.join(SNAPSHOT_FIELDS)
+        if calendar_name is not None:
+            rows = conn.execute(sql + ' WHERE calendar = ? ORDER BY id', (calendar_name,))
+        else:
+            rows = conn.execute(sql + ' ORDER BY id')
+        return [row_snapshot(row) for row in rows]
+    finally:
+        conn.close()
+
+
+def get_snapshot(snapshot_id):
+    """
+    Returns a snapshot by id, or None.
+    """
+    conn = connect()
+    try:
+        row = conn.execute('SELECT %s FROM snapshot WHERE id = ?' % ', '.join(SNAPSHOT_FIELDS),
+                           (snapshot_id,)).fetchone()
+        return row_snapshot(row) if row is not None else None
+    finally:
+        conn.close()
+
+
+def previous_snapshot(snapshot):
+    """
+    Returns the snapshot of the same calendar taken before another, or None.
+    """
+    earlier = [other for other in list_snapshots(snapshot.calendar) if other.id < snapshot.id]
+    return earlier[-1] if earlier else None
+
+
+def leaf_digests(conn, snapshot):
+    level = [snapshot.root]
+    for _ in range(snapshot.height):
+        level = unpaginate(read_chunks(conn, level))
+    return level
+
+
+def load(snapshot):
+    """
+    Returns the iCal data of a snapshot, as downloaded.
+    """
+    conn = connect()
+    try:
+        data = b''.join(read_chunks(conn, leaf_digests(conn, snapshot)))
+    finally:
+        conn.close()
+    if snapshot.dtstamp is not None:
+        data = restamp(data, snapshot.dtstamp)
+    if hashlib.sha1(data).hexdigest() != snapshot.sha1:
+        raise ValueError("Snapshot {} corrupt!".format(snapshot.id))
+    return data
+
+
+def diff(old, new):
+    """
+    Returns the VEVENTs only in the old snapshot and those only in the new
+    one, as iCal data. Only the chunks that differ are read.
+    """
+    conn = connect()
+    try:
+        old_digests = leaf_digests(conn, old)
+        new_digests = leaf_digests(conn, new)
+        old_set, new_set = set(old_digests), set(new_digests)
+        removed = read_chunks(conn, [value for value in old_digests if value not in new_set])
+        added = read_chunks(conn, [value for value in new_digests if value not in old_set])
+    finally:
+        conn.close()
+
+    def events(chunks, stamp):
+        return [restamp(chunk, stamp) if stamp is not None else chunk
+                for chunk in chunks if is_event(chunk)]
+
+    return events(removed, old.dtstamp), events(added, new.dtstamp)
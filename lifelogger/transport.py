@@ -0,0 +1,89 @@
+# coding=utf-8
+"""
+HTTP transport for the Calendar API client that threads can share.
+
+httplib2.Http keeps its connections alive between requests, but isn't
+thread-safe. PooledHttp stands in for it, lending each request one of a
+bounded pool of Http objects - so concurrent writers (sync, flush, bulk
+imports) can use one authorized service, and sequential requests keep
+reusing warm connections instead of negotiating TLS again.
+"""
+from __future__ import absolute_import
+
+import threading
+from contextlib import contextmanager
+
+import httplib2
+from six.moves import queue
+
+DEFAULT_SIZE = 4
+DEFAULT_TIMEOUT = 30  # seconds, per socket operation
+
+
+class PooledHttp(object):
+    """
+    Thread-safe drop-in for httplib2.Http (as far as the API client and
+    oauth2client use it), backed by at most size Http objects.
+    """
+
+    def __init__(self, size=DEFAULT_SIZE, timeout=DEFAULT_TIMEOUT, factory=httplib2.Http):
+        """
+        :param size: Most requests in flight at once - more wait their turn
+        :param timeout: Socket timeout in seconds
+        :param factory: Callable making an Http object from a timeout
+        """
+        self.size = size
+        self.timeout = timeout
+        self.factory = factory
+        self.idle = queue.LifoQueue()  # The warmest connection goes first
+        self.created = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        """Borrow an Http object, creating one if the pool isn't full yet
+        """
+        try:
+            http = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                create = self.created < self.size
+                if create:
+                    self.created += 1
+            if create:
+                http = self.factory(timeout=self.timeout)
+            else:
+                http = self.idle.get()
+
+        try:
+            yield http
+        except Exception:
+            # Its connections may be half way through a response - start over
+            http.connections.clear()
+            raise
+        finally:
+            self.idle.put(http)
+
+    def request(self, uri, method='GET', body=None, headers=None,
+                redirections=httplib2.DEFAULT_MAX_REDIRECTS, connection_type=None):
+        with self.connection() as http:
+            return http.request(
+                uri, method=method, body=body, headers=headers,
+                redirections=redirections, connection_type=connection_type,
+            )
+
+    def close(self):
+        """Close the idle connections
+        """
+        idle = []
+        while True:
+            try:
+                idle.append(self.idle.get_nowait())
+            except queue.Empty:
+                break
+
+        for http in idle:
+            for conn in http.connections.values():
+                conn.close()
+            http.connections.clear()
+            self.idle.put(http)
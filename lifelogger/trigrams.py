@@ -0,0 +1,231 @@
+# coding=utf-8
+"""
+Trigrams of event text, and the trigrams any text matching a regex must
+contain - so a regex filter only needs to run on the events the trigram
+index (EventTrigram) says hold them, rather than on every event.
+
+For example, anything /#weight \\d+kg/ matches contains '#we', 'wei', 'eig',
+'igh', 'ght' and 'ht ', and anything /#(run|ride)/ matches contains both
+'#ru' and 'run', or both '#ri' and 'rid' and 'ide'.
+
+Both sides are case-folded, as lifelogger regexes ignore case. Only ASCII
+text goes into trigrams: other characters break text into separately
+indexed pieces, and a regex's non-ASCII literals are taken to match
+anything, so the trigrams stay a necessary condition whatever case rules
+apply to them.
+"""
+from __future__ import absolute_import
+
+import re
+
+import six
+
+try:
+    from re import _parser as sre_parse  # Python 3.11+
+except ImportError:
+    import sre_parse
+
+# Non-ASCII characters that match ASCII letters when ignoring case
+FOLDED_CHARACTERS = {
+    0x130: u'i',  # İ
+    0x131: u'i',  # ı
+    0x17f: u's',  # ſ
+    0x212a: u'k',  # Kelvin sign
+}
+
+NON_ASCII_RE = re.compile(u'[^\x00-\x7f]+')
+
+# Most strings a piece of a regex is tracked as matching exactly, e.g.
+# 'colo(u|)r' as colour or color, before making do with their trigrams
+MAX_STRINGS = 16
+
+# Most trigrams to require of a single string
+MAX_TRIGRAMS = 8
+
+# Condition matching everything
+ANYTHING = ('and', ())
+
+REPEATS = tuple(getattr(sre_parse, name) for name in ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT')
+                if hasattr(sre_parse, name))
+GROUPS = tuple(getattr(sre_parse, name) for name in ('SUBPATTERN', 'ATOMIC_GROUP')
+               if hasattr(sre_parse, name))
+
+
+def fold(text):
+    return text.translate(FOLDED_CHARACTERS).lower()
+
+
+def text_trigrams(text):
+    """
+    Returns the set of trigrams in some text.
+    """
+    trigrams = set()
+    for piece in NON_ASCII_RE.split(fold(text or u'')):
+        trigrams.update(piece[i:i + 3] for i in range(len(piece) - 2))
+    return trigrams
+
+
+def all_of(conditions):
+    """
+    And of conditions - trigrams, or ('and' | 'or', conditions) tuples.
+    """
+    flat = set()
+    for condition in conditions:
+        if isinstance(condition, tuple) and condition[0] == 'and':
+            flat.update(condition[1])
+        else:
+            flat.add(condition)
+    if len(flat) == 1 and isinstance(next(iter(flat)), tuple):
+        return flat.pop()
+    return ('and', tuple(sorted(flat, key=repr)))
+
+
+def any_of(conditions):
+    flat = set()
+    for condition in conditions:
+        if condition == ANYTHING:
+            return ANYTHING
+        if isinstance(condition, tuple) and condition[0] == 'or':
+            flat.update(condition[1])
+        else:
+            flat.add(condition)
+    if len(flat) == 1:
+        return flat.pop()
+    return ('or', tuple(sorted(flat, key=repr)))
+
+
+def string_condition(string):
+    trigrams = sorted(set(string[i:i + 3] for i in range(len(string) - 2)))
+    if len(trigrams) > MAX_TRIGRAMS:
+        # Spread the ones kept over the string
+        step = len(trigrams) / float(MAX_TRIGRAMS)
+        trigrams = [trigrams[int(i * step)] for i in range(MAX_TRIGRAMS)]
+    return all_of(trigrams)
+
+
+def strings_condition(strings):
+    """
+    What text containing one of some strings contains.
+    """
+    if any(len(string) < 3 for string in strings):
+        return ANYTHING
+    return any_of(string_condition(string) for string in strings)
+
+
+class Info(object):
+    """
+    What's known of the text a piece of a regex matches: the set of strings
+    it can be exactly (folded), if known and few, and a condition on the
+    trigrams it contains otherwise.
+    """
+
+    def __init__(self, strings=None, condition=ANYTHING):
+        self.strings = strings
+        self.condition = condition
+
+    def required(self):
+        if self.strings is not None:
+            return all_of([self.condition, strings_condition(self.strings)])
+        return self.condition
+
+
+UNKNOWN = Info()
+
+
+def literal(code):
+    character = six.unichr(code)
+    if ord(character) < 0x80 or code in FOLDED_CHARACTERS:
+        return Info(set([fold(character)]))
+    return UNKNOWN
+
+
+def analyze_sequence(items):
+    strings = set([u''])
+    conditions = []
+    exact = True
+    for op, av in items:
+        info = analyze(op, av)
+        if info.strings is not None and len(strings) * len(info.strings) <= MAX_STRINGS:
+            strings = set(prefix + suffix for prefix in strings for suffix in info.strings)
+            continue
+        # Keep what's known so far, and start over from this piece
+        exact = False
+        conditions.append(strings_condition(strings))
+        conditions.append(info.condition)
+        strings = info.strings if info.strings is not None else set([u''])
+
+    if exact:
+        return Info(strings)
+    conditions.append(strings_condition(strings))
+    return Info(condition=all_of(conditions))
+
+
+def analyze(op, av):
+    if op == sre_parse.LITERAL:
+        return literal(av)
+
+    if op == sre_parse.AT:
+        # Anchors match no text
+        return Info(set([u'']))
+
+    if op == sre_parse.IN:
+        strings = set()
+        for item_op, item_av in av:
+            if item_op == sre_parse.LITERAL:
+                info = literal(item_av)
+            elif item_op == sre_parse.RANGE and item_av[1] - item_av[0] < MAX_STRINGS:
+                infos = [literal(code) for code in range(item_av[0], item_av[1] + 1)]
+                info = Info(set().union(*[i.strings for i in infos])) \
+                    if all(i.strings is not None for i in infos) else UNKNOWN
+            else:
+                # Negated sets, categories like \d...
+                return UNKNOWN
+            if info.strings is None:
+                return UNKNOWN
+            strings.update(info.strings)
+        return Info(strings) if len(strings) <= MAX_STRINGS else UNKNOWN
+
+    if op in GROUPS:
+        # (group, pattern) in Python 2, (group, add flags, del flags, pattern)
+        # after, the pattern alone for atomic groups
+        return analyze_sequence(av[-1] if isinstance(av, tuple) else av)
+
+    if op == sre_parse.BRANCH:
+        infos = [analyze_sequence(branch) for branch in av[1]]
+        if all(branch_info.strings is not None for branch_info in infos):
+            strings = set().union(*[branch_info.strings for branch_info in infos])
+            if len(strings) <= MAX_STRINGS:
+                return Info(strings)
+        return Info(condition=any_of(branch_info.required() for branch_info in infos))
+
+    if op in REPEATS:
+        low, high, pattern = av
+        info = analyze_sequence(pattern)
+        if low == high == 1:
+            return info
+        if low == 0 and high == 1 and info.strings is not None:
+            return Info(info.strings | set([u'']))
+        if low >= 1:
+            return Info(condition=info.required())
+        return UNKNOWN
+
+    return UNKNOWN
+
+
+def required_trigrams(pattern):
+    """
+    Returns a condition on the trigrams of any text a regex searches
+    successfully: a trigram, ('and', conditions) or ('or', conditions) -
+    ANYTHING, ('and', ()), if it can match text without trigrams.
+    """
+    if isinstance(pattern, bytes):
+        try:
+            pattern = pattern.decode('utf-8')
+        except UnicodeDecodeError:
+            return ANYTHING
+    try:
+        parsed = sre_parse.parse(pattern)
+    except (re.error, OverflowError, RuntimeError):
+        # Left for the regex engine to report
+        return ANYTHING
+    return analyze_sequence(parsed).required()
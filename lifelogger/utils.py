@@ -2,35 +2,51 @@
 from __future__ import absolute_import
 import re
 import sys
+import threading
 from datetime import datetime
 
+import dateutil.parser
+import six
+from dateutil import tz
 from termcolor import colored
 
 
-if sys.stdout.isatty():
-    def blue(string):
-        return colored(string, 'blue')
+# Checked on each call, as the daemon swaps sys.stdout for each client
+def blue(string):
+    return colored(string, 'blue') if sys.stdout.isatty() else string
 
-    def pink(string):
-        return colored(string, 'magenta')
-else:
-    def blue(string):
-        return string
 
-    def pink(string):
-        return string
+def pink(string):
+    return colored(string, 'magenta') if sys.stdout.isatty() else string
+
+
+class QueryTimeout(Exception):
+    """A query ran past the --timeout of a command
+    """
+
+
+class SchemaOutdated(Exception):
+    """The local database was made by another version of lifelogger, and
+    only make_db_all may rebuild it
+    """
+
+
+TAG_RE = re.compile(r'\#\w+\b', flags=re.MULTILINE)
 
 
 def highlight_tags(string):
     def highlight(match):
         return pink(match.group(0))
 
-    return re.sub(
-        r'\#\w+\b',
-        highlight,
-        string,
-        flags=re.MULTILINE
-    )
+    return TAG_RE.sub(highlight, string)
+
+
+def extract_tags(string):
+    """
+    Returns the sorted, lower-cased set of hashtags in a string, e.g.
+    ['#exercise', '#gym'] for '#Gym session #exercise'
+    """
+    return sorted(set(tag.lower() for tag in TAG_RE.findall(string or '')))
 
 
 def nice_format(var):
@@ -38,3 +54,53 @@ def nice_format(var):
         return var.isoformat()
     else:
         return str(var)
+
+
+API_TIME_RE = re.compile(r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.\d+)?(Z|([+-])(\d\d):(\d\d))?$')
+
+
+def parse_api_datetime(value):
+    """
+    Parses an RFC 3339 time as returned by the Calendar API - e.g.
+    2018-01-01T08:00:00Z or 2018-01-01T08:00:00+01:00 - much faster than
+    dateutil, falling back to it for anything else.
+    """
+    match = API_TIME_RE.match(value)
+    if match is None:
+        return dateutil.parser.parse(value)
+
+    dt = datetime.strptime(match.group(1), '%Y-%m-%dT%H:%M:%S')
+    if match.group(2) == 'Z':
+        return dt.replace(tzinfo=tz.tzutc())
+    if match.group(2):
+        offset = (int(match.group(4)) * 60 + int(match.group(5))) * 60
+        return dt.replace(tzinfo=tz.tzoffset(None, -offset if match.group(3) == '-' else offset))
+    return dt
+
+
+class BackgroundCall(threading.Thread):
+    """
+    Calls a function in a background thread straight away; result() waits for
+    it and returns its value, or re-raises its exception.
+    """
+
+    def __init__(self, func, *args, **kwargs):
+        super(BackgroundCall, self).__init__()
+        self.daemon = True
+        self._call = (func, args, kwargs)
+        self._value = None
+        self._exc_info = None
+        self.start()
+
+    def run(self):
+        func, args, kwargs = self._call
+        try:
+            self._value = func(*args, **kwargs)
+        except BaseException:
+            self._exc_info = sys.exc_info()
+
+    def result(self):
+        self.join()
+        if self._exc_info is not None:
+            six.reraise(*self._exc_info)
+        return self._value
@@ -0,0 +1,236 @@
+# coding=utf-8
+"""
+Building blocks of the watch command: noticing files change, with Linux
+inotify (through ctypes) or by polling their stat where it's missing,
+letting bursts of writes settle before reacting, and polling calendars
+more often the more often they turn out to change.
+
+Directories are watched rather than files, as Dropbox and write_atomically()
+replace files with a rename, which an inotify watch on the file itself
+wouldn't follow.
+
+Settings live under the "watch" key of the config file:
+- "debounce": seconds without writes before reacting to a change, default 2
+- "max_delay": most seconds to put off reacting while writes keep coming,
+  default 30
+- "min_poll", "max_poll": bounds on the seconds between downloads of a
+  calendar, default 300 and 21600 (6 hours)
+"""
+from __future__ import absolute_import
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+
+from .config import config
+
+DEFAULT_DEBOUNCE = 2
+DEFAULT_MAX_DELAY = 30
+DEFAULT_MIN_POLL = 5 * 60
+DEFAULT_MAX_POLL = 6 * 60 * 60
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_Q_OVERFLOW = 0x4000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# Files written in place, or moved into place
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO
+
+INOTIFY_EVENT = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+
+# Seconds between scans of the watched directories without inotify
+STAT_INTERVAL = 1
+
+
+def settings():
+    values = config.get('watch', {})
+    return (
+        values.get('debounce', DEFAULT_DEBOUNCE),
+        values.get('max_delay', DEFAULT_MAX_DELAY),
+        values.get('min_poll', DEFAULT_MIN_POLL),
+        values.get('max_poll', DEFAULT_MAX_POLL),
+    )
+
+
+class Inotify(object):
+    """
+    Linux inotify watches on directories.
+    """
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify not available")
+        self._libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self.watches = {}  # Directory of each watch descriptor
+
+    def add_watch(self, directory):
+        path = directory.encode(sys.getfilesystemencoding()) if not isinstance(directory, bytes) else directory
+        wd = self._libc.inotify_add_watch(self.fd, path, WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "%s: %s" % (directory, os.strerror(ctypes.get_errno())))
+        self.watches[wd] = directory
+
+    def read(self, timeout):
+        """
+        Waits up to timeout seconds for files to change, returning their
+        paths - None standing for any file, if too many changed to tell.
+        """
+        if not select.select([self.fd], [], [], max(timeout, 0))[0]:
+            return []
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except OSError as exc:
+            if exc.errno == errno.EAGAIN:
+                return []
+            raise
+
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                paths.append(None)
+            elif wd in self.watches and name:
+                paths.append(os.path.join(self.watches[wd], name.decode(sys.getfilesystemencoding())))
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+class StatWatcher(object):
+    """
+    Stand-in for Inotify where it's missing, scanning the directories'
+    files for a new inode, size or mtime.
+    """
+
+    def __init__(self):
+        self.directories = []
+        self.seen = {}
+
+    def scan(self):
+        changed = []
+        for directory in self.directories:
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                continue
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                key = (stat.st_ino, stat.st_size, stat.st_mtime)
+                if self.seen.get(path) != key:
+                    changed.append(path)
+                self.seen[path] = key
+        return changed
+
+    def add_watch(self, directory):
+        self.directories.append(directory)
+        self.scan()
+
+    def read(self, timeout):
+        deadline = time.time() + timeout
+        while True:
+            changed = self.scan()
+            if changed or time.time() >= deadline:
+                return changed
+            time.sleep(max(min(STAT_INTERVAL, deadline - time.time()), 0))
+
+    def close(self):
+        pass
+
+
+def open_watcher():
+    """
+    Returns an Inotify, or a StatWatcher where inotify isn't available.
+    """
+    try:
+        return Inotify()
+    except (OSError, AttributeError, TypeError):
+        return StatWatcher()
+
+
+class Debouncer(object):
+    """
+    Collects changes, holding them until none came for quiet seconds - or
+    for at most max_delay seconds since the first.
+    """
+
+    def __init__(self, quiet, max_delay):
+        self.quiet = quiet
+        self.max_delay = max_delay
+        self.pending = set()
+        self.first = self.last = None
+
+    def add(self, key, now):
+        if not self.pending:
+            self.first = now
+        self.pending.add(key)
+        self.last = now
+
+    def deadline(self):
+        """
+        When the pending changes are due, or None if there are none.
+        """
+        if not self.pending:
+            return None
+        return min(self.last + self.quiet, self.first + self.max_delay)
+
+    def due(self, now):
+        """
+        Returns the pending changes if they're due, forgetting them.
+        """
+        if not self.pending or now < self.deadline():
+            return set()
+        pending, self.pending = self.pending, set()
+        return pending
+
+
+class PollSchedule(object):
+    """
+    When to next poll each of some sources: an interval that halves when a
+    poll finds a change and doubles when it doesn't, between min_interval
+    and max_interval - so sources get polled about as often as they change.
+    """
+
+    def __init__(self, keys, min_interval, max_interval, now):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.intervals = dict((key, min_interval) for key in keys)
+        self.next = dict((key, now) for key in keys)
+
+    def deadline(self):
+        return min(self.next.values()) if self.next else None
+
+    def due(self, now):
+        return sorted(key for key, when in self.next.items() if when <= now)
+
+    def record(self, key, changed, now):
+        """
+        Schedules the next poll of a source after one that did or didn't
+        find a change, returning the interval until then.
+        """
+        interval = self.intervals[key] / 2.0 if changed else self.intervals[key] * 2
+        interval = min(max(interval, self.min_interval), self.max_interval)
+        self.intervals[key] = interval
+        self.next[key] = now + interval
+        return interval
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""
+Speedup of running bulk Calendar API work concurrently (lifelogger.bulk),
+against the in-memory fake API with a fixed latency per round trip. Times
+single inserts (as sync-nomie sends them) and a journal flush (as import and
+the adding commands push them, in batches of 50) at growing concurrency.
+
+Uses a throwaway HOME, so your real ~/.config/lifelogger is left alone:
+
+    python scripts/benchmark_bulk.py --events 200 --latency 0.02
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fake_calendar_api import FakeCalendarService  # noqa: E402
+
+
+def insert_bodies(count, prefix):
+    start = datetime(2018, 1, 1, 8)
+    for i in range(count):
+        when = start + timedelta(minutes=10 * i)
+        yield {
+            'id': '%s%08d' % (prefix, i),
+            'summary': '#bench event %d' % i,
+            'start': {'dateTime': when.isoformat() + 'Z'},
+            'end': {'dateTime': when.isoformat() + 'Z'},
+        }
+
+
+def time_inserts(service, count, concurrency, run):
+    from lifelogger import bulk
+
+    requests = (
+        service.events().insert(calendarId='lifelogger', body=body)
+        for body in insert_bodies(count, 'ins%02d%02d' % (concurrency, run))
+    )
+    start = time.time()
+    for response, exc in bulk.execute_all(requests, concurrency):
+        assert exc is None, exc
+    return time.time() - start
+
+
+def time_flush(service, count, concurrency, run):
+    """
+    Leaves out the time spent writing the new events to the local database
+    at the end, which doesn't depend on the concurrency.
+    """
+    from lifelogger import journal
+
+    write_through = journal.write_through
+    local = []
+
+    def timed_write_through(created):
+        start = time.time()
+        write_through(created)
+        local.append(time.time() - start)
+
+    journal.queue_inserts('lifelogger', list(insert_bodies(count, 'fl%02d%02d' % (concurrency, run))))
+    journal.write_through = timed_write_through
+    start = time.time()
+    try:
+        remaining = journal.flush(lambda: service, concurrency=concurrency)
+    finally:
+        journal.write_through = write_through
+    assert remaining == 0, remaining
+    return time.time() - start - sum(local)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--events', type=int, default=200, help="Inserts per run")
+    parser.add_argument('--batched-events', type=int, default=2000, help="Flushed entries per run")
+    parser.add_argument('--latency', type=float, default=0.02, help="Seconds per round trip")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    args = parser.parse_args()
+
+    home = tempfile.mkdtemp(prefix='lifelogger-bench-')
+    os.environ['HOME'] = home
+    stdout = sys.stdout
+    try:
+        from lifelogger.config import config
+        with config.batch():
+            config['calendars'] = {'lifelogger': {'id': 'lifelogger', 'ical_url': ''}}
+            config['calendar_id'] = 'lifelogger'
+            config['timezone'] = 'UTC'
+            # Measure concurrency, not the pacing of a real quota
+            config['api'] = {'rate': 1e6, 'burst': 1e6, 'max_in_flight': max(args.concurrency)}
+
+        service = FakeCalendarService(latency=args.latency)
+        benchmarks = [
+            ("%d single inserts" % args.events, time_inserts, args.events),
+            ("flush of %d entries" % args.batched_events, time_flush, args.batched_events),
+        ]
+
+        print("%.0fms per round trip" % (args.latency * 1000))
+        for title, func, count in benchmarks:
+            print()
+            print("%-24s %11s %8s %8s" % (title, "concurrency", "seconds", "speedup"))
+            baseline = None
+            for run, concurrency in enumerate(args.concurrency):
+                sys.stdout = open(os.devnull, 'w')  # Per-event progress
+                try:
+                    elapsed = func(service, count, concurrency, run)
+                finally:
+                    sys.stdout.close()
+                    sys.stdout = stdout
+                baseline = baseline or elapsed
+                print("%-24s %11d %8.2f %7.1fx" % ('', concurrency, elapsed, baseline / elapsed))
+    finally:
+        sys.stdout = stdout
+        shutil.rmtree(home)
+
+
+if __name__ == '__main__':
+    main()
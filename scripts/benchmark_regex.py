@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+Regex filters over a large synthetic calendar (see generate_calendar.py),
+run as a full scan through the REGEXP function and through the trigram
+index (lifelogger.trigrams), checking both find the same events.
+
+Uses a throwaway HOME, so your real ~/.config/lifelogger is left alone:
+
+    python scripts/benchmark_regex.py --events 100000
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import sys
+import time
+
+from benchmark_suite import make_home, run
+
+PATTERNS = (
+    '#weight',
+    '#exercise (run|ride)',
+    '#caffeine \\d+mg',
+    '^#(sleep|meal)\\b',
+    '#work #(thesis|taxes)',
+    'colou?r|#search: .*water',
+    '[0-9.]+kg',
+)
+
+
+def time_query(query, repeat):
+    """Returns the ids of the events a query selects, and the best time
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        ids = [event_id for event_id, in query.tuples()]
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return ids, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--events', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3, help="Runs of each query - the best counts")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('patterns', nargs='*', default=PATTERNS, metavar='PATTERN',
+                        help="Regexes to time - default a few typical ones")
+    args = parser.parse_args()
+
+    home = make_home(args.events, 0, args.seed)
+    try:
+        start = time.time()
+        run(home, ['-m', 'lifelogger', 'make_db_all'])
+        print("Imported %d events in %.1fs" % (args.events, time.time() - start))
+
+        os.environ['HOME'] = home
+        from lifelogger.database import Event, query_stats, regex_search, regexp
+
+        print()
+        print("%-28s %8s %10s %10s %10s %8s" % ("pattern", "matches", "regexps", "scan s", "index s", "speedup"))
+        for pattern in args.patterns:
+            full_ids, full_time = time_query(
+                Event.select(Event.id).where(regexp(Event.summary, pattern)), args.repeat)
+
+            query_stats.reset_usage()
+            ids, index_time = time_query(
+                Event.select(Event.id).where(regex_search('summary', pattern)), args.repeat)
+            assert sorted(ids) == sorted(full_ids), pattern
+            print("%-28s %8d %10d %10.3f %10.3f %7.1fx" % (
+                pattern[:28], len(ids), query_stats.usage['regexp_calls'] // args.repeat,
+                full_time, index_time, full_time / index_time))
+    finally:
+        shutil.rmtree(home)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
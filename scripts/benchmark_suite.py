@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+"""
+End-to-end benchmarks of the lifelogger CLI on synthetic calendars (see
+generate_calendar.py): CLI startup, make_db_all from scratch and with nothing
+changed, list, csv, sql and the diff sync-nomie runs to find new events.
+
+Every command runs as its own process, against a throwaway HOME per size, so
+your real ~/.config/lifelogger is left alone:
+
+    python scripts/benchmark_suite.py --events 10000 100000 --output results.json
+
+Pass the results of an earlier run as --baseline to report the change in
+every benchmark, failing if any got slower than --threshold times.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+SCRIPTS_PATH = os.path.dirname(os.path.abspath(__file__))
+ROOT_PATH = os.path.join(SCRIPTS_PATH, '..')
+
+sys.path.insert(0, ROOT_PATH)
+
+from generate_calendar import generate  # noqa: E402
+
+# What sync-nomie does before talking to the API
+NOMIE_DIFF = """
+import json
+from lifelogger import nomie
+from lifelogger.config import NOMIE_BACKUP_PATH
+with open(NOMIE_BACKUP_PATH) as f:
+    events = nomie.parse_events(json.load(f))
+nomie.new_events(events)
+"""
+
+BENCHMARKS = (
+    # Name, command line, whether it needs a fresh database
+    ('startup', ['-m', 'lifelogger', '--help'], False),
+    ('make_db_all', ['-m', 'lifelogger', 'make_db_all'], True),
+    ('make_db_all unchanged', ['-m', 'lifelogger', 'make_db_all'], False),
+    ('list', ['-m', 'lifelogger', 'list', '--no-cache', '#weight'], False),
+    ('csv', ['-m', 'lifelogger', 'csv', '--no-cache', '-v', 'start,duration_minutes,kg', '#weight'], False),
+    # A regex the trigram index can't narrow down, on one process and on four
+    ('list scan', ['-m', 'lifelogger', 'list', '--no-cache', '[0-9.]+kg'], False),
+    ('list scan -j4', ['-m', 'lifelogger', 'list', '--no-cache', '-j', '4', '[0-9.]+kg'], False),
+    ('sql', ['-m', 'lifelogger', 'sql', '--no-cache',
+             "SELECT substr(summary, 1, instr(summary || ' ', ' ') - 1) AS tag, count(*) "
+             "FROM event GROUP BY tag ORDER BY 2 DESC"], False),
+    ('sync-nomie diff', ['-c', NOMIE_DIFF], False),
+)
+
+
+def make_home(num_events, num_nomie_events, seed):
+    """
+    A HOME with config, iCal files and a Nomie backup for lifelogger.
+    """
+    home = tempfile.mkdtemp(prefix='lifelogger-bench-')
+    data_path = os.path.join(home, '.config', 'lifelogger')
+    ics_path = os.path.join(data_path, 'ics')
+    os.makedirs(ics_path)
+
+    generate(ics_path, num_events, num_nomie_events, num_nomie_events // 10, seed)
+
+    # Where lifelogger looks for it in that HOME
+    backup_path = subprocess.check_output(
+        [sys.executable, '-c', 'from lifelogger.config import NOMIE_BACKUP_PATH; print(NOMIE_BACKUP_PATH)'],
+        env=environment(home), cwd=ROOT_PATH,
+    ).decode('utf-8').strip()
+    os.makedirs(os.path.dirname(backup_path))
+    shutil.move(os.path.join(ics_path, 'nomie.json'), backup_path)
+
+    with open(os.path.join(data_path, 'config.json'), 'w') as f:
+        json.dump({
+            'calendars': {
+                'lifelogger': {'id': 'lifelogger', 'ical_url': ''},
+                'Nomie': {'id': 'nomie', 'ical_url': ''},
+            },
+            'calendar_id': 'lifelogger',
+            'timezone': 'UTC',
+        }, f)
+    return home
+
+
+def environment(home):
+    env = dict(os.environ, HOME=home, PYTHONPATH=ROOT_PATH)
+    env.pop('PYTHONSTARTUP', None)
+    return env
+
+
+def run(home, args):
+    """Runs Python with args in home, returning the wall time it took
+    """
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        subprocess.check_call([sys.executable] + args, env=environment(home), cwd=ROOT_PATH,
+                              stdout=devnull)
+        return time.time() - start
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+def git_commit():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], cwd=ROOT_PATH, stderr=devnull
+            ).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints the change of each benchmark since the baseline results, and
+    returns whether none got slower than threshold times.
+    """
+    before = dict(((result['name'], result['events']), result['median']) for result in baseline['results'])
+    successful = True
+    print()
+    print("%-24s %10s %10s %10s %8s" % ("vs. baseline", "events", "before", "after", "change"))
+    for result in results:
+        key = (result['name'], result['events'])
+        if key not in before:
+            continue
+        ratio = result['median'] / before[key]
+        regressed = ratio > threshold
+        successful = successful and not regressed
+        print("%-24s %10d %10.3f %10.3f %7.2fx%s" % (
+            result['name'], result['events'], before[key], result['median'], ratio,
+            "  REGRESSION" if regressed else ""))
+    return successful
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--events', type=int, nargs='+', default=[10000],
+                        help="Sizes of the lifelogger calendar to run at")
+    parser.add_argument('--nomie-events', type=int, default=None,
+                        help="Events in the Nomie backup - default a tenth of --events")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs of each benchmark")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', nargs='+', metavar='NAME', help="Benchmarks to run")
+    parser.add_argument('--output', help="JSON file to write the results to")
+    parser.add_argument('--baseline', help="JSON results of an earlier run to compare against")
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help="Slowdown over the baseline that fails the run - default 1.25")
+    args = parser.parse_args()
+
+    benchmarks = [b for b in BENCHMARKS if not args.only or b[0] in args.only]
+    results = []
+
+    print("%-24s %10s %10s %10s" % ("benchmark", "events", "median", "min"))
+    for num_events in args.events:
+        num_nomie_events = args.nomie_events if args.nomie_events is not None else num_events // 10
+        home = make_home(num_events, num_nomie_events, args.seed)
+        db_path = os.path.join(home, '.config', 'lifelogger', 'calendar.sqlite')
+        try:
+            # Everything but make_db_all queries a database made beforehand
+            run(home, ['-m', 'lifelogger', 'make_db_all'])
+
+            for name, command, fresh_db in benchmarks:
+                times = []
+                for _ in range(args.repeat):
+                    if fresh_db:
+                        os.remove(db_path)
+                    times.append(run(home, command))
+                result = {
+                    'name': name,
+                    'events': num_events,
+                    'nomie_events': num_nomie_events,
+                    'runs': times,
+                    'median': median(times),
+                    'min': min(times),
+                }
+                results.append(result)
+                print("%-24s %10d %10.3f %10.3f" % (name, num_events, result['median'], result['min']))
+        finally:
+            shutil.rmtree(home)
+
+    report = {
+        'created': datetime.utcnow().isoformat() + 'Z',
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
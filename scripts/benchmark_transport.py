@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+"""
+Throughput benchmark of the HTTP transports the Calendar API client can use,
+against a local stub server that answers like events.insert after a fixed
+latency, and charges a handshake delay for every new connection (standing in
+for TCP + TLS setup to www.googleapis.com).
+
+    python scripts/benchmark_transport.py --requests 400 --threads 8
+
+Compares a fresh httplib2.Http per request (no reuse), one httplib2.Http
+shared behind a lock (reuse, but serial), and lifelogger's PooledHttp.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+import httplib2
+from six.moves import BaseHTTPServer, socketserver
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lifelogger.transport import PooledHttp  # noqa: E402
+
+
+class StubServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency, handshake):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.latency = latency
+        self.handshake = handshake
+        self.connections = 0
+        self.lock = threading.Lock()
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        # Headers go out line by line - don't let Nagle hold them back
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.server.lock:
+            self.server.connections += 1
+        time.sleep(self.server.handshake)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('content-length', 0)))
+        time.sleep(self.server.latency)
+        event = dict(json.loads(body.decode('utf-8')), status='confirmed')
+        response = json.dumps(event).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+class FreshHttp(object):
+    def request(self, *args, **kwargs):
+        http = httplib2.Http()
+        try:
+            return http.request(*args, **kwargs)
+        finally:
+            close(http)
+
+    def close(self):
+        pass
+
+
+class LockedHttp(object):
+    def __init__(self):
+        self.http = httplib2.Http()
+        self.lock = threading.Lock()
+
+    def request(self, *args, **kwargs):
+        with self.lock:
+            return self.http.request(*args, **kwargs)
+
+    def close(self):
+        close(self.http)
+
+
+def close(http):
+    for conn in http.connections.values():
+        conn.close()
+
+
+def run(server, http, num_requests, num_threads):
+    url = 'http://127.0.0.1:%d/calendar/v3/calendars/lifelogger/events' % server.server_address[1]
+    remaining = iter(range(num_requests))
+    lock = threading.Lock()
+    errors = []
+
+    def worker():
+        while True:
+            with lock:
+                i = next(remaining, None)
+            if i is None:
+                return
+            body = json.dumps({'summary': '#bench event %d' % i})
+            resp, content = http.request(url, 'POST', body=body,
+                                         headers={'content-type': 'application/json'})
+            if resp.status != 200:
+                errors.append(resp.status)
+
+    server.connections = 0
+    start = time.time()
+    threads = [threading.Thread(target=worker) for _ in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    return elapsed, server.connections, len(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--pool-size', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.005, help="Seconds per request")
+    parser.add_argument('--handshake', type=float, default=0.03, help="Seconds per new connection")
+    args = parser.parse_args()
+
+    server = StubServer(args.latency, args.handshake)
+    threading.Thread(target=server.serve_forever).start()
+
+    transports = [
+        ("httplib2.Http per request", FreshHttp()),
+        ("shared httplib2.Http + lock", LockedHttp()),
+        ("PooledHttp(size=%d)" % args.pool_size, PooledHttp(size=args.pool_size)),
+    ]
+
+    print("%d requests, %d threads, %.0fms latency, %.0fms handshake" % (
+        args.requests, args.threads, args.latency * 1000, args.handshake * 1000))
+    print("%-30s %10s %12s %7s" % ("transport", "requests/s", "connections", "errors"))
+    try:
+        for name, http in transports:
+            elapsed, connections, errors = run(server, http, args.requests, args.threads)
+            print("%-30s %10.1f %12d %7d" % (name, args.requests / elapsed, connections, errors))
+            http.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
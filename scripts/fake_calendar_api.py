@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+"""
+In-memory fake of the parts of the Google Calendar API that lifelogger uses
+(events list/insert/delete with paging and sync tokens, batches), for trying
+out sync and bulk operations without touching a real calendar.
+
+Run it directly to exercise 'lifelogger sync' against it - it uses a
+throwaway HOME, so your real ~/.config/lifelogger is left alone:
+
+    python scripts/fake_calendar_api.py
+"""
+from __future__ import print_function
+
+import copy
+import itertools
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+
+def http_error(status, message='', reason=None):
+    error = {'code': status, 'message': message}
+    if reason is not None:
+        error['errors'] = [{'reason': reason, 'message': message}]
+    return HttpError(
+        httplib2.Response({'status': status}),
+        json.dumps({'error': error}).encode('utf-8'),
+    )
+
+
+class FakeRequest(object):
+
+    def __init__(self, api, func, **kwargs):
+        self.api = api
+        self.func = func
+        self.kwargs = kwargs
+        self.headers = {}
+
+    @staticmethod
+    def postproc(resp, content):
+        return json.loads(content) if content else content
+
+    def execute(self, http=None, num_retries=0):
+        time.sleep(self.api.latency)
+        # Round trip through JSON like a real response
+        return self.postproc({'status': '200'}, json.dumps(self.run()))
+
+    def run(self):
+        with self.api.lock:
+            return self.func(**self.kwargs)
+
+
+class FakeBatch(object):
+
+    def __init__(self, api):
+        self.api = api
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        self.requests.append((request, callback, request_id))
+
+    def execute(self, http=None):
+        time.sleep(self.api.latency)  # One round trip for the whole batch
+        for request, callback, request_id in self.requests:
+            try:
+                response, exception = request.run(), None
+            except HttpError as exc:
+                response, exception = None, exc
+            callback(request_id, response, exception)
+
+
+class FakeEvents(object):
+
+    def __init__(self, api):
+        self.api = api
+
+    def list(self, **kwargs):
+        return FakeRequest(self.api, self.api.list_events, **kwargs)
+
+    def insert(self, **kwargs):
+        return FakeRequest(self.api, self.api.insert_event, **kwargs)
+
+    def delete(self, **kwargs):
+        return FakeRequest(self.api, self.api.delete_event, **kwargs)
+
+
+class FakeCalendarService(object):
+    """
+    Stands in for the service returned by connection.connect(). Every change
+    gets a sequence number; sync tokens are just the last number seen.
+    """
+
+    def __init__(self, calendar_ids=('lifelogger',), latency=0):
+        """
+        :param latency: Seconds every request takes, as if over the network
+        """
+        self.events_by_calendar = dict((cal_id, {}) for cal_id in calendar_ids)
+        self.latency = latency
+        self.lock = threading.Lock()  # Requests may come from several threads
+        self.seq = itertools.count(1)
+        self.current_seq = 0
+        self.min_valid_seq = 0  # Tokens older than this get 410 Gone
+        self.requests = 0
+
+    # Service interface
+
+    def events(self):
+        return FakeEvents(self)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self)
+
+    # Behind the interface
+
+    def touch(self, event):
+        self.current_seq = next(self.seq)
+        event['_seq'] = self.current_seq
+        event['updated'] = datetime.utcnow().isoformat() + 'Z'
+
+    def add(self, calendar_id, summary, start, minutes=0, **extra):
+        """
+        Adds an event directly, as if created from another device.
+        """
+        end = start + timedelta(minutes=minutes)
+        return self.insert_event(calendarId=calendar_id, body=dict(
+            extra,
+            summary=summary,
+            start={'dateTime': start.isoformat() + 'Z'},
+            end={'dateTime': end.isoformat() + 'Z'},
+        ))
+
+    def insert_event(self, calendarId, body, **kwargs):
+        self.requests += 1
+        events = self.events_by_calendar[calendarId]
+        event = copy.deepcopy(body)
+        event.setdefault('id', 'fake%08d' % (len(events) + 1))
+        if event['id'] in events:
+            raise http_error(409, 'The requested identifier already exists.')
+
+        event.update(
+            status='confirmed',
+            iCalUID=event['id'] + '@google.com',
+            htmlLink='https://calendar.google.com/event?eid=' + event['id'],
+        )
+        self.touch(event)
+        events[event['id']] = event
+        return self.public(event)
+
+    def delete_event(self, calendarId, eventId, **kwargs):
+        self.requests += 1
+        event = self.events_by_calendar[calendarId][eventId]
+        event['status'] = 'cancelled'
+        self.touch(event)
+        return ''
+
+    def list_events(self, calendarId, syncToken=None, pageToken=None, maxResults=250, **kwargs):
+        self.requests += 1
+        events = sorted(self.events_by_calendar[calendarId].values(), key=lambda e: e['_seq'])
+
+        if syncToken is not None:
+            since = int(syncToken)
+            if since < self.min_valid_seq:
+                raise http_error(410, 'Sync token is no longer valid, a full sync is required.')
+            events = [e for e in events if e['_seq'] > since]
+        else:
+            events = [e for e in events if e['status'] != 'cancelled']
+
+        offset = int(pageToken or 0)
+        page = events[offset:offset + maxResults]
+        result = {'items': [self.public(e) for e in page]}
+        if offset + maxResults < len(events):
+            result['nextPageToken'] = str(offset + maxResults)
+        else:
+            result['nextSyncToken'] = str(self.current_seq)
+        return result
+
+    @staticmethod
+    def public(event):
+        return dict((k, v) for k, v in event.items() if not k.startswith('_'))
+
+
+def main():
+    home = tempfile.mkdtemp(prefix='lifelogger-fake-')
+    os.environ['HOME'] = home
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+    # Show the pages and bytes listed
+    logging.basicConfig(level=logging.INFO, format='    %(message)s')
+
+    try:
+        from lifelogger.config import config
+        with config.batch():
+            config['calendars'] = {'lifelogger': {'id': 'lifelogger', 'ical_url': ''}}
+            config['calendar_id'] = 'lifelogger'
+            config['timezone'] = 'UTC'
+
+        from lifelogger.commands.google import sync_calendar
+        from lifelogger.database import Event
+
+        service = FakeCalendarService()
+        start = datetime(2018, 1, 1, 8)
+        for i in range(5000):
+            service.add('lifelogger', '#fake event %d' % i, start + timedelta(hours=i), minutes=30)
+
+        def step(title, **kwargs):
+            before = service.requests
+            changed, deleted = sync_calendar(service, 'lifelogger', **kwargs)
+            print("%-32s %5d changed %5d deleted %3d requests -> %d events" % (
+                title, changed, deleted, service.requests - before, Event.select().count()))
+
+        step("Initial full sync")
+        step("No changes")
+
+        service.add('lifelogger', '#fake added elsewhere', start - timedelta(days=1))
+        service.delete_event('lifelogger', 'fake00000003')
+        step("1 added, 1 deleted")
+
+        service.min_valid_seq = service.current_seq + 1
+        service.add('lifelogger', '#fake after token expiry', start - timedelta(days=2))
+        step("Token expired (410)")
+    finally:
+        shutil.rmtree(home)
+
+
+if __name__ == '__main__':
+    main()
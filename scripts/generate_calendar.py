@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+"""
+Deterministic synthetic lifelogger data, for benchmarks: an iCal file as
+Google exports it, with the hashtags, measurements, #search: notes,
+descriptions and all-day events real lifelogs have, plus a Nomie backup.
+
+The same --seed and sizes always give the same files (for a given Python
+version and timezone, which the Nomie times depend on):
+
+    python scripts/generate_calendar.py --events 100000 --nomie-events 10000 out/
+
+writes out/lifelogger.ics, out/nomie.json and out/Nomie.ics - the Nomie
+events sync-nomie already pushed, all but the last --nomie-new of them.
+"""
+from __future__ import print_function
+
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lifelogger import nomie  # noqa: E402
+
+EPOCH = datetime(2015, 1, 1, 7)
+
+WORDS = (
+    "about after again against also another around back because before "
+    "between both call came change come could day different does down each "
+    "end even every find first follow found give good great hand help here "
+    "home house just keep kind know large last later learn left light line "
+    "little long look made make many might more most move much must name "
+    "near need never next night number often old only open order other over "
+    "own page part people picture place play point put read right same say "
+    "school seem sentence set should show side small something sound spell "
+    "still study such take tell than thing think three through time together "
+    "turn under until very want water well went where while why without word "
+    "work world write year young"
+).split()
+
+PROJECTS = ('lifelogger', 'thesis', 'garden', 'taxes', 'website', 'move')
+PLACES = ('Madrid', 'London', 'Lisbon', 'Berlin', 'the coast', 'the mountains')
+TRACKERS = (
+    ('Running', True), ('Cycling', True), ('Yoga', True), ('Meditation', False),
+    ('Deep Work', False), ('Reading', False), ('Guitar', False), ('Nap', False),
+)
+
+
+def words(rng, low, high):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+
+def sentences(rng, count):
+    return ' '.join(words(rng, 4, 14).capitalize() + '.' for _ in range(count))
+
+
+def timed_event(rng):
+    """
+    Returns (summary, description, minutes) of an event of the mix in a
+    typical lifelog.
+    """
+    kind = rng.random()
+    if kind < 0.08:
+        return "#weight %.1fkg" % rng.gauss(75, 4), rng.choice(('', 'morning', 'after run')), 0
+    if kind < 0.12:
+        return "#bodyfat %.1f%%" % rng.gauss(18, 2), '', 0
+    if kind < 0.22:
+        return "#caffeine %dmg %s" % (rng.choice((40, 80, 95, 150)), rng.choice(('coffee', 'tea'))), '', 0
+    if kind < 0.30:
+        return "#exercise %s %.1fkm" % (rng.choice(('run', 'ride', 'swim')), rng.uniform(1, 25)), \
+            rng.choice(('', sentences(rng, 1))), rng.randint(20, 120)
+    if kind < 0.37:
+        return "#sleep", '', rng.randint(300, 540)
+    if kind < 0.62:
+        return "#work #%s %s" % (rng.choice(PROJECTS), words(rng, 1, 5)), \
+            rng.choice(('', '', sentences(rng, 2))), rng.randint(15, 180)
+    if kind < 0.70:
+        return "#reading %s" % words(rng, 2, 4), '', rng.randint(10, 90)
+    if kind < 0.78:
+        return "#search: %s" % words(rng, 2, 6), \
+            '\n'.join(sentences(rng, rng.randint(1, 4)) for _ in range(rng.randint(1, 4))), 0
+    if kind < 0.90:
+        return "#meal %s" % words(rng, 1, 3), '', rng.randint(10, 60)
+    return "%s #%s" % (words(rng, 2, 6), rng.choice(WORDS)), rng.choice(('', sentences(rng, 3))), \
+        rng.randint(0, 240)
+
+
+def generate_events(count, seed=0):
+    """
+    Yields dicts of uid, summary, description, start and end (naive UTC
+    datetimes, or dates for all-day events), in order of start.
+    """
+    rng = random.Random(seed)
+    when = EPOCH
+    for i in range(count):
+        uid = 'synth%08d@google.com' % i
+        if rng.random() < 0.02:
+            day = when.date()
+            yield {
+                'uid': uid,
+                'summary': "#holiday #travel %s" % rng.choice(PLACES),
+                'description': '',
+                'start': day,
+                'end': day + timedelta(days=rng.randint(1, 5)),
+            }
+            continue
+
+        summary, description, minutes = timed_event(rng)
+        yield {
+            'uid': uid,
+            'summary': summary,
+            'description': description,
+            'start': when,
+            'end': when + timedelta(minutes=minutes),
+        }
+        # About 12 events a day
+        when += timedelta(minutes=rng.randint(10, 230))
+
+
+def ical_text(value):
+    return (value.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+            .replace('\n', '\\n'))
+
+
+def ical_time(value):
+    if isinstance(value, datetime):
+        return ':' + value.strftime('%Y%m%dT%H%M%SZ')
+    return ';VALUE=DATE:' + value.strftime('%Y%m%d')
+
+
+def folded(line):
+    """Folds a content line at 75 characters, as RFC 5545 asks
+    """
+    chunks = [line[:75]]
+    for i in range(75, len(line), 74):
+        chunks.append(' ' + line[i:i + 74])
+    return '\r\n'.join(chunks) + '\r\n'
+
+
+def write_ics(path, events, name):
+    with io.open(path, 'w', encoding='utf-8', newline='') as f:
+        f.write(u'BEGIN:VCALENDAR\r\nPRODID:-//Google Inc//Google Calendar 70.9054//EN\r\n'
+                u'VERSION:2.0\r\nX-WR-CALNAME:%s\r\n' % name)
+        stamp = EPOCH.strftime('%Y%m%dT%H%M%SZ')
+        for event in events:
+            f.write(u'BEGIN:VEVENT\r\n')
+            f.write(u'DTSTART%s\r\n' % ical_time(event['start']))
+            f.write(u'DTEND%s\r\n' % ical_time(event['end']))
+            f.write(u'DTSTAMP:%s\r\n' % stamp)
+            f.write(u'UID:%s\r\n' % event['uid'])
+            f.write(folded(u'DESCRIPTION:' + ical_text(event['description'])))
+            f.write(folded(u'SUMMARY:' + ical_text(event['summary'])))
+            f.write(u'END:VEVENT\r\n')
+        f.write(u'END:VCALENDAR\r\n')
+
+
+def generate_nomie_backup(count, seed=0):
+    """
+    A Nomie backup with count tracker events, about a tenth of them with a
+    note, in the format nomie.parse_events() reads.
+    """
+    rng = random.Random(seed)
+    trackers = [{'_id': 'tracker%d' % i, 'label': label} for i, (label, _) in enumerate(TRACKERS)]
+    exercise = [tracker['_id'] for tracker, (_, is_exercise) in zip(trackers, TRACKERS) if is_exercise]
+
+    events = []
+    notes = []
+    now = time.mktime(EPOCH.timetuple())
+    for _ in range(count):
+        # Each event starts after the one before ends, so they get unique ids
+        gap = rng.randint(20, 300) * 60
+        duration = rng.choice((None, rng.randint(60, gap - 1)))
+        now += gap
+        tracker = rng.choice(trackers)
+        events.append({'parent': tracker['_id'], 'value': duration, 'time': int(now * 1000)})
+
+        if rng.random() < 0.1:
+            minutes = (duration or 0) // 60
+            clock = datetime.fromtimestamp(now).strftime('%H:%M')
+            notes.append({
+                'time': int(now * 1000) + 1000,
+                'value': '#%s %dm  at %s\n%s\n%s' % (
+                    tracker['label'].replace(' ', '_'), minutes, clock,
+                    words(rng, 2, 5), sentences(rng, rng.randint(1, 3))),
+            })
+
+    return {
+        'trackers': trackers,
+        'meta': [{}, {'groups': {'Exercise': exercise}}],
+        'events': events,
+        'notes': notes,
+    }
+
+
+def synced_nomie_events(backup, synced):
+    """
+    The first synced events of a Nomie backup, as sync-nomie leaves them in
+    the Nomie calendar.
+    """
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')  # parse_events reports every event
+    try:
+        events = nomie.parse_events(backup)[:synced]
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    for event in events:
+        yield {
+            'uid': nomie.event_id(event) + '@google.com',
+            'summary': event['title'],
+            'description': event['description'],
+            # Close enough to UTC for a benchmark
+            'start': event['startdate'],
+            'end': event['enddate'],
+        }
+
+
+def generate(output, num_events, num_nomie_events, num_nomie_new, seed=0):
+    """
+    Writes lifelogger.ics, nomie.json and Nomie.ics into the output folder.
+    """
+    write_ics(os.path.join(output, 'lifelogger.ics'), generate_events(num_events, seed), 'lifelogger')
+
+    backup = generate_nomie_backup(num_nomie_events, seed)
+    with open(os.path.join(output, 'nomie.json'), 'w') as f:
+        json.dump(backup, f)
+
+    synced = synced_nomie_events(backup, max(num_nomie_events - num_nomie_new, 0))
+    write_ics(os.path.join(output, 'Nomie.ics'), synced, 'Nomie')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('output', help="Folder to write the files to")
+    parser.add_argument('--events', type=int, default=10000)
+    parser.add_argument('--nomie-events', type=int, default=1000)
+    parser.add_argument('--nomie-new', type=int, default=100, help="Nomie events not synced yet")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    generate(args.output, args.events, args.nomie_events, args.nomie_new, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,11 @@
 #!/usr/bin/env python
 """
 Take notes from Notes.app and turn them into lifelogger events, putting those
-that were converted into an 'Archive' folder on the way. It is your
-responsibility to clear the 'Archive' folder before re-running, otherwise you
-will get duplicate events. You'll also probably want to update the import
-functions as you'll be using different syntax to me.
+that were converted into an 'Archive' folder on the way. Events are imported
+in one go with `lifelogger import`, which skips any already imported, so
+re-running with notes left outside the 'Archive' folder won't duplicate them.
+You'll also probably want to update the import functions as you'll be using
+different syntax to me.
 
 Needs two extra dependencies from lifelogger - sh and lxml. Runs the
 accompanying applescript to export to json before loading here.
@@ -40,9 +41,22 @@ def main():
     notes = dump_and_load_notes()
 
     print "Running import functions"
-    import_weights_to_lifelogger(notes)
+    events = []
+    events += import_weights_to_lifelogger(notes)
+    events += import_cms_to_lifelogger(notes)
 
-    import_cms_to_lifelogger(notes)
+    if not events:
+        print "Nothing to import"
+        return
+
+    # One bulk import rather than starting lifelogger for every event
+    print lifelogger('import', '--format', 'jsonl', '-', _in=''.join(
+        json.dumps({'summary': summary, 'start': when.isoformat()}) + '\n'
+        for note, when, summary in events
+    ))
+
+    for note, when, summary in events:
+        archive_note(note['id'])
 
 
 def dump_and_load_notes():
@@ -96,6 +110,7 @@ weights_re = re.compile("""
 
 
 def import_weights_to_lifelogger(notes):
+    events = []
     for note in notes:
         body = note['body']
         match = weights_re.match(body)
@@ -109,18 +124,19 @@ def import_weights_to_lifelogger(notes):
             print note['when'], event
             import ipdb; ipdb.set_trace()
 
-            print lifelogger('add', '--start', note['when'].isoformat(), event)
-            archive_note(note['id'])
+            events.append((note, note['when'], event))
+    return events
 
 
 def import_cms_to_lifelogger(notes):
     event = 'Clenil Modulite 200mcg #drugs'
+    events = []
     for note in notes:
         if note['body'].lower() == 'cm':
             print note
             import ipdb; ipdb.set_trace()
-            print lifelogger('add', '--start', note['when'].isoformat(), event)
-            archive_note(note['id'])
+            events.append((note, note['when'], event))
+    return events
 
 
 def archive_note(note_id):